@@ -0,0 +1,81 @@
+"""
+Benchmark calibrator_db.peak_stats against the per (baseband, JD, source)
+masking loop that caltable_plots.py used to use, on a synthetic calibrator
+table ``scale`` times larger than calibrator_data.txt (~2800 rows).
+
+    python benchmark_peak_stats.py [scale]
+"""
+import sys
+import time
+import numpy as np
+from astropy.table import Table
+
+from calibrator_db import peak_stats, q_basebands
+
+
+def loop_peak_stats(tbl, basebands=q_basebands):
+    """
+    The original implementation, kept for comparison.
+    """
+    fluxes = {}
+    sources = np.unique(tbl['FieldID'])
+    for bpname,frqrange in basebands:
+        frqmask = (tbl['freq']/1e3 > frqrange[0]) & (tbl['freq']/1e3 < frqrange[1])
+        for jd in np.unique(tbl['JD']):
+            datemask = tbl['JD'] == jd
+            for source in sources:
+                sourcemask = tbl['FieldID'] == source
+                contmask = tbl['bw'] == 128e3
+                mask = sourcemask & contmask & frqmask & datemask
+                subtbl = tbl[mask]
+                if any(mask):
+                    flux = np.mean(subtbl['peak'])
+                    rms = np.std(subtbl['peak'])
+                    fluxes[(source, jd, bpname)] = (flux,rms)
+    return fluxes
+
+
+def synthetic_table(nrows, seed=0):
+    """
+    A Q-band-like calibrator table: three calibrators observed on many JDs,
+    each with ~56 spws, most of them 128 MHz continuum windows.
+    """
+    rng = np.random.RandomState(seed)
+    sources = np.array(['"1331+305=3C286"', 'J1733-1304', 'J1744-3116'])
+    nspw = 56
+    njd = max(1, nrows // (nspw * len(sources)))
+
+    jd = np.repeat(58177 + np.arange(njd)*0.03, nspw*len(sources))
+    field = np.tile(np.repeat(sources, nspw), njd)
+    spw = np.tile(np.arange(nspw), njd*len(sources))
+    freq = 42000 + spw * 8000./nspw + rng.uniform(-1, 1, spw.size)
+    bw = np.where(spw % 8 == 3, 16e3, 128e3)
+    peak = np.tile(np.repeat([1.9, 1.2, 0.13], nspw), njd) * rng.normal(1, 0.02, spw.size)
+    rms = np.abs(peak) * 1e-3
+
+    return Table([jd, np.full(spw.size, 'Q'), field, spw, freq, bw, peak, rms],
+                 names=['JD', 'BandName', 'FieldID', 'spw', 'freq', 'bw',
+                        'peak', 'rms'])
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tbl = synthetic_table(2843*scale)
+    print("Synthetic table: {0} rows, {1} JDs".format(len(tbl), len(np.unique(tbl['JD']))))
+
+    t0 = time.time()
+    stats = peak_stats(tbl)
+    t_fast = time.time() - t0
+    print("peak_stats:      {0:10.3f} s".format(t_fast))
+
+    t0 = time.time()
+    fluxes = loop_peak_stats(tbl)
+    t_loop = time.time() - t0
+    print("loop_peak_stats: {0:10.3f} s".format(t_loop))
+    print("speedup:         {0:10.1f}x".format(t_loop / t_fast))
+
+    assert len(fluxes) == len(stats)
+    for row in stats:
+        flux, rms = fluxes[(row['FieldID'], row['JD'], row['baseband'])]
+        assert np.allclose([flux, rms], [row['flux'], row['rms']])
+    print("Results agree")
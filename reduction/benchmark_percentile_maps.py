@@ -0,0 +1,61 @@
+"""
+Benchmark cube_collapse.percentile_maps against the ray-iterating
+``SpectralCube.percentile`` that quicklooks.py used to use, on a synthetic
+(nchan, size, size) cube with some blanked pixels and masked channels.
+
+    python benchmark_percentile_maps.py [size] [nchan]
+"""
+import sys
+import time
+import numpy as np
+from astropy import units as u
+from astropy import wcs
+from spectral_cube import SpectralCube
+
+from cube_collapse import percentile_maps
+
+
+def synthetic_cube(size, nchan, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.normal(0, 0.01, (nchan, size, size)).astype('float32')
+    # a line in the middle of the band and a blanked corner (blanked channels
+    # are left to the mask: the ray path gives NaN for any spectrum with a
+    # NaN in it)
+    data[nchan//2-5:nchan//2+5, size//4:size//2, size//4:size//2] += 1
+    data[:, :size//10, :size//10] = np.nan
+
+    ww = wcs.WCS(naxis=3)
+    ww.wcs.ctype = ['RA---SIN', 'DEC--SIN', 'FREQ']
+    ww.wcs.cunit = ['deg', 'deg', 'Hz']
+    ww.wcs.cdelt = [-1e-5, 1e-5, 1e5]
+    ww.wcs.crval = [266.8, -28.4, 23.69e9]
+    ww.wcs.crpix = [size/2., size/2., 1]
+
+    return SpectralCube(data=data*u.Jy/u.beam, wcs=ww)
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    nchan = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    pcts = (25,50,75)
+
+    cube = synthetic_cube(size, nchan)
+    include = np.ones(nchan, dtype='bool')
+    include[::17] = False
+    mcube = cube.with_mask(include[:,None,None])
+    print("Synthetic cube: {0}".format(cube.shape))
+
+    t0 = time.time()
+    pctmaps = percentile_maps(mcube, pcts, include)
+    t_fast = time.time() - t0
+    print("percentile_maps:     {0:10.3f} s".format(t_fast))
+
+    t0 = time.time()
+    raymaps = [mcube.percentile(pct, axis=0, iterate_rays=True) for pct in pcts]
+    t_ray = time.time() - t0
+    print("iterate_rays:        {0:10.3f} s".format(t_ray))
+    print("speedup:             {0:10.1f}x".format(t_ray / t_fast))
+
+    for pctmap, raymap in zip(pctmaps, raymaps):
+        assert np.allclose(pctmap, np.asarray(raymap), equal_nan=True)
+    print("Results agree")
@@ -0,0 +1,295 @@
+"""
+Incremental SQLite store of the calibrator peak / rms measurements harvested
+from the pipeline stage 20 logs by compile_cal_data.py.
+
+Each log is recorded with its size, mtime and a content hash, so only new or
+changed EBs need to be parsed again.  `load` opens the store for reading,
+importing the shipped IPAC export (calibrator_data.txt) if the store is
+empty.  `query` selects rows by JD, band, field and baseband without loading
+the whole table, `peak_stats` reduces a
+selection to per (field, JD, baseband) averages, and `coverage` gives the
+(cached) frequency coverage of each band.
+"""
+import os
+import hashlib
+import sqlite3
+import numpy as np
+from astropy.table import Table
+
+default_dbname = 'calibrator_data.sqlite'
+default_ipacname = 'calibrator_data.txt'
+
+columns = (('JD', 'REAL'), ('BandName', 'TEXT'), ('FieldID', 'TEXT'),
+           ('spw', 'INTEGER'), ('freq', 'REAL'), ('bw', 'REAL'),
+           ('peak', 'REAL'), ('rms', 'REAL'), ('msname', 'TEXT'),
+           ('baseband', 'TEXT'))
+colnames = [name for name, dtype in columns]
+
+# Q-band basebands by frequency range (GHz)
+q_basebands = (('B1D1', (42,43.8)),
+               ('B2D2', (43.8, 45.8)),
+               ('A1C1', (46,47.75)),
+               ('A2C2', (47.75, 50)))
+
+
+def connect(dbname=default_dbname):
+    db = sqlite3.connect(dbname)
+    db.execute("CREATE TABLE IF NOT EXISTS logs (logfn TEXT PRIMARY KEY, "
+               "msname TEXT, size INTEGER, mtime REAL, hash TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS caldata ({0})"
+               .format(", ".join("{0} {1}".format(name, dtype)
+                                 for name, dtype in columns)))
+    db.execute("CREATE INDEX IF NOT EXISTS caldata_select ON caldata "
+               "(BandName, FieldID, JD, baseband)")
+    db.execute("CREATE INDEX IF NOT EXISTS caldata_msname ON caldata (msname)")
+    db.commit()
+    return db
+
+
+def file_hash(fn, blocksize=2**22):
+    hsh = hashlib.sha1()
+    with open(fn, 'rb') as fh:
+        block = fh.read(blocksize)
+        while block:
+            hsh.update(block)
+            block = fh.read(blocksize)
+    return hsh.hexdigest()
+
+
+def stale_logs(db, logfns):
+    """
+    Return the subset of ``logfns`` that are not yet in the database or whose
+    contents have changed, as a dict of logfn -> content hash (to be handed
+    to `store`).  Files with an unchanged size and mtime are trusted without
+    hashing them.
+    """
+    stale = {}
+    for logfn in logfns:
+        stat = os.stat(logfn)
+        known = db.execute("SELECT size, mtime, hash FROM logs WHERE logfn=?",
+                           (logfn,)).fetchone()
+        if known is not None and (known[0], known[1]) == (stat.st_size, stat.st_mtime):
+            continue
+        loghash = file_hash(logfn)
+        if known is None or loghash != known[2]:
+            stale[logfn] = loghash
+        else:
+            # touched but not changed
+            db.execute("UPDATE logs SET size=?, mtime=? WHERE logfn=?",
+                       (stat.st_size, stat.st_mtime, logfn))
+    db.commit()
+    return stale
+
+
+def store(db, logfn, msname, rows, loghash=None):
+    """
+    Replace the rows of ``msname`` with ``rows`` (sequences ordered as
+    `colnames`) and record the current state of ``logfn``, whose content hash
+    is ``loghash`` (computed if not given).
+    """
+    stat = os.stat(logfn)
+    if loghash is None:
+        loghash = file_hash(logfn)
+    with db:
+        db.execute("DELETE FROM caldata WHERE msname=?", (msname,))
+        db.executemany("INSERT INTO caldata VALUES ({0})"
+                       .format(",".join("?"*len(columns))),
+                       [tuple(row) for row in rows])
+        db.execute("INSERT OR REPLACE INTO logs VALUES (?,?,?,?,?)",
+                   (logfn, msname, stat.st_size, stat.st_mtime, loghash))
+
+
+def q_baseband(freq):
+    """ The Q-band baseband of a frequency in MHz, or None """
+    for name, (fmin, fmax) in q_basebands:
+        if fmin < freq/1e3 < fmax:
+            return name
+    return None
+
+
+def import_ipac(db, ipacfn=default_ipacname):
+    """
+    Load the IPAC export written by compile_cal_data.py into ``db``, replacing
+    the rows of the MSes it lists.  The export has no baseband column, so Q
+    band basebands are assigned by frequency.  Returns the number of rows.
+    """
+    tbl = Table.read(ipacfn, format='ascii.ipac')
+    rows = [[row[name] for name in colnames[:-1]]
+            + [q_baseband(row['freq']) if row['BandName'] == 'Q' else None]
+            for row in tbl]
+    rows = [tuple(value.item() if hasattr(value, 'item') else value
+                  for value in row)
+            for row in rows]
+    stat = os.stat(ipacfn)
+    with db:
+        db.executemany("DELETE FROM caldata WHERE msname=?",
+                       [(msname,) for msname in set(tbl['msname'])])
+        db.executemany("INSERT INTO caldata VALUES ({0})"
+                       .format(",".join("?"*len(columns))), rows)
+        # recorded like a log, so that `state` changes if it is re-imported
+        db.execute("INSERT OR REPLACE INTO logs VALUES (?,?,?,?,?)",
+                   (ipacfn, '', stat.st_size, stat.st_mtime,
+                    file_hash(ipacfn)))
+    return len(rows)
+
+
+def load(dbname=default_dbname, ipacfn=default_ipacname):
+    """
+    Open the store for reading.  If it has no measurements (compile_cal_data.py
+    has not been run here), ``ipacfn`` is imported into it; if there is no
+    data at all, raise an IOError rather than create an empty store.
+    """
+    if not os.path.exists(dbname) and not os.path.exists(ipacfn):
+        raise IOError("Neither {0} nor {1} exists; run compile_cal_data.py"
+                      .format(dbname, ipacfn))
+    db = connect(dbname)
+    if db.execute("SELECT COUNT(*) FROM caldata").fetchone()[0] == 0:
+        if not os.path.exists(ipacfn):
+            raise IOError("{0} has no calibrator data and {1} does not exist;"
+                          " run compile_cal_data.py".format(dbname, ipacfn))
+        nrows = import_ipac(db, ipacfn)
+        print("Imported {0} rows from {1} into {2}".format(nrows, ipacfn, dbname))
+        if nrows == 0:
+            raise IOError("{0} has no calibrator data".format(ipacfn))
+    return db
+
+
+def query(db, jd=None, band=None, field=None, baseband=None, bw=None,
+          names=colnames):
+    """
+    Select calibrator measurements.  Each selection may be a single value or a
+    list of values; ``None`` selects everything.  Returns an astropy Table.
+    """
+    where = []
+    args = []
+    for name, value in (('JD', jd), ('BandName', band), ('FieldID', field),
+                        ('baseband', baseband), ('bw', bw)):
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            where.append("{0} IN ({1})".format(name, ",".join("?"*len(value))))
+            args += list(value)
+        else:
+            where.append("{0}=?".format(name))
+            args.append(value)
+
+    sql = "SELECT {0} FROM caldata".format(", ".join(names))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+
+    rows = db.execute(sql, args).fetchall()
+    if rows:
+        return Table(rows=rows, names=names)
+    return Table(names=names)
+
+
+def distinct(db, column):
+    """
+    The sorted unique values of ``column``
+    """
+    return [row[0] for row in
+            db.execute("SELECT DISTINCT {0} FROM caldata ORDER BY {0}"
+                       .format(column)).fetchall()]
+
+
+def state(db):
+    """
+    A digest of all of the harvested logs; it changes whenever any EB is added
+    or re-harvested.
+    """
+    hsh = hashlib.sha1()
+    for logfn, loghash in db.execute("SELECT logfn, hash FROM logs ORDER BY logfn"):
+        hsh.update("{0}:{1}\n".format(logfn, loghash).encode())
+    return hsh.hexdigest()
+
+
+def coverage(db, band, height=0.75, cachefn=None):
+    """
+    The frequency coverage of ``band`` as rectangles: returns the unique
+    (freq [MHz], bw [MHz], JD) of every observed spw and an (N, 4, 2) array of
+    rectangle vertices (freq-bw/2 .. freq+bw/2, JD .. JD+height) that can be
+    handed directly to a ``PolyCollection``.
+
+    The arrays are cached in ``cachefn`` (default
+    ``coverage_<band>.npz``) and rebuilt only if the database `state` changes.
+    """
+    if cachefn is None:
+        cachefn = 'coverage_{0}.npz'.format(band)
+    key = np.array([state(db), str(height)])
+
+    if os.path.exists(cachefn):
+        try:
+            with np.load(cachefn) as cache:
+                if np.all(cache['key'] == key):
+                    return cache['freq'], cache['bw'], cache['jd'], cache['verts']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    rows = db.execute("SELECT DISTINCT freq, bw, JD FROM caldata "
+                      "WHERE BandName=? ORDER BY JD, freq", (band,)).fetchall()
+    if not rows:
+        # nothing observed in this band: nothing worth caching
+        empty = np.zeros(0)
+        return empty, empty, empty, np.zeros((0, 4, 2))
+    freq, bw, jd = np.array(rows, dtype='float').reshape(-1, 3).T
+    bw = bw / 1e3
+
+    left, right = freq - bw/2, freq + bw/2
+    bottom, top = jd, jd + height
+    verts = np.stack([np.stack([left, bottom], axis=-1),
+                      np.stack([right, bottom], axis=-1),
+                      np.stack([right, top], axis=-1),
+                      np.stack([left, top], axis=-1)], axis=1)
+
+    try:
+        with open(cachefn, 'wb') as fh:
+            np.savez(fh, key=key, freq=freq, bw=bw, jd=jd, verts=verts)
+    except (IOError, OSError) as ex:
+        print("Could not write coverage cache {0}: {1}".format(cachefn, ex))
+
+    return freq, bw, jd, verts
+
+
+def peak_stats(tbl, basebands=q_basebands, bw=128e3):
+    """
+    Mean and standard deviation of the peak flux of the ``bw``-wide spws for
+    each (FieldID, JD, baseband) group in one pass: rows are labeled with an
+    integer group key, sorted once, and reduced with ``np.add.reduceat``.
+
+    ``basebands`` is a sequence of (name, (fmin, fmax)) with frequencies in
+    GHz.  Returns a Table with columns FieldID, JD, baseband, flux, rms, n,
+    sorted by field, JD and baseband.
+    """
+    freq = np.asarray(tbl['freq'])/1e3
+    bbidx = np.full(len(freq), -1, dtype='int')
+    for ii, (name, (fmin, fmax)) in enumerate(basebands):
+        bbidx[(freq > fmin) & (freq < fmax)] = ii
+
+    keep = (bbidx >= 0) & (np.asarray(tbl['bw']) == bw)
+    sources, srcidx = np.unique(np.asarray(tbl['FieldID'])[keep],
+                                return_inverse=True)
+    jds, jdidx = np.unique(np.asarray(tbl['JD'])[keep], return_inverse=True)
+    bbidx = bbidx[keep]
+    peak = np.asarray(tbl['peak'], dtype='float')[keep]
+
+    key = (srcidx * len(jds) + jdidx) * len(basebands) + bbidx
+    order = np.argsort(key, kind='mergesort')
+    key = key[order]
+    peak = peak[order]
+
+    if len(key) == 0:
+        return Table(names=['FieldID', 'JD', 'baseband', 'flux', 'rms', 'n'])
+
+    starts = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+    counts = np.diff(np.concatenate([starts, [len(key)]]))
+    mean = np.add.reduceat(peak, starts) / counts
+    dev = peak - np.repeat(mean, counts)
+    std = np.sqrt(np.add.reduceat(dev**2, starts) / counts)
+
+    groups = key[starts]
+    bbnames = np.array([name for name, frqrange in basebands])
+    return Table([sources[groups // len(basebands) // len(jds)],
+                  jds[groups // len(basebands) % len(jds)],
+                  bbnames[groups % len(basebands)],
+                  mean, std, counts],
+                 names=['FieldID', 'JD', 'baseband', 'flux', 'rms', 'n'])
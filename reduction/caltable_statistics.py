@@ -0,0 +1,150 @@
+"""
+Summarize amplitude (gain) calibration tables: the gain amplitude and SNR of
+the solved, unflagged solutions of each table, overall and per antenna, spw
+and solution time.
+
+CPARAM, FLAG and SNR are read together in blocks of rows; solutions that are
+flagged or were never solved (CPARAM == 1) are dropped, and each grouping is
+reduced in one vectorized pass (sort by group, then ``np.add.reduceat``).
+Tables are summarized in parallel (set NPROCS to limit the number of
+workers) and the results of all of them are collected in one Table.
+
+    python caltable_statistics.py ['*amp*cal'] [caltable_statistics.txt]
+"""
+import os
+import sys
+import glob
+import multiprocessing
+import numpy as np
+from astropy.table import Table
+from taskinit import tbtool
+
+colnames = ['caltable', 'group', 'key', 'nsol', 'nflag', 'nunsolved',
+            'mean', 'median', 'std', 'snr_median']
+
+
+def read_caltable(caltable, max_bytes=256*1024**2):
+    """
+    Read the solutions of ``caltable`` in blocks.  Returns the amplitude and
+    SNR of the good (unflagged, solved) solutions, their antenna, spw and
+    solution time index, and the numbers of flagged and unsolved solutions.
+    """
+    tb = tbtool()
+    tb.open(caltable)
+    try:
+        nrows = tb.nrows()
+        if nrows == 0:
+            return None
+        # complex64 CPARAM + float32 SNR + bool FLAG per solution
+        rowbytes = np.prod(tb.getcell('FLAG', 0).shape) * 13
+        chunk = int(max(1, max_bytes // rowbytes))
+
+        parts = []
+        nflag = nunsolved = 0
+        for start in range(0, nrows, chunk):
+            nrow = min(chunk, nrows - start)
+            cparam = tb.getcol('CPARAM', start, nrow)
+            flag = tb.getcol('FLAG', start, nrow)
+            snr = tb.getcol('SNR', start, nrow)
+            rowcols = [tb.getcol(col, start, nrow) for col in
+                       ('ANTENNA1', 'SPECTRAL_WINDOW_ID', 'TIME')]
+
+            unsolved = cparam == 1
+            good = ~flag & ~unsolved
+            nflag += flag.sum()
+            nunsolved += (unsolved & ~flag).sum()
+
+            # per-row quantities broadcast to the (npol, nchan, nrow) shape
+            keys = [np.broadcast_to(col, cparam.shape)[good] for col in rowcols]
+            parts.append([np.abs(cparam[good]), snr[good]] + keys)
+    finally:
+        tb.close()
+
+    amp, snr, antenna, spw, time = [np.concatenate(col) for col in zip(*parts)]
+    # solution intervals, numbered in time order
+    times, timeidx = np.unique(time, return_inverse=True)
+
+    return {'amp': amp, 'snr': snr, 'antenna': antenna, 'spw': spw,
+            'time': timeidx, 'nflag': int(nflag), 'nunsolved': int(nunsolved)}
+
+
+def group_stats(keys, amp, snr):
+    """
+    Count, mean, median and standard deviation of ``amp`` and the median of
+    ``snr`` for each unique value of ``keys``: sorting by key (and value)
+    makes each group contiguous, so the medians are the middle elements.
+    Returns the unique keys and the five arrays.
+    """
+    sorted_keys = np.sort(keys)
+    amp = amp[np.lexsort((amp, keys))]
+    snr = snr[np.lexsort((snr, keys))]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+    counts = np.diff(np.concatenate([starts, [len(keys)]]))
+
+    mean = np.add.reduceat(amp, starts) / counts
+    dev = amp - np.repeat(mean, counts)
+    std = np.sqrt(np.add.reduceat(dev**2, starts) / counts)
+    median = (amp[starts + (counts-1)//2] + amp[starts + counts//2]) / 2.
+    snr_median = (snr[starts + (counts-1)//2] + snr[starts + counts//2]) / 2.
+
+    return sorted_keys[starts], counts, mean, median, std, snr_median
+
+
+def summarize(caltable):
+    """
+    The summary rows (ordered as `colnames`) of one caltable: one 'all' row
+    and one row per antenna, spw and solution time.  Flagged / unsolved
+    counts are only given for the 'all' row.
+    """
+    data = read_caltable(caltable)
+    if data is None or len(data['amp']) == 0:
+        return []
+
+    rows = []
+    allkeys = np.zeros(len(data['amp']), dtype='int')
+    for group in ('all', 'antenna', 'spw', 'time'):
+        keys = allkeys if group == 'all' else data[group]
+        stats = group_stats(keys, data['amp'], data['snr'])
+        for key, nsol, mean, median, std, snr_median in zip(*stats):
+            rows.append([caltable, group, int(key), int(nsol),
+                         data['nflag'] if group == 'all' else -1,
+                         data['nunsolved'] if group == 'all' else -1,
+                         mean, median, std, snr_median])
+    return rows
+
+
+def caltable_statistics(caltables, nprocs=None):
+    """
+    Summarize every caltable in ``caltables`` in parallel and return all of
+    the rows as one Table
+    """
+    if nprocs is None:
+        nprocs = int(os.getenv('NPROCS', multiprocessing.cpu_count()))
+
+    if nprocs > 1 and len(caltables) > 1:
+        pool = multiprocessing.Pool(processes=min(nprocs, len(caltables)))
+        try:
+            results = pool.map(summarize, caltables, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [summarize(caltable) for caltable in caltables]
+
+    rows = [row for result in results for row in result]
+    if rows:
+        return Table(rows=rows, names=colnames)
+    return Table(names=colnames)
+
+
+if __name__ == "__main__":
+    pattern = sys.argv[1] if len(sys.argv) > 1 else "*amp*cal"
+    outfn = sys.argv[2] if len(sys.argv) > 2 else "caltable_statistics.txt"
+
+    stats = caltable_statistics(sorted(glob.glob(pattern)))
+    stats.write(outfn, format='ascii.ipac', overwrite=True)
+
+    for row in stats[stats['group'] == 'all']:
+        print("{caltable}: mean={mean:0.4g} median={median:0.4g} "
+              "snr={snr_median:0.3g} flagged={nflag} unsolved={nunsolved}"
+              .format(**{name: row[name] for name in colnames}))
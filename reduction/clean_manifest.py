@@ -0,0 +1,288 @@
+"""
+Job manifests for the ``myclean`` functions (continuum_imaging_general.py and
+maserline_imaging.py), so that an image is redone exactly when its inputs
+have changed.
+
+Each image gets a manifest, clean_manifests/<imagename>.json next to it,
+recording a hash of every tclean parameter and the modification stamps (mtime
+and size) of its inputs: the data files of each MS (every storage manager file
+except those holding only MODEL_DATA, so re-flagging or applying a new
+caltable changes the stamp, but predicting a model does not) and any other
+parameter naming an existing file or image (masks, start models, ...).  An
+image is current if its FITS marker exists, its manifest is finished and both
+the hash and the stamps match.
+
+The manifest is written, unfinished, before tclean starts; an unfinished or
+out-of-date image has its leftover CASA images removed before it is redone,
+so tclean never continues from a stale model.  Images made before manifests
+existed (a marker but no manifest) are adopted as current only if their
+marker is newer than every one of their inputs.
+
+Predicted models are tracked the same way: <ms>.model_predict.json records
+which model (a hash of the model image and the predict parameters) was last
+predicted into the MODEL_DATA rows of each field, and the stamp the model
+column had afterwards, so an unchanged model is not predicted again.
+"""
+import os
+import glob
+import json
+import shutil
+import hashlib
+import datetime
+
+from taskinit import tbtool, iatool
+
+manifest_version = 1
+
+# parameters read back from a JSON job file are unicode under python 2
+string_types = (str, type(u''))
+
+# MS path -> (table.dat stamp, storage manager columns and files)
+ms_files_cache = {}
+
+
+def manifest_name(imagename):
+    return os.path.join(os.path.dirname(imagename), 'clean_manifests',
+                        os.path.basename(imagename)+'.json')
+
+
+def load_manifest(imagename):
+    try:
+        with open(manifest_name(imagename), 'r') as fh:
+            manifest = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('version') != manifest_version:
+        return None
+    return manifest
+
+
+def write_manifest(imagename, manifest):
+    fn = manifest_name(imagename)
+    if not os.path.exists(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    # write-then-rename, so a crash never leaves a truncated manifest
+    with open(fn+'.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.rename(fn+'.tmp', fn)
+
+
+def file_stamp(fn):
+    stat = os.stat(fn)
+    return [stat.st_mtime, stat.st_size]
+
+
+def path_stamp(path):
+    """ The stamp of a file, or of the files of a table / image directory """
+    if not os.path.isdir(path):
+        return file_stamp(path)
+    stamps = [file_stamp(os.path.join(path, fn)) for fn in os.listdir(path)
+              if os.path.isfile(os.path.join(path, fn))]
+    return [max([stamp[0] for stamp in stamps] + [0]),
+            sum(stamp[1] for stamp in stamps)]
+
+
+def ms_storage_managers(vis):
+    """
+    The columns and files of each storage manager of ``vis``'s main table
+    """
+    key = file_stamp(os.path.join(vis, 'table.dat'))
+    if vis in ms_files_cache and ms_files_cache[vis][0] == key:
+        return ms_files_cache[vis][1]
+
+    tb = tbtool()
+    tb.open(vis)
+    try:
+        dminfo = tb.getdminfo()
+    finally:
+        tb.close()
+
+    managers = []
+    for dm in dminfo.values():
+        prefix = os.path.join(vis, 'table.f{0}'.format(dm['SEQNR']))
+        files = [fn for fn in glob.glob(prefix+'*')
+                 if fn == prefix or fn.startswith(prefix+'_')]
+        managers.append((list(dm['COLUMNS']), sorted(files)))
+
+    ms_files_cache[vis] = (key, managers)
+    return managers
+
+
+def ms_data_files(vis):
+    """
+    The files of the storage managers of ``vis``'s main table, except those
+    holding only MODEL_DATA
+    """
+    return sorted(fn for columns, files in ms_storage_managers(vis)
+                  if not set(columns) <= set(['MODEL_DATA'])
+                  for fn in files)
+
+
+def model_stamp(vis):
+    """ The stamps of the files holding ``vis``'s MODEL_DATA column """
+    stamps = {os.path.basename(fn): file_stamp(fn)
+              for columns, files in ms_storage_managers(vis)
+              if 'MODEL_DATA' in columns
+              for fn in files}
+    return json.loads(json.dumps(stamps))
+
+
+def input_stamps(params):
+    """
+    The stamps of the MSes (``vis``) and of every other existing path among
+    the (string or list of string) values of ``params``
+    """
+    stamps = {}
+    for key, value in params.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for value in values:
+            if not isinstance(value, string_types) or not value or not os.path.exists(value):
+                continue
+            if key == 'vis':
+                stamps[value] = {os.path.basename(fn): file_stamp(fn)
+                                 for fn in ms_data_files(value)}
+            elif key != 'imagename':
+                stamps[value] = path_stamp(value)
+    # as they will read back from the manifest
+    return json.loads(json.dumps(stamps))
+
+
+def newest_input(stamps):
+    """ The latest modification time among ``stamps`` (see `input_stamps`) """
+    mtimes = [0]
+    for stamp in stamps.values():
+        if isinstance(stamp, dict):
+            mtimes += [file_stamp[0] for file_stamp in stamp.values()]
+        else:
+            mtimes.append(stamp[0])
+    return max(mtimes)
+
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str)
+                        .encode('utf-8')).hexdigest()
+
+
+def is_current(imagename, params, marker):
+    """
+    Whether the image ``imagename`` made by tclean with ``params`` is up to
+    date, and why (a string)
+    """
+    if not os.path.exists(marker):
+        return False, "{0} does not exist".format(marker)
+
+    manifest = load_manifest(imagename)
+    if manifest is None:
+        # made before manifests existed: only trusted if nothing it was made
+        # from has changed since
+        if newest_input(input_stamps(params)) >= os.path.getmtime(marker):
+            return False, "inputs newer than the existing image"
+        finish(imagename, params, [marker], adopted=True)
+        return True, "adopted the existing image"
+    if manifest.get('finished') is None:
+        return False, "the previous clean did not finish"
+    if manifest['params_hash'] != params_hash(params):
+        return False, "the tclean parameters changed"
+
+    stamps = input_stamps(params)
+    changed = sorted(path for path in set(stamps) | set(manifest['inputs'])
+                     if stamps.get(path) != manifest['inputs'].get(path))
+    if changed:
+        return False, "inputs changed: {0}".format(", ".join(changed))
+    return True, "up to date"
+
+
+def remove_products(imagename):
+    """ Remove the CASA images (directories) of ``imagename`` """
+    for path in glob.glob(imagename+'.*'):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+def start(imagename, params):
+    """
+    Clear any leftovers of a previous clean of ``imagename`` and record that a
+    clean with ``params`` has started
+    """
+    remove_products(imagename)
+    write_manifest(imagename, {'version': manifest_version,
+                               'params_hash': params_hash(params),
+                               'params': json.loads(json.dumps(params, default=str)),
+                               'inputs': {}, 'products': [],
+                               'started': datetime.datetime.now().isoformat(),
+                               'finished': None})
+
+
+def finish(imagename, params, products, adopted=False):
+    """
+    Record that the clean of ``imagename`` finished, with the stamps its inputs
+    have now (after any model was written to the MSes)
+    """
+    manifest = load_manifest(imagename) or {'started': None}
+    manifest.update({'version': manifest_version,
+                     'params_hash': params_hash(params),
+                     'params': json.loads(json.dumps(params, default=str)),
+                     'inputs': input_stamps(params),
+                     'products': products,
+                     'finished': datetime.datetime.now().isoformat(),
+                     'adopted': adopted})
+    write_manifest(imagename, manifest)
+
+
+def image_hash(imagename):
+    """ A hash of the pixels and coordinates of a CASA image """
+    ia = iatool()
+    ia.open(imagename)
+    try:
+        data = ia.getchunk()
+        csys = ia.coordsys()
+        coords = csys.torecord()
+        csys.done()
+    finally:
+        ia.close()
+        ia.done()
+    sha = hashlib.sha1(data.tobytes())
+    sha.update(json.dumps([list(data.shape), coords], sort_keys=True,
+                          default=str).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def predict_record_name(vis):
+    return vis.rstrip('/') + '.model_predict.json'
+
+
+def predicted_models(vislist):
+    """
+    The model predicted into the MODEL_DATA rows of each field of the MSes in
+    ``vislist``, as a dict of field -> key (see `record_predict`).  It is
+    empty unless every MS's model column is exactly as the last recorded
+    predict left it.
+    """
+    predicted = None
+    for vis in vislist:
+        try:
+            with open(predict_record_name(vis), 'r') as fh:
+                record = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+        if record.get('model_stamp') != model_stamp(vis):
+            return {}
+        if predicted is None:
+            predicted = record['fields']
+        elif predicted != record['fields']:
+            return {}
+    return predicted or {}
+
+
+def record_predict(vislist, fields):
+    """
+    Record that the MODEL_DATA rows of each field (key) of the MSes in
+    ``vislist`` now hold the model identified by its value
+    """
+    for vis in vislist:
+        fn = predict_record_name(vis)
+        with open(fn+'.tmp', 'w') as fh:
+            json.dump({'fields': fields, 'model_stamp': model_stamp(vis),
+                       'time': datetime.datetime.now().isoformat()},
+                      fh, indent=1, sort_keys=True)
+        os.rename(fn+'.tmp', fn)
@@ -1,6 +1,21 @@
+"""
+Collect the calibrator peak / rms measurements from the pipeline's stage 20
+(calibrator imaging) logs into calibrator_data.txt.
+
+The listobs / log pairs are found in one walk over the tree, then each new or
+changed log (see calibrator_db.py) is parsed in a worker process.  Set NPROCS
+to limit the number of workers.
+"""
 import os
+import time
+import mmap
+import multiprocessing
 from listobs_parser import get_spws
-from astropy.table import Table
+from calibrator_db import connect, stale_logs, store, query, colnames
+
+# logs bigger than this are scanned with mmap rather than line by line
+mmap_threshold = 16*1024**2
+
 
 def get_cal_data(fn):
     data = {}
@@ -21,35 +36,131 @@ def get_cal_data(fn):
     return data
 
 
-all_data = {}
+def get_cal_data_mmap(fn):
+    """
+    Same as `get_cal_data`, but jumps between the "Clean image iter" markers
+    of a memory-mapped log instead of testing every line.  The max and rms
+    recorded for each target are the last ones logged before its "Cleaning for
+    intent" line, as in `get_cal_data`.
+    """
+    def line_at(mm, pos):
+        start = mm.rfind(b'\n', 0, pos) + 1
+        end = mm.find(b'\n', pos)
+        if end < 0:
+            end = len(mm)
+        return mm[start:end].decode()
+
+    data = {}
+    with open(fn, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = mm.find(b'Clean image iter')
+            while pos >= 0:
+                target = mm.find(b'Cleaning for intent', pos)
+                if target < 0:
+                    break
+                mxpos = mm.rfind(b'Clean image max', 0, target)
+                rmspos = mm.rfind(b'Clean image annulus area rms', 0, target)
+                if mxpos >= 0 and rmspos >= 0:
+                    mx = float(line_at(mm, mxpos).split()[-1])
+                    rms = float(line_at(mm, rmspos).split()[-1])
+                    row = line_at(mm, target)
+                    spw = int(row.split()[-1])
+                    field = row.split("field")[-1].split(",")[0].strip()
+                    data[(field,spw)] = (mx, rms)
+                pos = mm.find(b'Clean image iter', mm.find(b'\n', target))
+        finally:
+            mm.close()
+    return data
+
+
+def find_log_pairs(root='.'):
+    """
+    Walk the tree once and pair each stage 20 casapy.log with the listobs.txt
+    that shares the longest directory prefix with it (i.e., the one from the
+    same pipeline weblog).
+    """
+    listobsfiles = []
+    logs = []
+    for directory, dirnames, filenames in os.walk(root):
+        if 'listobs.txt' in filenames:
+            listobsfiles.append(os.path.join(directory, 'listobs.txt'))
+        if 'stage20' in directory and 'casapy.log' in filenames:
+            logs.append(os.path.join(directory, 'casapy.log'))
+
+    pairs = []
+    for logfn in sorted(logs):
+        if not listobsfiles:
+            print("No listobs found for {0}".format(logfn))
+            continue
+        listfn = max(listobsfiles,
+                     key=lambda fn: len(os.path.commonprefix([fn, logfn])))
+        pairs.append((listfn, logfn))
 
-for directory, dirnames, filenames in os.walk('.'):
-    for fn in filenames:
-        if 'listobs.txt' == fn:
-            listfn = os.path.join(directory, fn)
-            msname, spws, bws, band, bbs, fields_table = get_spws(listfn)
-            if '/' in msname:
-                msname = os.path.split(msname)[-1]
-                #print('--',directory, msname, band)
-    if 'stage20' in directory and 'casapy.log' in filenames:
-        stage20path = os.path.join(directory, 'casapy.log')
-        data = get_cal_data(stage20path)
+    return pairs
 
-        all_data[msname] = data, spws, bws, band, bbs, fields_table
-        #print(directory, msname, band)
 
-titles = ['JD', 'BandName', 'FieldID', 'spw', 'freq', 'bw', 'peak', 'rms', 'msname']
-rows = []
+def harvest(pair):
+    """
+    Parse one listobs / stage 20 log pair; run in a worker process.
+    """
+    listfn, logfn = pair
+    t0 = time.time()
+    msname, spws, bws, band, bbs, fields = get_spws(listfn)
+    if '/' in msname:
+        msname = os.path.split(msname)[-1]
+    if os.path.getsize(logfn) > mmap_threshold:
+        data = get_cal_data_mmap(logfn)
+    else:
+        data = get_cal_data(logfn)
+    return msname, (data, spws, bws, band, bbs, fields), logfn, time.time()-t0
 
-for msname in all_data:
+
+def make_rows(msname, rslt):
+    """
+    Turn the harvested data for one MS into rows ordered as
+    `calibrator_db.colnames`.
+    """
+    data, spws, bws, band, bbs, fields = rslt
     jd = float('.'.join(msname.split('.')[3:5]))
 
-    for (field,spw),(mx,rms) in all_data[msname][0].items():
-        band = all_data[msname][3]
-        spws = all_data[msname][1]
-        bws = all_data[msname][2]
-        row = [jd, band, field, spw, spws[spw], bws[spw], mx, rms, msname]
+    rows = []
+    for (field,spw),(mx,rms) in data.items():
+        row = [jd, band, field, spw, spws[spw], bws[spw], mx, rms, msname,
+               bbs[spw]]
         rows.append(row)
 
-tbl = Table(rows=rows, names=titles)
-tbl.write('reduction_scripts/calibrator_data.txt', format='ascii.ipac', overwrite=True)
+    return rows
+
+
+if __name__ == "__main__":
+    nprocs = int(os.getenv('NPROCS', multiprocessing.cpu_count()))
+
+    t0 = time.time()
+    pairs = find_log_pairs('.')
+    print("Found {0} listobs/log pairs in {1:0.1f}s".format(len(pairs), time.time()-t0))
+
+    db = connect('reduction_scripts/calibrator_data.sqlite')
+    stale = stale_logs(db, [logfn for listfn, logfn in pairs])
+    pairs = [pair for pair in pairs if pair[1] in stale]
+    print("{0} logs are new or changed".format(len(pairs)))
+
+    results = []
+    if pairs:
+        pool = multiprocessing.Pool(processes=max(1, min(nprocs, len(pairs))))
+        try:
+            results = pool.map(harvest, pairs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    for msname, rslt, logfn, elapsed in results:
+        print("{0:8.2f}s {1:10.1f} MB {2}".format(elapsed, os.path.getsize(logfn)/1024.**2, logfn))
+        store(db, logfn, msname, make_rows(msname, rslt), stale[logfn])
+    print("Harvested {0} logs in {1:0.1f}s with {2} processes"
+          .format(len(results), time.time()-t0, nprocs))
+
+    # the IPAC table is kept as a plain-text export of the database
+    if results or not os.path.exists('reduction_scripts/calibrator_data.txt'):
+        tbl = query(db, names=colnames[:-1])
+        tbl.write('reduction_scripts/calibrator_data.txt', format='ascii.ipac', overwrite=True)
@@ -8,6 +8,8 @@ import shutil
 import os
 import glob
 import re
+import time
+import multiprocessing
 
 from immath_cli import immath_cli as immath
 from tclean_cli import tclean_cli as tclean
@@ -17,58 +19,129 @@ from gaincal_cli import gaincal_cli as gaincal
 from applycal_cli import applycal_cli as applycal
 from taskinit import casalog
 
+from image_export import export_products
+import clean_manifest
+import imaging_queue
+
 
 
 def makefits(myimagebase, cleanup=True):
+    """
+    Export the products of an mtmfs (``.tt0`` etc.) or mfs image to FITS,
+    including the primary-beam corrected image (also kept as a CASA image),
+    concurrently (see `image_export.export_products`), then remove the CASA
+    images except the tt0 model
+    """
     if os.path.exists(myimagebase+'.image.tt0'):
-        try:
-            impbcor(imagename=myimagebase+'.image.tt0', pbimage=myimagebase+'.pb.tt0', outfile=myimagebase+'.image.tt0.pbcor', overwrite=True) # perform PBcorr
-            exportfits(imagename=myimagebase+'.image.tt0.pbcor', fitsimage=myimagebase+'.image.tt0.pbcor.fits', dropdeg=False, overwrite=True) # export the corrected image
-        except AttributeError as ex:
-            print(ex)
-        exportfits(imagename=myimagebase+'.image.tt1', fitsimage=myimagebase+'.image.tt1.fits', dropdeg=False, overwrite=True) # export the corrected image
-        exportfits(imagename=myimagebase+'.pb.tt0', fitsimage=myimagebase+'.pb.tt0.fits', dropdeg=False, overwrite=True) # export the PB image
-        exportfits(imagename=myimagebase+'.model.tt0', fitsimage=myimagebase+'.model.tt0.fits', dropdeg=False, overwrite=True) # export the PB image
-        exportfits(imagename=myimagebase+'.model.tt1', fitsimage=myimagebase+'.model.tt1.fits', dropdeg=False, overwrite=True) # export the PB image
-        exportfits(imagename=myimagebase+'.residual.tt0', fitsimage=myimagebase+'.residual.tt0.fits', dropdeg=False, overwrite=True) # export the PB image
-        exportfits(imagename=myimagebase+'.alpha', fitsimage=myimagebase+'.alpha.fits', dropdeg=False, overwrite=True)
-        exportfits(imagename=myimagebase+'.alpha.error', fitsimage=myimagebase+'.alpha.error.fits', dropdeg=False, overwrite=True)
-
+        remove = []
         if cleanup:
             for ttsuffix in ('.tt0', '.tt1', '.tt2'):
                 for suffix in ('pb{tt}', 'weight', 'sumwt{tt}', 'psf{tt}',
                                'model{tt}', 'mask', 'image{tt}', 'residual{tt}',
                                'alpha', 'alpha.error'):
+                    suffix = '.'+suffix.format(tt=ttsuffix)
                     # keep the model around
-                    if not suffix.format(tt=ttsuffix) == 'model.tt0':
-                        os.system('rm -rf {0}.{1}'.format(myimagebase, suffix).format(tt=ttsuffix))
+                    if suffix != '.model.tt0' and suffix not in remove:
+                        remove.append(suffix)
+        export_products(myimagebase,
+                        ('.image.tt1', '.pb.tt0', '.model.tt0', '.model.tt1',
+                         '.residual.tt0', '.alpha', '.alpha.error'),
+                        pbcor=('.image.tt0', '.pb.tt0'), pbcor_image=True,
+                        dropdeg=False, remove=remove)
     elif os.path.exists(myimagebase+'.image'):
-        try:
-            impbcor(imagename=myimagebase+'.image', pbimage=myimagebase+'.pb', outfile=myimagebase+'.image.pbcor', overwrite=True) # perform PBcorr
-            exportfits(imagename=myimagebase+'.image.pbcor', fitsimage=myimagebase+'.image.pbcor.fits', dropdeg=False, overwrite=True) # export the corrected image
-        except AttributeError as ex:
-            print(ex)
-        exportfits(imagename=myimagebase+'.pb', fitsimage=myimagebase+'.pb.fits', dropdeg=False, overwrite=True) # export the PB image
-        exportfits(imagename=myimagebase+'.model', fitsimage=myimagebase+'.model.fits', dropdeg=False, overwrite=True) # export the PB image
-        exportfits(imagename=myimagebase+'.residual', fitsimage=myimagebase+'.residual.fits', dropdeg=False, overwrite=True) # export the PB image
-
+        remove = []
         if cleanup:
-            ttsuffix=''
-            for suffix in ('pb{tt}', 'weight', 'sumwt{tt}', 'psf{tt}',
-                           'model{tt}', 'mask', 'image{tt}', 'residual{tt}',
-                           'alpha', 'alpha.error'):
-                os.system('rm -rf {0}.{1}'.format(myimagebase, suffix).format(tt=ttsuffix))
+            remove = ['.pb', '.weight', '.sumwt', '.psf', '.model', '.mask',
+                      '.image', '.residual', '.alpha', '.alpha.error']
+        export_products(myimagebase, ('.pb', '.model', '.residual'),
+                        pbcor=('.image', '.pb'), pbcor_image=True,
+                        dropdeg=False, remove=remove)
     else:
         raise IOError("No image file found matching {0}".format(myimagebase))
 
 
+# held (across the field workers of a parallel `myclean`) while a model is
+# written to the MSes, which the workers share
+ms_lock = None
+
+
+def _set_ms_lock(lock):
+    global ms_lock
+    ms_lock = lock
+
+
+def with_ms_lock(func, **kwargs):
+    if ms_lock is None:
+        return func(**kwargs)
+    with ms_lock:
+        return func(**kwargs)
+
+
+def mfs_memory_gb(imsize, nterms=2):
+    """
+    A rough estimate of the peak memory (GB) of an mtmfs clean: ~(4 nterms +
+    6) float planes (psf, residual, model, image, pb, weight, mask, ...) and
+    the complex gridding buffers (padded by 1.2), plus ~2 GB for casa itself
+    """
+    return 2 + imsize**2 * ((4*nterms + 6)*4 + 1.44*2*8) / 1024.**3
+
+
+def clean_field(job):
+    """
+    Clean and export one field of a `myclean` call.  If the job has a
+    ``logfile``, the casa log goes there.  Returns the wall time of each step.
+    """
+    if job.get('logfile'):
+        casalog.setlogfile(job['logfile'])
+    imagename, params = job['name'], job['params']
+
+    timings = {}
+    t0 = time.time()
+    current, reason = clean_manifest.is_current(imagename, params, job['marker'])
+    if not current:
+        casalog.post("Imaging {0}: {1}".format(imagename, reason),
+                     origin='myclean')
+        clean_manifest.start(imagename, params)
+        if params['savemodel'] == 'none':
+            rslt = tclean(**params)
+        else:
+            rslt = with_ms_lock(tclean, **params)
+        timings['tclean'] = time.time() - t0
+
+        t0 = time.time()
+        makefits(imagename, cleanup=job['cleanup'])
+        clean_manifest.finish(imagename, params, [job['marker']])
+        timings['makefits'] = time.time() - t0
+    else:
+        casalog.post("Skipping {0}".format(imagename), origin='myclean')
+
+    return timings
+
+
+continuum_fields = ["Sgr B2 N Q", "Sgr B2 NM Q", "Sgr B2 MS Q", "Sgr B2 S Q",
+                    "Sgr B2 DS1 Q", "Sgr B2 DS2 Q", "Sgr B2 DS3 Q",]
+
+
+def myclean_imagename(name, field, robust, threshold):
+    return ("{name}_{field}_r{robust}_allcont_clean1e4_{threshold}"
+            .format(name=name, field=field.replace(" ","_"), robust=robust,
+                    threshold=threshold))
+
+
+def myclean_markers(name, fields=continuum_fields, robust=0.5,
+                    threshold='0.75mJy', **kwargs):
+    """ The FITS images whose existence means `myclean` has been run """
+    return [myclean_imagename(name, field, robust, threshold)+".image.tt0.pbcor.fits"
+            for field in fields]
+
+
 def myclean(
     vis,
     name,
     spws="2,4,5,6,7,8,9,11,12,13,14,15,16,17,18,21,22,23,24,25,27,28,29,30,31,33,34,35,36,38,41,43,44,46,47,48,49,51,52,53,54,55,56,57,58,59,60,62,63,64",
     imsize=8000,
     cell='0.01arcsec',
-    fields=["Sgr B2 N Q", "Sgr B2 NM Q", "Sgr B2 MS Q", "Sgr B2 S Q", "Sgr B2 DS1 Q", "Sgr B2 DS2 Q", "Sgr B2 DS3 Q",],
+    fields=continuum_fields,
     niter=10000,
     threshold='0.75mJy',
     robust=0.5,
@@ -80,65 +153,134 @@ def myclean(
     datacolumn='corrected',
     noneg=True,
     cleanup=True,
+    nfieldprocs=1,
+    field_memory_gb=None,
+    memory_budget_gb=None,
     **kwargs
 ):
+    """
+    Clean and export each of ``fields``, then (if ``noneg``) predict their
+    non-negative models into the MSes, each into its own field's rows, in one
+    pass after all of the fields are imaged (see `predict_models`).  A field
+    is only re-imaged, and its model only re-predicted, when its parameters or
+    inputs changed (see clean_manifest.py).
+
+    With ``nfieldprocs`` > 1, the fields are imaged in parallel worker
+    processes (see `imaging_queue.run_local`), as many at once as fit in
+    ``memory_budget_gb`` (default: the NODE_MEMORY_GB budget) given
+    ``field_memory_gb`` per field (default: `mfs_memory_gb`).  Unless savemodel
+    is 'none', the tcleans take turns writing their models to the MSes.  Each field's casa log is
+    kept in <imagename>.casalog and all of them, with the time each step
+    took, are collected in <name>_myclean.log.
+    """
+    jobs = []
     for field in fields:
-        imagename = ("{name}_{field}_r{robust}_allcont_clean1e4_{threshold}"
-                     .format(name=name, field=field.replace(" ","_"),
-                             robust=robust, threshold=threshold)
-                    )
+        imagename = myclean_imagename(name, field, robust, threshold)
         if phasecenters is not None:
             phasecenter = phasecenters[field]
         else:
             phasecenter = ''
 
-        if not os.path.exists(imagename+".image.tt0.pbcor.fits"):
-            rslt = tclean(vis=vis,
-                          field=field,
-                          spw=spws,
-                          imsize=[imsize, imsize],
-                          cell=cell,
-                          imagename=imagename,
-                          niter=niter,
-                          threshold=threshold,
-                          phasecenter=phasecenter,
-                          robust=robust,
-                          gridder=gridder,
-                          deconvolver='mtmfs',
-                          specmode='mfs',
-                          nterms=2,
-                          weighting='briggs',
-                          pblimit=0.1,
-                          interactive=False,
-                          outframe='LSRK',
-                          datacolumn=datacolumn,
-                          savemodel=savemodel,
-                          scales=scales,
-                          mask=mask,
-                          **kwargs
-                         )
-            makefits(imagename, cleanup=cleanup)
-        else:
-            casalog.post("Skipping {0}".format(imagename), origin='myclean')
+        params = dict(vis=vis,
+                      field=field,
+                      spw=spws,
+                      imsize=[imsize, imsize],
+                      cell=cell,
+                      imagename=imagename,
+                      niter=niter,
+                      threshold=threshold,
+                      phasecenter=phasecenter,
+                      robust=robust,
+                      gridder=gridder,
+                      deconvolver='mtmfs',
+                      specmode='mfs',
+                      nterms=2,
+                      weighting='briggs',
+                      pblimit=0.1,
+                      interactive=False,
+                      outframe='LSRK',
+                      datacolumn=datacolumn,
+                      savemodel=savemodel,
+                      scales=scales,
+                      mask=mask,
+                      **kwargs
+                     )
+        jobs.append({'name': imagename, 'field': field,
+                     'marker': imagename+".image.tt0.pbcor.fits",
+                     'memory': (field_memory_gb if field_memory_gb is not None
+                                else mfs_memory_gb(imsize)),
+                     'phasecenter': phasecenter,
+                     'params': params, 'cleanup': cleanup,
+                     'logfile': (imagename+'.casalog' if nfieldprocs > 1
+                                 else None)})
+
+    if nfieldprocs <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            clean_field(job)
+        failed = []
+    else:
+        failed = clean_fields(jobs, name, nfieldprocs, memory_budget_gb)
+
+    if noneg:
+        # all of the fields' models, predicted in one pass once every field
+        # is imaged
+        t0 = time.time()
+        predicted = predict_models([(job['field'], job['name'],
+                                     job['name']+".model.tt0",
+                                     job['phasecenter'])
+                                    for job in jobs
+                                    if job['field'] not in failed
+                                    and os.path.exists(job['name']+".model.tt0")],
+                                   ms=vis, imsize=[imsize, imsize], cell=cell,
+                                   gridder=gridder, robust=robust,
+                                   scales=scales, **kwargs)
+        summary = ("noneg: predicted {0} in {1:0.1f}s"
+                   .format(", ".join(predicted) or 'nothing', time.time() - t0))
+        casalog.post(summary, origin='myclean')
+        if nfieldprocs > 1 and len(jobs) > 1:
+            with open(name+'_myclean.log', 'a') as log:
+                log.write("==== {0}\n".format(summary))
 
-        if noneg and os.path.exists(imagename+".model.tt0"):
-            noneg_model(modelname=imagename+".model.tt0",
-                        ms=vis,
-                        imagename=imagename,
-                        imsize=[imsize, imsize],
-                        cell=cell,
-                        phasecenter=phasecenter,
-                        gridder=gridder,
-                        robust=robust,
-                        scales=scales,
-                        **kwargs
-                       )
+    if failed:
+        raise RuntimeError("myclean failed for {0}; see {1}_myclean.log"
+                           .format(", ".join(failed), name))
 
 
-def noneg_model(modelname, ms, imagename, **kwargs):
+def clean_fields(jobs, name, nfieldprocs, memory_budget_gb):
     """
-    Given a model image, set all model components positive, then ft them into
-    the ms's model column
+    Run the `clean_field` jobs of a `myclean` call in parallel and collect
+    their logs and timings in <name>_myclean.log.  Returns the failed fields.
+    """
+    # the manifest check happens in the workers, so every field is "pending"
+    results = imaging_queue.run_local(clean_field, jobs, nprocs=nfieldprocs,
+                                      memory_gb=memory_budget_gb,
+                                      is_done=lambda job: False,
+                                      initializer=_set_ms_lock,
+                                      initargs=(multiprocessing.Lock(),))
+    results = {result[0]: result for result in results}
+
+    with open(name+'_myclean.log', 'a') as log:
+        for job in jobs:
+            _, elapsed, error, timings = results[job['name']]
+            steps = ", ".join("{0} {1:0.1f}s".format(step, timings[step])
+                              for step in ('tclean', 'makefits')
+                              if timings and step in timings)
+            summary = ("{0}: {1:0.1f}s ({2})".format(job['field'], elapsed,
+                                                   steps or 'nothing to do')
+                       + (" FAILED: "+error if error else ''))
+            casalog.post(summary, origin='myclean',
+                         priority='SEVERE' if error else 'INFO')
+            log.write("==== {0}\n".format(summary))
+            if os.path.exists(job['logfile']):
+                with open(job['logfile'], 'r') as fh:
+                    log.write(fh.read())
+
+    return [job['field'] for job in jobs if results[job['name']][2]]
+
+
+def clip_model(modelname):
+    """
+    Set all components of a model image positive, in ``modelname+".positive"``
     """
     if os.path.exists(modelname+".positive"):
         shutil.rmtree(modelname+".positive")
@@ -147,58 +289,194 @@ def noneg_model(modelname, ms, imagename, **kwargs):
            expr='iif(IM0<0, 0.0, IM0)',
            outfile=modelname+".positive",
           )
+    return modelname+".positive"
+
+
+def predict_models(models, ms, **kwargs):
+    """
+    Set each model positive and ft it into the model column of the ms (a list
+    of MSes), where ``models`` is a list of (field, imagename, modelname,
+    phasecenter) and each model only goes into its own field's rows.
+
+    A model is not predicted again if those rows already hold it: the
+    positive model's pixels and the predict parameters are hashed and compared
+    with what was last predicted into each field, as long as the model column
+    has not been written since (see clean_manifest.py).  Returns the fields
+    that were predicted.
+    """
+    vislist = list(ms) if isinstance(ms, (list, tuple)) else [ms]
+    predicted = clean_manifest.predicted_models(vislist)
+
+    done = []
+    for field, imagename, modelname, phasecenter in models:
+        positive = clip_model(modelname)
+        key = clean_manifest.params_hash({'model': clean_manifest.image_hash(positive),
+                                          'imagename': imagename,
+                                          'phasecenter': phasecenter,
+                                          'params': kwargs})
+        if predicted.get(field) == key:
+            casalog.post("The model column of {0} already holds {1}"
+                         .format(field, positive), origin='predict_models')
+            continue
+
+        if os.path.exists(modelname):
+            if os.path.exists(modelname+".old"):
+                shutil.rmtree(modelname+".old")
+            os.rename(modelname, modelname+".old")
+
+        with_ms_lock(tclean,
+                     vis=ms,
+                     field=field,
+                     imagename=imagename,
+                     startmodel=positive,
+                     phasecenter=phasecenter,
+                     niter=0,
+                     deconvolver='mtmfs',
+                     specmode='mfs',
+                     nterms=1,
+                     calcpsf=False,
+                     calcres=False,
+                     interactive=False,
+                     savemodel='modelcolumn',
+                     **kwargs
+                    )
+        predicted[field] = key
+        # after every field, so an interrupted run keeps what it did
+        clean_manifest.record_predict(vislist, predicted)
+        done.append(field)
+
+    return done
 
-    if os.path.exists(modelname):
-        if os.path.exists(modelname+".old"):
-            shutil.rmtree(modelname+".old")
-        os.rename(modelname, modelname+".old")
-
-    tclean(vis=ms,
-           imagename=imagename,
-           startmodel=modelname+".positive",
-           niter=0,
-           deconvolver='mtmfs',
-           specmode='mfs',
-           nterms=1,
-           calcpsf=False,
-           calcres=False,
-           interactive=False,
-           savemodel='modelcolumn',
-           **kwargs
-          )
+
+def noneg_model(modelname, ms, imagename, field='', phasecenter='', **kwargs):
+    """
+    Given a model image, set all model components positive, then ft them into
+    the ms's model column (only the rows of ``field``, if given)
+    """
+    return predict_models([(field, imagename, modelname, phasecenter)], ms,
+                          **kwargs)
 
 name_regex = re.compile('18A-229_2018_([0-9][0-9])_([0-9][0-9])_T([0-9][0-9])_[0-9][0-9]_[0-9][0-9].[0-9][0-9][0-9]')
 
-def mygaincal(vis, name_regex=name_regex, caltable=None, **kwargs):
-    if isinstance(vis, list) or isinstance(vis, tuple):
-        for onems in vis:
-            matches = name_regex.search(onems)
-            assert matches.groups() is not None
-            mon,day,hr = matches.groups()
-            caltable_ = "{0}_{1}_T{2}_{3}".format(mon,day,hr,caltable)
-            if not os.path.exists(caltable_):
-                gaincal(vis=onems, caltable=caltable_, **kwargs)
+
+def epoch_caltable(onems, caltable, name_regex=name_regex):
+    """ The per-epoch name of ``caltable``: <month>_<day>_T<hour>_<caltable> """
+    matches = name_regex.search(onems)
+    if matches is None:
+        raise ValueError("Cannot tell the epoch of {0}".format(onems))
+    mon,day,hr = matches.groups()
+    return "{0}_{1}_T{2}_{3}".format(mon,day,hr,caltable)
+
+
+def _epoch_gaincal(args):
+    onems, caltable_, kwargs = args
+    if os.path.exists(caltable_):
+        return 'exists'
+    gaincal(vis=onems, caltable=caltable_, **kwargs)
+    if not os.path.exists(caltable_):
+        raise IOError("gaincal did not produce {0}".format(caltable_))
+    return 'done'
+
+
+def _epoch_applycal(args):
+    onems, caltable_, kwargs = args
+    if not os.path.exists(caltable_):
+        raise IOError("No such table {0}".format(caltable_))
+    applycal(vis=onems, gaintable=[caltable_], **kwargs)
+    return 'done'
+
+
+def _run_epoch(args):
+    func, onems, caltable_, kwargs = args
+    t0 = time.time()
+    try:
+        status = func((onems, caltable_, kwargs))
+    except Exception as ex:
+        # one failed epoch should not stop the others
+        return (onems, caltable_, time.time() - t0,
+                "{0}: {1}".format(type(ex).__name__, ex))
+    return onems, caltable_, time.time() - t0, status
+
+
+def run_epoch_tasks(tasks, nprocs=None, origin='run_epochs'):
+    """
+    Run each ``(func, ms, caltable, kwargs)`` of ``tasks`` as
+    ``func((ms, caltable, kwargs))`` in a pool of fresh worker processes (at
+    most ``nprocs``, default NPROCS or the node's cores,
+    `imaging_queue.node_cores`, at once; 1 runs them here, one after
+    another).
+
+    Every task is run even if some fail.  The outcome of each (its caltable,
+    wall time and status or error) is posted to the casa log, then, if any
+    failed, an IOError naming them is raised.  Returns a list of (ms,
+    caltable, wall time, status) in the order of ``tasks``.
+    """
+    if nprocs is None:
+        nprocs = int(os.getenv('NPROCS', imaging_queue.node_cores))
+    t0 = time.time()
+    if nprocs <= 1 or len(tasks) <= 1:
+        results = [_run_epoch(task) for task in tasks]
     else:
+        # maxtasksperchild=1: a fresh casa for every task
+        pool = multiprocessing.Pool(processes=min(nprocs, len(tasks)),
+                                    maxtasksperchild=1)
+        try:
+            results = pool.map(_run_epoch, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = [result for result in results
+              if result[3] not in ('done', 'exists')]
+    for onems, caltable_, elapsed, status in results:
+        casalog.post("{0} -> {1}: {2} ({3:0.1f}s)".format(onems, caltable_,
+                                                        status, elapsed),
+                     origin=origin,
+                     priority='SEVERE' if status not in ('done', 'exists') else 'INFO')
+    casalog.post("{0} of {1} succeeded in {2:0.1f}s"
+                 .format(len(results) - len(failed), len(results),
+                         time.time() - t0), origin=origin)
+
+    if failed:
+        raise IOError("{0} failed for {1}"
+                      .format(origin, ", ".join("{0} ({1})".format(onems, caltable_)
+                                                for onems, caltable_, _, _ in failed)))
+    return results
+
+
+def run_epochs(func, vis, caltable, name_regex=name_regex, nprocs=None,
+               origin='run_epochs', **kwargs):
+    """
+    Run ``func((ms, per-epoch caltable, kwargs))`` for each epoch MS in
+    ``vis``, in parallel (see `run_epoch_tasks`)
+    """
+    if not isinstance(vis, (list, tuple)):
         casalog.post("FAILURE: bad vis input {0}".format(vis),
-                     origin='mygaincal', priority='SEVERE')
+                     origin=origin, priority='SEVERE')
         raise ValueError
 
-def myapplycal(vis, name_regex=name_regex, gaintable=None, **kwargs):
+    return run_epoch_tasks([(func, onems,
+                             epoch_caltable(onems, caltable, name_regex), kwargs)
+                            for onems in vis],
+                           nprocs=nprocs, origin=origin)
+
+
+def mygaincal(vis, name_regex=name_regex, caltable=None, nprocs=None, **kwargs):
+    """
+    gaincal each epoch MS in ``vis`` into its own <epoch>_``caltable`` (unless
+    it exists), with the epochs in parallel (see `run_epochs`)
+    """
+    return run_epochs(_epoch_gaincal, vis, caltable, name_regex=name_regex,
+                      nprocs=nprocs, origin='mygaincal', **kwargs)
+
+
+def myapplycal(vis, name_regex=name_regex, gaintable=None, nprocs=None,
+               **kwargs):
+    """
+    applycal <epoch>_``gaintable[0]`` to each epoch MS in ``vis``, with the
+    epochs in parallel (see `run_epochs`)
+    """
     assert len(gaintable) == 1
-    if isinstance(vis, list) or isinstance(vis, tuple):
-        for onems in vis:
-            matches = name_regex.search(onems)
-            assert matches.groups() is not None
-            mon,day,hr = matches.groups()
-            caltable = gaintable[0]
-            caltable_ = "{0}_{1}_T{2}_{3}".format(mon,day,hr,caltable)
-            if os.path.exists(caltable_):
-                applycal(vis=onems, gaintable=[caltable_], **kwargs)
-            else:
-                casalog.post("FAILURE: table {0} not found".format(caltable_),
-                             origin='myapplycal', priority='SEVERE')
-                raise IOError("No such table {0}".format(caltable_))
-    else:
-        casalog.post("FAILURE: bad vis input {0}".format(vis),
-                     origin='myapplycal', priority='SEVERE')
-        raise ValueError
+    return run_epochs(_epoch_applycal, vis, gaintable[0],
+                      name_regex=name_regex, nprocs=nprocs,
+                      origin='myapplycal', **kwargs)
@@ -0,0 +1,157 @@
+"""
+Streaming collapse of spectral cubes for quicklooks.py.
+
+The spectral-cube reductions (``mad_std``, ``max``, ``min``, ``argmax``) each
+traverse the whole cube, and the ray-based ones load it into memory.  Here the
+cube is read one spectral plane at a time and all of the per-plane statistics
+and per-pixel accumulators are updated together, so peak memory is a few
+planes regardless of cube size.
+
+The channel selection used for the maps (channels whose noise is below a
+threshold derived from the whole noise spectrum) is only known once every
+plane has been seen, so the cube is read twice: `plane_statistics` gives the
+noise and peak spectra, and `collapse_maps` accumulates the 2D maps over the
+selected channels.
+
+Percentiles can't be accumulated plane by plane, so `percentile_maps` reads
+the cube in spatial blocks of full spectra instead.
+"""
+import numpy as np
+from astropy.stats import mad_std
+
+
+def iter_planes(cube, channels=None):
+    """
+    Yield (channel index, plane) for the selected channels, with masked
+    pixels set to NaN.  Only one plane is held in memory at a time.
+    """
+    if channels is None:
+        channels = range(cube.shape[0])
+    for ii in channels:
+        yield ii, cube.filled_data[ii].value
+
+
+def plane_statistics(cube):
+    """
+    First pass: the MAD-estimated standard deviation and the maximum of every
+    plane.  Fully masked planes give NaN.
+    """
+    nchan = cube.shape[0]
+    stdspec = np.full(nchan, np.nan)
+    maxspec = np.full(nchan, np.nan)
+
+    for ii, plane in iter_planes(cube):
+        if np.any(np.isfinite(plane)):
+            stdspec[ii] = mad_std(plane, ignore_nan=True)
+            maxspec[ii] = np.nanmax(plane)
+
+    return stdspec, maxspec
+
+
+def collapse_maps(cube, include, sn_include=None):
+    """
+    Second pass: per-pixel max, min and argmax over the channels in
+    ``include`` and, if given, the max over the channels in ``sn_include``,
+    from a single read of each needed plane.
+
+    Returns a dict of 2D arrays: ``max``, ``min``, ``argmax`` (float, NaN where
+    no channel had data) and ``max_masked`` (None if ``sn_include`` is None
+    or selects nothing).
+    """
+    shape = cube.shape[1:]
+    mx = np.full(shape, -np.inf)
+    mn = np.full(shape, np.inf)
+    argmax = np.full(shape, np.nan)
+    if sn_include is not None and np.any(sn_include):
+        mx_masked = np.full(shape, -np.inf)
+        channels = np.flatnonzero(include | sn_include)
+    else:
+        mx_masked = None
+        channels = np.flatnonzero(include)
+
+    for ii, plane in iter_planes(cube, channels):
+        if include[ii]:
+            # NaN comparisons are False, so blanked pixels never win
+            better = plane > mx
+            mx[better] = plane[better]
+            argmax[better] = ii
+            np.fmin(mn, plane, out=mn)
+        if mx_masked is not None and sn_include[ii]:
+            np.fmax(mx_masked, plane, out=mx_masked)
+
+    for arr in (mx, mn, mx_masked):
+        if arr is not None:
+            arr[~np.isfinite(arr)] = np.nan
+
+    return {'max': mx, 'min': mn, 'argmax': argmax, 'max_masked': mx_masked}
+
+
+def nanpercentile_axis0(block, percentiles):
+    """
+    ``np.nanpercentile(block, percentiles, axis=0)`` (linear interpolation),
+    vectorized: numpy falls back to a python loop over the spectra when
+    there are NaNs.  Sorting moves the NaNs to the end of each spectrum, so the
+    percentiles are interpolated between the first ``n`` sorted values.
+    """
+    srt = np.sort(block, axis=0)
+    nvalid = np.isfinite(srt).sum(axis=0)
+    yy, xx = np.indices(block.shape[1:])
+    result = np.full((len(percentiles),) + block.shape[1:], np.nan)
+    for ii, pct in enumerate(percentiles):
+        pos = pct / 100. * (nvalid - 1)
+        lo = np.clip(np.floor(pos).astype('int'), 0, None)
+        hi = np.clip(lo + 1, None, np.maximum(nvalid - 1, 0))
+        frac = pos - lo
+        vlo = srt[lo, yy, xx]
+        vhi = srt[hi, yy, xx]
+        result[ii] = np.where(nvalid > 0, vlo + (vhi - vlo) * frac, np.nan)
+    return result
+
+
+def percentile_maps(cube, percentiles, include=None, max_bytes=512*1024**2):
+    """
+    Per-pixel percentiles along the spectral axis over the channels in
+    ``include`` (all channels if None), ignoring NaNs.
+
+    The cube is read in blocks of whole rows, all channels at once, of at
+    most ``max_bytes``, and each block is reduced with one vectorized sort
+    (`nanpercentile_axis0`), so the result is exact but memory stays bounded.
+    Returns an array of shape (len(percentiles), ny, nx).
+    """
+    nchan, ny, nx = cube.shape
+    if include is None:
+        include = np.ones(nchan, dtype='bool')
+    pctmaps = np.full((len(percentiles), ny, nx), np.nan)
+    if not np.any(include):
+        return pctmaps
+
+    # allow for the sorted copy and the index arrays
+    rows = int(max(1, max_bytes // (3 * nchan * nx * 8)))
+    for y0 in range(0, ny, rows):
+        y1 = min(y0 + rows, ny)
+        block = cube.filled_data[:, y0:y1, :].value[include]
+        pctmaps[:, y0:y1, :] = nanpercentile_axis0(block, percentiles)
+
+    return pctmaps
+
+
+def max_spectrum(cube):
+    """
+    The maximum of every plane, from one plane-by-plane read.
+    """
+    mxspec = np.full(cube.shape[0], np.nan)
+    for ii, plane in iter_planes(cube):
+        if np.any(np.isfinite(plane)):
+            mxspec[ii] = np.nanmax(plane)
+    return mxspec
+
+
+def noise_threshold(stdspec):
+    """
+    The noise threshold quicklooks.py uses to reject bad channels: the 90th
+    percentile of the noise spectrum if every channel is noisier than 0.1 (in
+    the cube's units), otherwise 0.1.
+    """
+    if np.nanmin(stdspec) > 0.1:
+        return np.nanpercentile(stdspec, 90)
+    return 0.1
@@ -0,0 +1,102 @@
+"""
+Per-cube metadata shared by the collapse (quicklooks.py) and extraction
+(extract_nh3_spectra.py) routines.
+
+The beam, mean frequency, Jy/beam -> K factor, spectral and velocity axes of
+a cube each require a pass over the spectral axis (and, for the beams of a
+varying-resolution cube, an average over all of them), so `CubeMetadata`
+computes each of them once, on first use, and every product of the cube
+reuses it.
+"""
+import numpy as np
+from astropy import units as u
+from astropy import wcs
+from spectral_cube.lower_dimensional_structures import (Projection,
+                                                        OneDSpectrum,
+                                                        VaryingResolutionOneDSpectrum)
+
+
+class CubeMetadata(object):
+    """
+    Lazily computed, cached properties of ``cube``.  The cube is not modified.
+    """
+
+    def __init__(self, cube):
+        self.cube = cube
+        self._cache = {}
+
+    def _cached(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    @property
+    def beam(self):
+        """ The beam, or the average of the beams of a varying-resolution cube """
+        return self._cached('beam', lambda: self.cube.beam
+                            if hasattr(self.cube, 'beam')
+                            else self.cube.average_beams(1))
+
+    @property
+    def beam_areas(self):
+        """ The solid angle of every channel's beam """
+        def beam_areas():
+            if hasattr(self.cube, 'unmasked_beams'):
+                return self.cube.unmasked_beams.sr
+            return np.repeat(self.cube.beam.sr.value, self.cube.shape[0])*u.sr
+        return self._cached('beam_areas', beam_areas)
+
+    @property
+    def spectral_axis(self):
+        return self._cached('spectral_axis', lambda: self.cube.spectral_axis)
+
+    @property
+    def frequency(self):
+        """ The mean frequency of the cube """
+        return self._cached('frequency',
+                            lambda: self.cube.with_spectral_unit(u.GHz).spectral_axis.mean())
+
+    def velocity_axis(self, velocity_convention='radio'):
+        """ The spectral axis in km/s (uses the cube's rest frequency) """
+        def velocity_axis():
+            vcube = self.cube.with_spectral_unit(u.km/u.s,
+                                                 velocity_convention=velocity_convention)
+            return vcube.spectral_axis
+        return self._cached(('velocity_axis', velocity_convention), velocity_axis)
+
+    @property
+    def jtok(self):
+        """ The Jy/beam -> K conversion factor at the mean frequency """
+        def jtok():
+            equiv = u.brightness_temperature(beam_area=self.beam,
+                                             frequency=self.frequency)
+            return (1*u.Jy).to(u.K, equiv) / (u.Jy/u.beam)
+        return self._cached('jtok', jtok)
+
+    def to_K(self, data):
+        """ Convert Jy/beam ``data`` (e.g., a Projection) to K """
+        return (data * self.jtok).to(u.K)
+
+    def make_spectrum(self, values, unit=None):
+        """
+        A OneDSpectrum of ``values`` with the spectral WCS and beam(s) of the
+        cube, in the cube's unit unless ``unit`` is given
+        """
+        cube = self.cube
+        kwargs = dict(value=values, unit=cube.unit if unit is None else unit,
+                      wcs=cube.wcs.sub([wcs.WCSSUB_SPECTRAL]),
+                      spectral_unit=self.spectral_axis.unit, meta=cube.meta)
+        if hasattr(cube, 'unmasked_beams'):
+            # cube.beams excludes the masked-out beams
+            return VaryingResolutionOneDSpectrum(beams=cube.unmasked_beams, **kwargs)
+        elif hasattr(cube, 'beam'):
+            return OneDSpectrum(beam=cube.beam, **kwargs)
+        return OneDSpectrum(**kwargs)
+
+    def make_projection(self, values):
+        """
+        A Projection of ``values`` with the celestial WCS and (average) beam of
+        the cube
+        """
+        return Projection(values, unit=self.cube.unit, wcs=self.cube.wcs.celestial,
+                          meta=self.cube.meta, beam=self.beam)
@@ -1,13 +1,33 @@
+"""
+Extract NH3 spectra toward the SgrB2M NH3 (2,2) masers from every NH3 cube.
+
+Each cube is opened once (memory-mapped) in a worker process; all of the
+region positions are converted to pixels with a single WCS call and all of the
+spectra are pulled with one fancy-indexed read.  Set NPROCS to limit the
+number of workers.
+
+``python extract_nh3_spectra.py aperture [regionfile]`` instead sums the
+spectra over each (circle / ellipse) region, by default those of
+cleanbox_regions_SgrB2.reg; see `extract_apertures`.
+"""
 import os
+import sys
+import hashlib
+import functools
 import numpy as np
 from astropy.io import fits
 from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.wcs.utils import skycoord_to_pixel, proj_plane_pixel_area
 from astropy.stats import mad_std
 import radio_beam
 import glob
+import multiprocessing
 from spectral_cube import SpectralCube
 import regions
 
+from cube_metadata import CubeMetadata
+
 import matplotlib
 matplotlib.use('agg')
 import pylab as pl
@@ -35,41 +55,219 @@ freq_dict = {
     '99': 27.477943e9,
 }
 
-for ii,reg in enumerate(nh3_regs):
 
-    print(ii, reg)
-    pl.figure(1).clf()
+def region_pixels(regs, ww, shape):
+    """
+    Convert the centers of all regions to (integer) pixel positions in one
+    call.  Returns the y and x pixel arrays and a mask of the regions that fall
+    inside the image.
+    """
+    centers = SkyCoord([reg.center for reg in regs])
+    xx, yy = skycoord_to_pixel(centers, ww)
+    inside = (yy > 0) & (yy < shape[1]) & (xx > 0) & (xx < shape[2])
+    return yy.astype('int'), xx.astype('int'), inside
+
+
+def open_cube(fn):
+    """
+    Open a cube in velocity units of its NH3 line.  The NH3 (2,2) cube is
+    swapped for the self-calibrated zoom cube.  Returns the line name, the
+    file name, the cube and its `CubeMetadata`.
+    """
+    linename = nh3_re.search(fn).groups()[0]
+
+    if linename == '22':
+        fn = 'NH322_zoom_on_SgrB2M_40to80kms_selfcal_iter3.image.pbcor.fits'
+
+    restfreq = freq_dict[linename]*u.Hz
+
+    # FITS cubes are opened memory-mapped, so only the indexed spectra are read
+    cube = SpectralCube.read(fn).with_spectral_unit(u.km/u.s,
+                                                    velocity_convention='radio',
+                                                    rest_value=restfreq)
+    cube.beam_threshold = 1
+    print(linename, cube.wcs.wcs.restfrq)
+
+    return linename, fn, cube, CubeMetadata(cube)
+
+
+def extract_cube(fn, regs=nh3_regs):
+    """
+    Extract the spectra of all regions from one cube and write them to
+    nh3spectra/.  Returns the line name, the (possibly swapped) file name, the
+    spectral axis, the (nchan, nregions) spectra and the inside mask.
+    """
+    linename, fn, cube, meta = open_cube(fn)
+
+    yy, xx, inside = region_pixels(regs, cube.wcs.celestial, cube.shape)
+
+    spectra = cube.unmasked_data[:, yy[inside], xx[inside]]
+
+    for kk, ii in enumerate(np.flatnonzero(inside)):
+        # equivalent to cube[:, y, x]
+        spec = meta.make_spectrum(spectra[:, kk].value)
+        spec.write("nh3spectra/{0}_{1}".format(ii, fn), overwrite=True)
+
+    allspectra = np.full([cube.shape[0], len(regs)], np.nan)
+    allspectra[:, inside] = spectra.value
+
+    return linename, fn, meta.spectral_axis, allspectra, inside
+
+
+# rasterized apertures, keyed by celestial WCS, image shape and region file
+aperture_cache = {}
+
+
+def aperture_indices(regionfile, ww, shape, cachedir='nh3spectra'):
+    """
+    Rasterize every region in ``regionfile`` onto the (ny, nx) = ``shape``
+    image grid of celestial WCS ``ww``.
+
+    Returns ``(flat, offsets)``: the flattened pixel indices of all apertures
+    concatenated, with aperture ``ii`` occupying
+    ``flat[offsets[ii]:offsets[ii+1]]``.  Apertures are computed once per
+    unique WCS / shape / region file and cached in memory and in
+    ``cachedir``.
+    """
+    hsh = hashlib.sha1()
+    hsh.update(ww.to_header_string().encode())
+    hsh.update(str(tuple(shape)).encode())
+    with open(regionfile, 'rb') as fh:
+        hsh.update(fh.read())
+    key = hsh.hexdigest()
+
+    if key in aperture_cache:
+        return aperture_cache[key]
+
+    cachefn = os.path.join(cachedir, 'apertures_{0}.npz'.format(key))
+    if os.path.exists(cachefn):
+        with np.load(cachefn) as cache:
+            aperture_cache[key] = cache['flat'], cache['offsets']
+            return aperture_cache[key]
+
+    flat = []
+    offsets = [0]
+    for reg in regions.read_ds9(regionfile):
+        mask = reg.to_pixel(ww).to_mask(mode='center')
+        yy, xx = np.nonzero(mask.data)
+        yy = yy + mask.bbox.iymin
+        xx = xx + mask.bbox.ixmin
+        ok = (yy >= 0) & (yy < shape[0]) & (xx >= 0) & (xx < shape[1])
+        flat.append(np.ravel_multi_index((yy[ok], xx[ok]), shape))
+        offsets.append(offsets[-1] + ok.sum())
+    flat = np.concatenate(flat).astype('int64') if flat else np.zeros(0, dtype='int64')
+    offsets = np.array(offsets, dtype='int64')
+
+    np.savez(cachefn, flat=flat, offsets=offsets)
+    aperture_cache[key] = flat, offsets
+    return flat, offsets
+
+
+def aperture_sums(cube, flat, offsets, meta=None, max_bytes=2*1024**3):
+    """
+    Sum the cube over each aperture, reading only the bounding box of all the
+    apertures, ``max_bytes`` at a time along the spectral axis.
+
+    Returns an (nchan, naperture) array in Jy if the cube is in Jy/beam
+    (scaled by the pixel / beam area of each channel), otherwise in the cube's
+    units times pixels.  Empty apertures (off the image) are NaN.  ``meta``
+    is the cube's `CubeMetadata`, if it already has one.
+    """
+    nchan, ny, nx = cube.shape
+    naper = len(offsets) - 1
+    sums = np.full([nchan, naper], np.nan)
+    if len(flat) == 0:
+        return sums
+
+    yy, xx = np.unravel_index(flat, (ny, nx))
+    ymin, ymax, xmin, xmax = yy.min(), yy.max()+1, xx.min(), xx.max()+1
+    # indices into the flattened bounding box
+    local = np.ravel_multi_index((yy-ymin, xx-xmin), (ymax-ymin, xmax-xmin))
+    # each aperture's pixels are contiguous in `local`, so a reduceat over
+    # the starts of the non-empty apertures sums each one
+    nonempty = np.flatnonzero(np.diff(offsets) > 0)
+
+    plane_bytes = (ymax-ymin)*(xmax-xmin)*cube.unmasked_data[0,0,0].value.nbytes
+    chunk = int(max(1, max_bytes // plane_bytes))
+
+    for c0 in range(0, nchan, chunk):
+        c1 = min(c0+chunk, nchan)
+        block = cube.unmasked_data[c0:c1, ymin:ymax, xmin:xmax].value
+        pix = block.reshape(c1-c0, -1)[:, local]
+        pix = np.where(np.isfinite(pix), pix, 0)
+        sums[c0:c1, nonempty] = np.add.reduceat(pix, offsets[nonempty], axis=1)
+
+    if cube.unit.is_equivalent(u.Jy/u.beam):
+        if meta is None:
+            meta = CubeMetadata(cube)
+        pixarea = proj_plane_pixel_area(cube.wcs.celestial)*u.deg**2
+        ppbeam = (meta.beam_areas / pixarea).decompose().value
+        sums *= cube.unit.to(u.Jy/u.beam) / ppbeam[:, None]
+
+    return sums
+
+
+def extract_apertures(fn, regionfile='cleanbox_regions_SgrB2.reg'):
+    """
+    Write the aperture-summed spectrum of every region in ``regionfile`` from
+    one cube to nh3spectra/aperture_<ii>_<fn>.  Returns the line name, the
+    (possibly swapped) file name, the spectral axis, and the (nchan,
+    nregions) spectra.
+    """
+    linename, fn, cube, meta = open_cube(fn)
+
+    flat, offsets = aperture_indices(regionfile, cube.wcs.celestial,
+                                     cube.shape[1:])
+    spectra = aperture_sums(cube, flat, offsets, meta=meta)
+
+    for ii in np.flatnonzero(np.diff(offsets) > 0):
+        unit = u.Jy if cube.unit.is_equivalent(u.Jy/u.beam) else None
+        spec = meta.make_spectrum(spectra[:, ii], unit=unit)
+        spec.write("nh3spectra/aperture_{0}_{1}".format(ii, fn), overwrite=True)
+
+    return linename, fn, meta.spectral_axis, spectra, np.diff(offsets) > 0
 
-    for jj,fn in enumerate(glob.glob("*combined_Sgr_B2_MN_K*NH3*.image.pbcor.fits")):
 
-        linename = nh3_re.search(fn).groups()[0]
+if __name__ == "__main__":
+    nprocs = int(os.getenv('NPROCS', multiprocessing.cpu_count()))
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'point'
 
-        if linename == '22':
-            fn = 'NH322_zoom_on_SgrB2M_40to80kms_selfcal_iter3.image.pbcor.fits'
+    fns = glob.glob("*combined_Sgr_B2_MN_K*NH3*.image.pbcor.fits")
 
-        restfreq = freq_dict[linename]*u.Hz
+    if mode == 'aperture':
+        regionfile = sys.argv[2] if len(sys.argv) > 2 else 'cleanbox_regions_SgrB2.reg'
+        regs = regions.read_ds9(regionfile)
+        extract = functools.partial(extract_apertures, regionfile=regionfile)
+        prefix = 'aperture_'
+    else:
+        regs = nh3_regs
+        extract = extract_cube
+        prefix = ''
 
-        cube = SpectralCube.read(fn).with_spectral_unit(u.km/u.s,
-                                                        velocity_convention='radio',
-                                                        rest_value=restfreq)
-        cube.beam_threshold = 1
-        print(linename, cube.wcs.wcs.restfrq)
+    pool = multiprocessing.Pool(processes=max(1, min(nprocs, len(fns))))
+    try:
+        results = pool.map(extract, fns, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
 
-        rpix = reg.to_pixel(cube.wcs.celestial)
+    for ii,reg in enumerate(regs):
 
-        if rpix.center.y > 0 and rpix.center.y < cube.shape[1] and rpix.center.x > 0 and rpix.center.x < cube.shape[2]:
+        print(ii, reg)
+        pl.figure(1).clf()
 
-            spec = cube[:, int(rpix.center.y), int(rpix.center.x)]
+        for jj,(linename, fn, spectral_axis, spectra, inside) in enumerate(results):
 
-            spec.write("nh3spectra/{0}_{1}".format(ii, fn), overwrite=True)
+            if not inside[ii]:
+                continue
 
             if ii == 0 and linename == '22':
-                pl.plot(spec.spectral_axis, jj*0.01 + spec.value/10, label=linename+"/10")
+                pl.plot(spectral_axis, jj*0.01 + spectra[:,ii]/10, label=linename+"/10")
             else:
-                pl.plot(spec.spectral_axis, jj*0.01 + spec.value, label=linename)
+                pl.plot(spectral_axis, jj*0.01 + spectra[:,ii], label=linename)
 
-    pl.legend(loc='best')
-    pl.xlabel("$V_{LSR}$ [km s$^{-1}$]")
-    pl.ylabel("Flux Density (Jy)")
-    pl.savefig("nh3spectra/{0}_nh3_lines.png".format(ii), dpi=150)
-    pl.savefig("nh3spectra/{0}_nh3_lines.pdf".format(ii))
+        pl.legend(loc='best')
+        pl.xlabel("$V_{LSR}$ [km s$^{-1}$]")
+        pl.ylabel("Flux Density (Jy)")
+        pl.savefig("nh3spectra/{0}{1}_nh3_lines.png".format(prefix, ii), dpi=150)
+        pl.savefig("nh3spectra/{0}{1}_nh3_lines.pdf".format(prefix, ii))
@@ -0,0 +1,116 @@
+"""
+The FITS export stage of ``makefits`` (continuum_imaging_general.py and
+maserline_imaging.py): export the clean products of one image to FITS and
+remove the CASA images afterwards.
+
+Every product is exported by its own image tool in a thread pool, so the
+products are written concurrently instead of by one ``exportfits`` after
+another.  The primary-beam correction is fused with its export: the
+corrected image made by ``ia.pbcor`` is written to FITS straight from the
+tool, without first writing an intermediate CASA image (unless one is wanted)
+and reading it back.  The CASA images are then removed with
+``shutil.rmtree`` in the same pool.
+
+Set EXPORT_THREADS to change the number of threads (default 4).
+"""
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+
+from taskinit import iatool, casalog
+
+
+def tofits(image, fitsimage, dropdeg):
+    """ ``image.tofits`` with the defaults of ``exportfits`` """
+    image.tofits(outfile=fitsimage, velocity=False, optical=False,
+                 bitpix=-32, minpix=0, maxpix=-1, overwrite=True,
+                 dropdeg=dropdeg, dropstokes=False, stokeslast=True,
+                 history=True)
+
+
+def export_image(imagename, fitsimage, dropdeg=False):
+    ia = iatool()
+    ia.open(imagename)
+    try:
+        tofits(ia, fitsimage, dropdeg)
+    finally:
+        ia.close()
+        ia.done()
+    return fitsimage
+
+
+def export_pbcor(imagename, pbimage, fitsimage, outfile='', dropdeg=False):
+    """
+    Primary-beam correct ``imagename`` by ``pbimage`` (like ``impbcor``) and
+    export the result to ``fitsimage``.  The corrected CASA image is only
+    kept if ``outfile`` is given.
+    """
+    ia = iatool()
+    ia.open(imagename)
+    try:
+        pbcor = ia.pbcor(pbimage=pbimage, outfile=outfile, overwrite=True)
+        try:
+            tofits(pbcor, fitsimage, dropdeg)
+        finally:
+            pbcor.done()
+    finally:
+        ia.close()
+        ia.done()
+    return fitsimage
+
+
+def remove_image(imagename):
+    if os.path.isdir(imagename):
+        shutil.rmtree(imagename)
+    elif os.path.exists(imagename):
+        os.remove(imagename)
+
+
+def export_products(myimagebase, suffixes, pbcor=None, pbcor_image=False,
+                    dropdeg=False, remove=(), nthreads=None):
+    """
+    Export ``myimagebase+suffix`` to ``myimagebase+suffix+'.fits'`` for each
+    of ``suffixes`` that exists, and, if ``pbcor`` is an (image suffix, pb
+    suffix) pair, the primary-beam corrected image to
+    ``myimagebase+image suffix+'.pbcor.fits'`` (also keeping the CASA image
+    ``myimagebase+image suffix+'.pbcor'`` if ``pbcor_image``).  Once all of
+    them are written, the CASA images ``myimagebase+suffix`` for ``suffix`` in
+    ``remove`` are deleted.
+
+    Returns the FITS files written.
+    """
+    if nthreads is None:
+        nthreads = int(os.getenv('EXPORT_THREADS', 4))
+
+    pool = ThreadPool(processes=nthreads)
+    try:
+        jobs = []
+        if pbcor is not None:
+            imagename, pbimage = [myimagebase+suffix for suffix in pbcor]
+            if os.path.exists(imagename) and os.path.exists(pbimage):
+                outfile = imagename+'.pbcor' if pbcor_image else ''
+                jobs.append(pool.apply_async(export_pbcor,
+                                             (imagename, pbimage,
+                                              imagename+'.pbcor.fits',
+                                              outfile, dropdeg)))
+            else:
+                casalog.post("Cannot primary-beam correct {0}: missing {1} or {2}"
+                             .format(myimagebase, imagename, pbimage),
+                             origin='export_products', priority='WARN')
+
+        for suffix in suffixes:
+            imagename = myimagebase+suffix
+            if os.path.exists(imagename):
+                jobs.append(pool.apply_async(export_image,
+                                             (imagename, imagename+'.fits',
+                                              dropdeg)))
+
+        # re-raises any export failure, before anything is removed
+        fitsfiles = [job.get() for job in jobs]
+
+        pool.map(remove_image, [myimagebase+suffix for suffix in remove])
+    finally:
+        pool.close()
+        pool.join()
+
+    return fitsfiles
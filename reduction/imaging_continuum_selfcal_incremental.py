@@ -30,6 +30,7 @@ msmd = msmdtool()
 assert os.getenv('SCRIPT_DIR') is not None
 sys.path.append(os.getenv('SCRIPT_DIR'))
 from continuum_imaging_general import myclean, makefits
+from selfcal_engine import run_selfcal, from_tuples
 from continuum_windows import Qmses
 
 from astropy.io import fits
@@ -41,6 +42,82 @@ def logprint(string, origin='imaging_continuum_selfcal_incremental',
     casalog.post(string, origin=origin, priority=priority)
 
 
+def selfcal_image(vis, name, threshold, nterms, phasecenter, imsize, mask):
+    """
+    Clean one self-calibration iteration with mtmfs, writing its model to the
+    MS, and check that the model is positive
+    """
+    output = myimagebase = imagename = name
+    logprint("Working on {0}".format(myimagebase))
+
+    for ttsuffix in ('.tt0', '.tt1', '.tt2'):
+        for suffix in ('pb{tt}', 'weight', 'sumwt{tt}', 'psf{tt}',
+                       'model{tt}', 'mask', 'image{tt}', 'residual{tt}',
+                       'image{tt}.pbcor',
+                       'alpha', ):
+            rmfile = "{0}.{1}".format(output, suffix).format(tt=ttsuffix)
+            if os.path.exists(rmfile):
+                logprint("Removing {0}".format(rmfile))
+                os.system('rm -rf {0}'.format(rmfile))
+
+    tclean(vis=vis,
+           imagename=imagename,
+           # use all fields # field=field,
+           field="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q,Sgr B2 S Q",
+           spw='',
+           weighting='briggs',
+           robust=0.0,
+           phasecenter=phasecenter,
+           imsize=imsize,
+           cell=['0.01 arcsec'],
+           threshold=threshold,
+           niter=100000,
+           #gridder='wproject',
+           gridder='standard',
+           #wprojplanes=32,
+           specmode='mfs',
+           deconvolver='mtmfs',
+           outframe='LSRK',
+           savemodel='modelcolumn',
+           scales=[0,3,9,27],
+           nterms=nterms,
+           selectdata=True,
+           mask=mask,
+          )
+    makefits(myimagebase)
+
+    modelim = fits.open(imagename+".model.tt0.fits")
+    mx = modelim[0].data.max()
+    logprint("max value in model: {0}".format(mx))
+    assert mx > 0
+
+    # cleanimage = myimagebase+'.image.tt0'
+    # ia.open(cleanimage)
+    # ia.calcmask(mask=cleanimage+" > {0}".format(float(threshold.split()[0])/1000),
+    #             name='clean_mask_iter{0}_{1}'.format(iternum, field_nospace))
+
+    # ia.close()
+    # makemask(mode='copy', inpimage=cleanimage,
+    #          inpmask=cleanimage+":clean_mask_iter{0}_{1}".format(iternum, field_nospace),
+    #          output='clean_mask_{0}_{1}.mask'.format(iternum, field_nospace),
+    #          overwrite=True)
+    # mask = 'clean_mask_{0}_{1}.mask'.format(iternum, field_nospace)
+    # exportfits(mask, mask+'.fits', dropdeg=True, overwrite=True)
+
+    if not os.path.exists(myimagebase+".model.tt0"):
+        if os.path.exists(myimagebase+".model.tt0.fits"):
+            importfits(fitsimage=myimagebase+".model.tt0.fits",
+                       imagename=myimagebase+".model.tt0")
+        else:
+            raise IOError("Missing model image file & model FITS image")
+    ia.open(myimagebase+".model.tt0")
+    stats = ia.statistics()
+    if stats['min'] < 0:
+        logprint("Negative model component encountered: {0}.".format(stats['min']))
+    logprint(str(stats))
+    ia.close()
+
+
 mses = list(Qmses.keys())
 
 fullpath_mses = ['../' + ms[:-3] + "_continuum.ms"
@@ -56,9 +133,6 @@ if not os.path.exists(cont_vis):
     assert split(vis=raw_and_corr_vis, outputvis=cont_vis,
                  datacolumn='corrected')
 
-caltables = []
-calinfo = {}
-
 thresholds = {'Sgr B2 MS Q': (3.0,2.5,2.0,1.5,1.0,1.0,1.0,0.75,0.75,0.75,0.5,0.5,0.5),
              }
 mask_threshold = {'Sgr B2 MS Q': 4.0,
@@ -76,10 +150,55 @@ phasecenter ={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
 
 field_list = ['Sgr B2 MS Q']
 
-
-msmd.open(selfcal_vis)
-nspws = msmd.nspw()
-msmd.close()
+selfcal_tuples = [#(0, 2, '{0} mJy','amp','a', 'inf', 'spw',),
+                 #(1, 2, '{0} mJy','bandpass', 'ap', 'inf', '',),
+                 #(2, 2, '{0} mJy','amp','a', '240s', 'scan',),
+                 #(2, 2, '{0} mJy','phase','p', '240s', 'scan',),
+                 #(3, 2, '{0} mJy','ampphase','ap', 'inf', '',),
+                 (0, 2, '{0} mJy','phase','p', '60s', '',),
+                 (1, 2, '{0} mJy','phase','p', '60s', '',),
+                 (2, 2, '{0} mJy','phase','p', '60s', '',),
+                 (3, 2, '{0} mJy','phase','p', '60s', '',),
+                 (4, 2, '{0} mJy','phase','p', '60s', '',),
+                 (5, 2, '{0} mJy','phase','p', '30s', '',),
+                 (6, 2, '{0} mJy','phase','p', '30s', '',),
+                 (7, 2, '{0} mJy','phase','p', '30s', '',),
+                 (8, 2, '{0} mJy','phase','p', '30s', '',),
+                 (9, 2, '{0} mJy','phase','p', '30s', '',),
+                 (10, 2, '{0} mJy','phase','p', '30s', '',),
+                 (11, 2, '{0} mJy','phase','p', '30s', '',),
+                 (12, 2, '{0} mJy','phase','p', '30s', '',),
+                 #(13, 2, '{0} mJy','phase','p', '20s', '',),
+                 #(14, 2, '{0} mJy','phase','p', '10s', '',),
+                 #(15, 2, '{0} mJy','phase','p', '10s', '',),
+                 #(16, 2, '{0} mJy','amp','a', 'inf', 'scan',),
+                 #(17, 2, '{0} mJy','amp','a', 'inf', 'scan',),
+                 # bandpass goes wanky (16, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
+                 # bandpass goes wanky (17, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
+                 # bandpass goes wanky (18, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
+                 # bandpass goes wanky (19, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
+                 # bandpass goes wanky (20, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
+                 # bandpass goes wanky (21, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
+                 # bandpass goes wanky (22, 2, '{0} mJy','phase','p', '30s', '',),
+                 # bandpass goes wanky (23, 2, '{0} mJy','phase','p', '30s', '',),
+                 #(20, 2, '{0} mJy','bandpass','', 'inf', 'scan',),
+                 #(7, 2, '{0} mJy','ampphase', 'ap', 'inf', '',),
+                 #(8, 2, '{0} mJy','ampphase', 'ap', 'inf', '',),
+                 #(9, 3, '{0} mJy','ampphase', 'ap', 'inf', '',),
+                 #(10, 3, '{0} mJy','ampphase', 'ap', 'inf', '',),
+                 #(5, 2, '{0} mJy','ampphase','ap', '120s', '',),
+                 #(6, 2, '{0} mJy','ampphase','ap', '120s', '',),
+                 #(7, 2, '{0} mJy','ampphase','ap', '120s', '',),
+                 #(8, 2, '{0} mJy','ampphase','ap', '30s', '',),
+                 #(9, 2, '{0} mJy','ampphase','ap', 'int', '',),
+                 #(10, 3, '{0} mJy','bandpass', 'ap', 'inf', '',),
+                 #(11, 3, '{0} mJy','bandpass', 'ap', 'inf', '',),
+                 #(12, 3, '{0} mJy','bandpass', 'ap', 'inf', '',),
+                ]
+
+
+# each solve runs a gaincal per table and epoch; at most this many at once
+selfcal_nprocs = int(os.getenv('NPROCS', 4))
 
 for field in field_list:
     logprint("Beginning main loop for field: {0}".format(field),
@@ -169,211 +288,37 @@ for field in field_list:
 
 
     # must iterate over fields separately because the mask name is being set and reset
-    for iternum, nterms, threshold, caltype, calmode, solint, combine in [#(0, 2, '{0} mJy','amp','a', 'inf', 'spw',),
-                                                                          #(1, 2, '{0} mJy','bandpass', 'ap', 'inf', '',),
-                                                                          #(2, 2, '{0} mJy','amp','a', '240s', 'scan',),
-                                                                          #(2, 2, '{0} mJy','phase','p', '240s', 'scan',),
-                                                                          #(3, 2, '{0} mJy','ampphase','ap', 'inf', '',),
-                                                                          (0, 2, '{0} mJy','phase','p', '60s', '',),
-                                                                          (1, 2, '{0} mJy','phase','p', '60s', '',),
-                                                                          (2, 2, '{0} mJy','phase','p', '60s', '',),
-                                                                          (3, 2, '{0} mJy','phase','p', '60s', '',),
-                                                                          (4, 2, '{0} mJy','phase','p', '60s', '',),
-                                                                          (5, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          (6, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          (7, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          (8, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          (9, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          (10, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          (11, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          (12, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          #(13, 2, '{0} mJy','phase','p', '20s', '',),
-                                                                          #(14, 2, '{0} mJy','phase','p', '10s', '',),
-                                                                          #(15, 2, '{0} mJy','phase','p', '10s', '',),
-                                                                          #(16, 2, '{0} mJy','amp','a', 'inf', 'scan',),
-                                                                          #(17, 2, '{0} mJy','amp','a', 'inf', 'scan',),
-                                                                          # bandpass goes wanky (16, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
-                                                                          # bandpass goes wanky (17, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
-                                                                          # bandpass goes wanky (18, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
-                                                                          # bandpass goes wanky (19, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
-                                                                          # bandpass goes wanky (20, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
-                                                                          # bandpass goes wanky (21, 2, '{0} mJy','bandpass','', 'inf', 'scan,obs',),
-                                                                          # bandpass goes wanky (22, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          # bandpass goes wanky (23, 2, '{0} mJy','phase','p', '30s', '',),
-                                                                          #(20, 2, '{0} mJy','bandpass','', 'inf', 'scan',),
-                                                                          #(7, 2, '{0} mJy','ampphase', 'ap', 'inf', '',),
-                                                                          #(8, 2, '{0} mJy','ampphase', 'ap', 'inf', '',),
-                                                                          #(9, 3, '{0} mJy','ampphase', 'ap', 'inf', '',),
-                                                                          #(10, 3, '{0} mJy','ampphase', 'ap', 'inf', '',),
-                                                                          #(5, 2, '{0} mJy','ampphase','ap', '120s', '',),
-                                                                          #(6, 2, '{0} mJy','ampphase','ap', '120s', '',),
-                                                                          #(7, 2, '{0} mJy','ampphase','ap', '120s', '',),
-                                                                          #(8, 2, '{0} mJy','ampphase','ap', '30s', '',),
-                                                                          #(9, 2, '{0} mJy','ampphase','ap', 'int', '',),
-                                                                          #(10, 3, '{0} mJy','bandpass', 'ap', 'inf', '',),
-                                                                          #(11, 3, '{0} mJy','bandpass', 'ap', 'inf', '',),
-                                                                          #(12, 3, '{0} mJy','bandpass', 'ap', 'inf', '',),
-                                                                         ]:
-        threshold = threshold.format(thresholds[field][iternum])
-        output = myimagebase = imagename = '{0}_QbandAarray_cont_spws_continuum_cal_clean_{2}terms_robust0_incrementalselfcal{1}'.format(field_nospace, iternum, nterms)
-
-        logprint("Working on {0}".format(myimagebase))
-
-        if os.path.exists(imagename+".image.tt0"):
-            #mask = 'clean_mask_{0}_{1}.mask'.format(iternum, field_nospace)
-            #outputvis = selfcal_vis.replace(".ms", "_{1}_selfcal{0}.ms".format(iternum, field_nospace))
-            #selfcal_vis = outputvis
-            caltable = '{2}_{1}_{0}_{3}.cal'.format(field_nospace, iternum, caltype, solint)
-            if not os.path.exists(caltable):
-                print('Does caltable {0} exist? {1}'.format(caltable, os.path.exists(caltable)))
-                try:
-                    logprint(os.listdir(caltable))
-                except Exception as ex:
-                    logprint(str(ex), priority='ERROR')
-                logprint(os.listdir(imagename+".image.tt0"))
-                logprint("Calibration table {1} does not exist but image does.  Remove images with "
-                         "suffix {0}".format(imagename, caltable), priority="SEVERE")
-                raise ValueError("Calibration table {1} does not exist but image does.  Remove images with "
-                                 "suffix {0}".format(imagename, caltable))
-            caltables.append(caltable)
-            calinfo[iternum] = {'combine':combine,}
-            logprint("Skipping {0}".format(myimagebase))
-            logprint("caltables set to {0}, calinfo set to {1}"
-                     .format(caltables, calinfo))
-            continue
-
-        if len(caltables) > 0:
-            logprint("Applying caltables {0}".format(caltables))
-            applycal(vis=selfcal_vis,
-                     # use all fields # field=field,
-                     gaintable=caltables,
-                     spwmap=[[0]*nspws if calinfo[ii]['combine']=='spw' else [] for ii in range(len(caltables))],
-                     interp='linear,linear', #['linearperobs,linear' if combine=='spw' else 'linearperobs,linear']*len(caltables),
-                     applymode='calonly', calwt=True)
-
-
-
-        for ttsuffix in ('.tt0', '.tt1', '.tt2'):
-            for suffix in ('pb{tt}', 'weight', 'sumwt{tt}', 'psf{tt}',
-                           'model{tt}', 'mask', 'image{tt}', 'residual{tt}',
-                           'image{tt}.pbcor',
-                           'alpha', ):
-                rmfile = "{0}.{1}".format(output, suffix).format(tt=ttsuffix)
-                if os.path.exists(rmfile):
-                    logprint("Removing {0}".format(rmfile))
-                    os.system('rm -rf {0}'.format(rmfile))
-
-        tclean(vis=selfcal_vis,
-               imagename=imagename,
-               # use all fields # field=field,
-               field="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q,Sgr B2 S Q",
-               spw='',
-               weighting='briggs',
-               robust=0.0,
-               phasecenter=phasecenter[field],
-               imsize=imsize[field],
-               cell=['0.01 arcsec'],
-               threshold=threshold,
-               niter=100000,
-               #gridder='wproject',
-               gridder='standard',
-               #wprojplanes=32,
-               specmode='mfs',
-               deconvolver='mtmfs',
-               outframe='LSRK',
-               savemodel='modelcolumn',
-               scales=[0,3,9,27],
-               nterms=nterms,
-               selectdata=True,
-               mask=mask,
-              )
-        makefits(myimagebase)
-
-        modelim = fits.open(imagename+".model.tt0.fits")
-        mx = modelim[0].data.max()
-        logprint("max value in model: {0}".format(mx))
-        assert mx > 0
-
-        caltable = '{2}_{1}_{0}.cal'.format(field_nospace, iternum, caltype)
-        rmtables([caltable])
-        if 'phase' in caltype or 'amp' in caltype:
-            gaincal(vis=selfcal_vis, caltable=caltable, solint=solint,
-                    combine=combine,
-                    gaintype='G',
-                    # use all fields field=field,
-                    calmode=calmode,
-                    gaintable=caltables,
-                    minsnr=1.5,
-                    spwmap=[[0]*nspws if calinfo[ii]['combine']=='spw' else [] for ii in range(len(caltables))],
-                    interp='linear,linear',
-                    solnorm=True)
-            if 'amp' in caltype:
-                # avoid extreme outliers: assume anything going more than 2x in either direction is wrong
-                flagdata(caltable, mode='clip', clipminmax=[0.5, 2.0], datacolumn='CPARAM')
-        elif 'bandpass' in caltype:
-            bandpass(vis=selfcal_vis, caltable=caltable,
-                     solint='{0},16ch'.format(solint), combine=combine,
-                     # use all fields # field=field,
-                     #refant='ea07',
-                     gaintable=caltables,
-                     minsnr=1.5,
-                     spwmap=[[0]*nspws if calinfo[ii]['combine']=='spw' else [] for ii in range(len(caltables))],
-                     interp='linear,linear',
-                     solnorm=True)
-            # avoid extreme outliers: assume anything going more than 2x in either direction is wrong
-            flagdata(caltable, mode='clip', clipminmax=[0.5, 2.0], datacolumn='CPARAM')
-
-        # do a purely diagnostic gaincal
-        gaincal(vis=selfcal_vis,
-                caltable='ampcal_diagnostic_iter{0}.cal'.format(iternum),
-                gaintype='G',
-                combine='spw,scan,field',
-                solint='inf',
-                calmode='a',
-                gaintable=caltables,
-                spwmap=[[0]*nspws if calinfo[ii]['combine']=='spw' else [] for ii in range(len(caltables))],
-                interp='linear,linear',
-                solnorm=True)
-
-        if not os.path.exists(caltable):
-            logprint("Calibration table {0} does not exist".format(caltable),
-                     priority="ERROR")
-            raise ValueError("Calibration table {0} does not exist".format(caltable))
-
-        caltables.append(caltable)
-        calinfo[iternum] = {'combine':combine,}
-        logprint("Calibration Information exists for these: {0}".format(calinfo.keys()))
-
-        # cleanimage = myimagebase+'.image.tt0'
-        # ia.open(cleanimage)
-        # ia.calcmask(mask=cleanimage+" > {0}".format(float(threshold.split()[0])/1000),
-        #             name='clean_mask_iter{0}_{1}'.format(iternum, field_nospace))
-
-        # ia.close()
-        # makemask(mode='copy', inpimage=cleanimage,
-        #          inpmask=cleanimage+":clean_mask_iter{0}_{1}".format(iternum, field_nospace),
-        #          output='clean_mask_{0}_{1}.mask'.format(iternum, field_nospace),
-        #          overwrite=True)
-        # mask = 'clean_mask_{0}_{1}.mask'.format(iternum, field_nospace)
-        # exportfits(mask, mask+'.fits', dropdeg=True, overwrite=True)
-
-        if not os.path.exists(myimagebase+".model.tt0"):
-            if os.path.exists(myimagebase+".model.tt0.fits"):
-                importfits(fitsimage=myimagebase+".model.tt0.fits",
-                           imagename=myimagebase+".model.tt0")
-            else:
-                raise IOError("Missing model image file & model FITS image")
-        ia.open(myimagebase+".model.tt0")
-        stats = ia.statistics()
-        if stats['min'] < 0:
-            logprint("Negative model component encountered: {0}.".format(stats['min']))
-        logprint(str(stats))
-        ia.close()
-
-        #outputvis = selfcal_vis.replace(".ms", "_{1}_selfcal{0}.ms".format(iternum, field_nospace))
-        #split(vis=selfcal_vis, outputvis=outputvis, field=field,
-        #      datacolumn='corrected')
-        #selfcal_vis = outputvis
+    schedule = from_tuples(selfcal_tuples, thresholds[field])
+    caltables = run_selfcal(vis=selfcal_vis,
+                            schedule=schedule,
+                            imagename='{0}_QbandAarray_cont_spws_continuum_cal_clean_{{nterms}}terms_robust0_incrementalselfcal{{iternum}}'.format(field_nospace),
+                            caltable='{{caltype}}_{{iternum}}_{0}.cal'.format(field_nospace),
+                            image=selfcal_image,
+                            image_kwargs=dict(phasecenter=phasecenter[field],
+                                              imsize=imsize[field],
+                                              mask=mask),
+                            image_markers=lambda name, **kwargs: [name+".image.tt0.pbcor.fits"],
+                            gaincal_kwargs=dict(gaintype='G',
+                                                # use all fields field=field,
+                                                minsnr=1.5,
+                                                interp='linear,linear',
+                                                solnorm=True),
+                            apply_kwargs=dict(# use all fields # field=field,
+                                              interp='linear,linear', #['linearperobs,linear' if combine=='spw' else 'linearperobs,linear']*len(caltables),
+                                              applymode='calonly', calwt=True),
+                            # do a purely diagnostic gaincal
+                            diagnostic=dict(caltable='ampcal_diagnostic_iter{iternum}.cal',
+                                            gaintype='G',
+                                            combine='spw,scan,field',
+                                            solint='inf',
+                                            calmode='a',
+                                            interp='linear,linear',
+                                            solnorm=True),
+                            accumulate=True,
+                            nprocs=selfcal_nprocs,
+                           )
+    logprint("caltables set to {0}".format(caltables))
+    iternum = schedule[-1]['iternum']
 
 
 
@@ -0,0 +1,236 @@
+"""
+A work queue for independent imaging jobs, run either on a local process pool
+or as a PBS array job.
+
+A job is a (JSON-serializable) dict with at least a unique ``name``, its
+estimated peak ``memory`` in GB and a ``marker``, the file whose existence
+means the job is done (e.g. the exported ``.image.pbcor.fits``); jobs whose
+marker exists are never run (a stricter ``is_done(job)`` test, e.g. one
+checking the job's clean manifest, can be given instead).  The function
+running a job must be defined at module level so it can be sent to the
+workers.
+
+Locally, `run_local` keeps up to ``nprocs`` jobs running at once, each in its
+own process, as long as their memory estimates fit in the node's budget (a
+job larger than the budget runs alone); a job whose process dies is reported
+as failed.  `write_pbs_array` instead writes the pending jobs to a JSON file
+and a PBS script with one array task per job, each requesting the memory of
+the largest job so that the scheduler packs as many as fit onto each node;
+every task runs the calling script with IMAGING_JOBFILE and IMAGING_JOB set,
+and the script runs that one job with `run_job_from_env`.
+
+The node budget defaults to the NODE_MEMORY_GB (30) and NODE_CORES (8)
+environment variables.
+"""
+import os
+import time
+import json
+import multiprocessing
+
+node_memory_gb = float(os.getenv('NODE_MEMORY_GB', 30))
+node_cores = int(os.getenv('NODE_CORES', 8))
+
+pbs_template = """#!/bin/sh
+#PBS -l mem={memory}gb
+#PBS -l nodes=1:ppn={ppn}
+#PBS -d {workdir}
+#PBS -N {jobname}
+#PBS -t 0-{last}{limit}
+#PBS -m a
+
+cd {workdir}
+echo {workdir} ${{PBS_ARRAYID}}
+
+export SCRIPT_DIR="{script_dir}"
+export IMAGING_JOBFILE="{jobfile}"
+export IMAGING_JOB=${{PBS_ARRAYID}}
+
+# casa's python requires a DISPLAY for matplot so create a virtual X server
+xvfb-run -d casa-prerelease --nogui --nologger -c "execfile('{script}')"
+"""
+
+
+def marker_exists(job):
+    return os.path.exists(job['marker'])
+
+
+def pending(jobs, is_done=None):
+    """ The jobs that are not done (by default: whose marker does not exist) """
+    if is_done is None:
+        is_done = marker_exists
+    return [job for job in jobs if not is_done(job)]
+
+
+def _run_job(args):
+    func, job = args
+    t0 = time.time()
+    try:
+        result = func(job)
+    except Exception as ex:
+        # one failed job should not stop the others
+        return (job['name'], time.time() - t0,
+                "{0}: {1}".format(type(ex).__name__, ex), None)
+    return job['name'], time.time() - t0, None, result
+
+
+def _job_process(conn, func, job, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    conn.send(_run_job((func, job)))
+    conn.close()
+
+
+def _finished(entry, t0):
+    """
+    The result of a job process, or None if it is still running.  A process
+    that exits without sending its result (killed by the OOM killer, a
+    segfault in a task, ...) is reported as a failed job.
+    """
+    proc, conn, job = entry
+    if not conn.poll():
+        if proc.is_alive():
+            return None
+    try:
+        # the pipe is also readable (at EOF) once a dead worker's end closed
+        result = conn.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    conn.close()
+    if result is None:
+        if proc.exitcode < 0:
+            error = "worker killed by signal {0}".format(-proc.exitcode)
+        else:
+            error = "worker exited with status {0}".format(proc.exitcode)
+        result = (job['name'], time.time() - t0, error, None)
+    return result
+
+
+def run_local(func, jobs, nprocs=None, memory_gb=None, poll=5, is_done=None,
+              initializer=None, initargs=()):
+    """
+    Run ``func(job)`` for every pending job, each in a fresh worker process,
+    with at most ``nprocs`` (default: NPROCS or `node_cores`) jobs and
+    ``memory_gb`` (default: `node_memory_gb`) of estimated memory in use at
+    once.  The biggest jobs are started first, and smaller ones fill the
+    remaining memory.  ``initializer(*initargs)`` is run in each worker.  A
+    worker that dies (e.g. when it is OOM-killed) fails its job.
+
+    Returns a list of (name, wall time, error or None, return value of
+    ``func``) in the order the jobs finished.
+    """
+    if nprocs is None:
+        nprocs = int(os.getenv('NPROCS', node_cores))
+    if memory_gb is None:
+        memory_gb = node_memory_gb
+
+    queue = sorted(pending(jobs, is_done), key=lambda job: -job['memory'])
+    print("{0} of {1} jobs to run".format(len(queue), len(jobs)))
+    if not queue:
+        return []
+
+    results = []
+    # (process, pipe, job, start time)
+    running = []
+    t0 = time.time()
+    try:
+        while queue or running:
+            for entry in list(running):
+                result = _finished(entry[:3], entry[3])
+                if result is None:
+                    continue
+                running.remove(entry)
+                results.append(result)
+                print("{0:10.1f}s {1} {2}".format(results[-1][1], results[-1][0],
+                                                  results[-1][2] or 'done'))
+
+            used = sum(entry[2]['memory'] for entry in running)
+            for job in list(queue):
+                if len(running) >= nprocs:
+                    break
+                if running and used + job['memory'] > memory_gb:
+                    continue
+                # a fresh process per job, so its memory is returned when it
+                # finishes and its exit status tells whether it died
+                recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+                proc = multiprocessing.Process(target=_job_process,
+                                               args=(send_conn, func, job,
+                                                     initializer, initargs))
+                proc.start()
+                send_conn.close()
+                running.append((proc, recv_conn, job, time.time()))
+                used += job['memory']
+                queue.remove(job)
+
+            if running:
+                time.sleep(poll)
+    finally:
+        for proc, conn, job, start in running:
+            proc.terminate()
+            proc.join()
+
+    print("Ran {0} jobs in {1:0.1f}s; {2} failed"
+          .format(len(results), time.time()-t0,
+                  sum(error is not None for _, _, error, _ in results)))
+    return results
+
+
+def write_pbs_array(jobs, script, jobfile='imaging_jobs.json',
+                    pbsfile='imaging_jobs.pbs', jobname='sb2_18A229_img',
+                    workdir=None, script_dir=None, ppn=1, max_concurrent=None,
+                    is_done=None):
+    """
+    Write the pending ``jobs`` to ``jobfile`` and a PBS array script running
+    ``script`` once per job to ``pbsfile`` (submit it with ``qsub``).  Each
+    task requests the memory of the largest job, capped at `node_memory_gb`,
+    and ``ppn`` cores; ``max_concurrent`` limits the number of tasks running
+    at once.  Returns the number of jobs written.
+    """
+    if workdir is None:
+        workdir = os.getcwd()
+    if script_dir is None:
+        script_dir = os.getenv('SCRIPT_DIR', os.path.dirname(os.path.abspath(script)))
+
+    jobs = pending(jobs, is_done)
+    if not jobs:
+        return 0
+
+    with open(jobfile, 'w') as fh:
+        json.dump(jobs, fh, indent=1)
+
+    memory = min(node_memory_gb, max(job['memory'] for job in jobs))
+    with open(pbsfile, 'w') as fh:
+        fh.write(pbs_template.format(memory=int(memory + 0.999), ppn=ppn,
+                                     workdir=workdir, jobname=jobname[:15],
+                                     last=len(jobs)-1,
+                                     limit=('%{0}'.format(max_concurrent)
+                                            if max_concurrent else ''),
+                                     script_dir=script_dir,
+                                     jobfile=os.path.abspath(jobfile),
+                                     script=os.path.abspath(script)))
+    return len(jobs)
+
+
+def run_job_from_env(func, is_done=None):
+    """
+    In a PBS array task (IMAGING_JOBFILE and IMAGING_JOB set), run ``func`` on
+    this task's job, unless it is already done.  Returns False if this is not
+    an array task.
+    """
+    jobfile = os.getenv('IMAGING_JOBFILE')
+    index = os.getenv('IMAGING_JOB')
+    if jobfile is None or index is None:
+        return False
+
+    with open(jobfile, 'r') as fh:
+        job = json.load(fh)[int(index)]
+
+    if (is_done or marker_exists)(job):
+        print("Skipping {0} because it's done".format(job['name']))
+        return True
+
+    name, elapsed, error, _ = _run_job((func, job))
+    print("{0:10.1f}s {1} {2}".format(elapsed, name, error or 'done'))
+    if error is not None:
+        raise RuntimeError(error)
+    return True
@@ -0,0 +1,95 @@
+"""
+The lines imaged by maserline_imaging.py: one entry per line, in place of one
+hand-written ``*clean`` function (with its own hard-coded spw numbers) per
+line.
+
+Each entry gives the band, the rest frequency (informational; ``None`` for
+the highly excited Ka-band NH3 lines), the frequency used to find the line's
+spw in each MS (``spwfreq``: the rest frequency where it lies inside the spw,
+otherwise the listobs centre frequency of the spw; see the tables at the end
+of maserline_imaging.py), the minimum number of channels of that spw where it
+is not the default 255 (so the 64-channel continuum windows covering the same
+frequency are never picked), optionally the peak memory (``memory_gb``) of
+imaging one field, and any imaging parameters that differ from the band
+defaults in `band_defaults`.
+
+The spws themselves are looked up per MS by `utilities.match_spws`, which
+caches the spw table of each MS, so the same entry works for every MS and
+every combination of them.
+"""
+
+# imaging defaults per band; the K-band images cover a much larger area, so
+# they need to be bigger
+band_defaults = {
+    'Q': {'fields': ["Sgr B2 N Q", "Sgr B2 NM Q", "Sgr B2 MS Q"],
+          'imsize': 2000, 'cell': '0.04arcsec'},
+    'KA': {'fields': ['Sgr B2 MN Ka', 'Sgr B2 MS Ka'],
+           'imsize': 2000, 'cell': '0.04arcsec'},
+    'K': {'fields': ['Sgr B2 MN K', 'Sgr B2 SDS K'],
+          'imsize': 3000, 'cell': '0.04arcsec'},
+}
+
+line_catalog = {
+    # Q-band
+    'SiOv=1': dict(band='Q', restfreq=43.12203e9, spwfreq=43.12203e9,
+                   chanchunks=8),
+    'SiOv=2': dict(band='Q', restfreq=42.82048e9, spwfreq=42.82048e9,
+                   chanchunks=8),
+    'CH3OH44.1': dict(band='Q', restfreq=44.06949e9, spwfreq=44.06949e9,
+                      chanchunks=8),
+    'CH3OH48.4': dict(band='Q', restfreq=48.372456e9, spwfreq=48.372456e9,
+                      chanchunks=8),
+    # the spw labelled CS 1-0 starts above the line's rest frequency
+    'CS1-0': dict(band='Q', restfreq=48.990955e9, spwfreq=49.0073158e9,
+                  min_chan=128, chanchunks=8),
+
+    # Ka-band
+    'CH3OH36.1': dict(band='KA', restfreq=36.169265e9, spwfreq=36.1636861e9),
+    'SO10_01': dict(band='KA', restfreq=30.001580e9, spwfreq=29.9968804e9),
+    'NH3_1414': dict(band='KA', restfreq=None, spwfreq=35.1288504e9),
+    'NH3_1918': dict(band='KA', restfreq=None, spwfreq=36.2758624e9),
+    'NH3_1212': dict(band='KA', restfreq=None, spwfreq=31.4200535e9),
+    'NH3_1313': dict(band='KA', restfreq=None, spwfreq=33.1516859e9),
+    'NH3_1615': dict(band='KA', restfreq=None, spwfreq=30.5326751e9),
+    'NH3_1716': dict(band='KA', restfreq=None, spwfreq=32.2141778e9),
+    'NH3_1817': dict(band='KA', restfreq=None, spwfreq=34.1221279e9),
+
+    # K-band
+    'H2O': dict(band='K', restfreq=22.23508e9, spwfreq=22.2331e9,
+                cell='0.1arcsec', imsize=1000, chanchunks=16),
+    'NH3_11': dict(band='K', restfreq=23.6944955e9, spwfreq=23.6923e9),
+    'NH3_21': dict(band='K', restfreq=23.098815e9, spwfreq=23.0968e9),
+    'NH3_22': dict(band='K', restfreq=23.722633335e9, spwfreq=23.7205e9),
+    'NH3_32': dict(band='K', restfreq=22.8341851e9, spwfreq=22.8287e9),
+    'NH3_44': dict(band='K', restfreq=24.1394169e9, spwfreq=24.1371e9,
+                   min_chan=128),
+    'NH3_53': dict(band='K', restfreq=21.285275e9, spwfreq=21.2834e9,
+                   min_chan=128),
+    'NH3_54': dict(band='K', restfreq=22.653022e9, spwfreq=22.6510e9,
+                   min_chan=128),
+    'NH3_55': dict(band='K', restfreq=24.53299e9, spwfreq=24.5307e9),
+    # only in the 03_29 MS; the spw labelled NH3 65 does not cover 22.732 GHz
+    'NH3_65': dict(band='K', restfreq=22.732429e9, spwfreq=22.7807e9),
+    'NH3_77': dict(band='K', restfreq=25.71518e9, spwfreq=25.7128e9),
+}
+
+# the keys of an entry that are not imaging (tclean / myclean) parameters
+catalog_keys = ('band', 'restfreq', 'spwfreq', 'min_chan', 'memory_gb')
+
+
+def lines_in_band(band):
+    """ The sorted names of the catalog lines in ``band`` """
+    return sorted(linename for linename, entry in line_catalog.items()
+                  if entry['band'] == band.upper())
+
+
+def imaging_parameters(linename):
+    """
+    The myclean parameters of ``linename``: its band's defaults updated with
+    the entry's own parameters
+    """
+    entry = line_catalog[linename]
+    params = dict(band_defaults[entry['band']])
+    params.update({key: value for key, value in entry.items()
+                   if key not in catalog_keys})
+    return params
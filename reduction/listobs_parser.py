@@ -1,46 +1,202 @@
+"""
+Parse the text output of CASA's listobs into columnar tables.
+
+`read_listobs` reads a listobs file in a single pass and returns a flat dict of
+numpy arrays, one per column, prefixed by table name (``spw_``, ``field_``,
+``scan_``, ``antenna_``).  `load_listobs` wraps it with an ``.npz`` cache kept
+next to the listobs file, so repeated runs over all of the EB directories only
+have to load the cache.
+"""
+import os
+import re
+import numpy as np
+
+scan_re = re.compile(r"^\s+(?:(?P<date>\d\d-\w\w\w-\d\d\d\d)/)?"
+                     r"(?P<start>\d\d:\d\d:\d\d\.\d)\s+-\s+"
+                     r"(?P<end>\d\d:\d\d:\d\d\.\d)\s+"
+                     r"(?P<scan>\d+)\s+(?P<fieldid>\d+)\s+(?P<field>.+?)\s+"
+                     r"(?P<nrows>\d+)\s+\[(?P<spws>[0-9, ]*)\]")
+antenna_re = re.compile(r"^\s+(?P<id>\d+)\s+(?P<name>\S+)\s+(?P<station>\S+)\s+"
+                        r"(?P<diam>[0-9.]+)\s*m\s")
+compact_antenna_re = re.compile(r"^\s+ID=\s*(?P<id>\d+)-\d+:")
+compact_antenna_pair_re = re.compile(r"'([^']+)'='([^']+)'")
+
+# column name -> dtype for each table in the record
+columns = {'spw': (('id', int), ('name', str), ('nchan', int),
+                   ('frame', str), ('ch0', float), ('chanwid', float),
+                   ('bw', float), ('freq', float), ('bbcnum', int),
+                   ('band', str), ('baseband', str)),
+           'field': (('id', int), ('code', str), ('name', str),
+                     ('ra', str), ('dec', str), ('epoch', str),
+                     ('srcid', int), ('nrows', int)),
+           'scan': (('scan', int), ('date', str), ('start', str),
+                    ('end', str), ('fieldid', int), ('field', str),
+                    ('nrows', int), ('spws', str), ('intent', str)),
+           'antenna': (('id', int), ('name', str), ('station', str),
+                       ('diam', float)),
+          }
+
+cache_version = 1
+
+
+def read_listobs(fn):
+    """
+    Read a listobs file once, splitting each row only once, and return a dict
+    of numpy arrays keyed by ``<table>_<column>`` plus the ``msname``.
+    """
+    rows = {table: [] for table in columns}
+    msname = ''
+    section = None
+    name_slice = None
+    date = ''
 
-def get_spws(fn):
-    spws = {}
-    bws = {}
-    bbs = {}
-
-    fields_table = []
-
-    in_fields = False
     with open(fn, 'r') as fh:
-        for row in fh.readlines():
-            
+        for row in fh:
             if 'MeasurementSet Name' in row:
                 msname = ("/".join(row.split("/")[-2:])).split(" ")[0]
-            if 'EVLA_' in row:
-                spw = int(row.split()[0])
-                frq = float(row.split()[7])
-                bw = float(row.split()[6])
-                bb = row.split()[1].split("#")[1]
-                band = row.split()[1].split("#")[0].split("_")[-1]
-                if band not in ("X","C"):
-                    spws[spw] = frq
-                    bws[spw] = bw
-                    bbs[spw] = bb
-            if 'Spectral Windows:' in row:
-                in_fields = False
-            if in_fields:
-                fields_table.append(row)
-            if 'Fields:' in row:
-                in_fields = True
+                continue
+            if 'ScanIntent' in row:
+                section = 'scan'
+                continue
+            if '(nRows = Total' in row:
+                section = None
+                continue
+            stripped = row.lstrip()
+            if stripped.startswith('Fields:'):
+                section = 'field'
+                name_slice = None
+                continue
+            if stripped.startswith('Spectral Windows:'):
+                section = 'spw'
+                continue
+            if (stripped.startswith('Sources:') or
+                    stripped.startswith('Polarization') or
+                    stripped.startswith('Data Description')):
+                section = None
+                continue
+            if stripped.startswith('Antennas:'):
+                section = 'antenna'
+                continue
+
+            if section == 'spw':
+                if 'EVLA_' not in row:
+                    continue
+                cols = row.split()
+                band, bb = cols[1].split("#")[:2]
+                rows['spw'].append((cols[0], cols[1], cols[2], cols[3],
+                                    cols[4], cols[5], cols[6], cols[7],
+                                    cols[8], band.split("_")[-1], bb))
+            elif section == 'field':
+                if name_slice is None:
+                    # the title row; field names contain spaces, so they are
+                    # cut out by column position
+                    name_slice = slice(row.find("Name"), row.find("RA"))
+                    continue
+                if not row.strip():
+                    continue
+                pre = row[:name_slice.start].split()
+                post = row[name_slice.stop:].split()
+                if len(post) < 5:
+                    # older listobs versions have no nRows column
+                    post.append(-1)
+                rows['field'].append((pre[0], pre[1] if len(pre) > 1 else '',
+                                      row[name_slice].strip(), post[0],
+                                      post[1], post[2], post[3], post[4]))
+            elif section == 'scan':
+                match = scan_re.match(row)
+                if match is None:
+                    continue
+                if match.group('date'):
+                    date = match.group('date')
+                intent = row.rsplit('[', 1)[-1].strip().rstrip(']')
+                rows['scan'].append((match.group('scan'), date,
+                                     match.group('start'), match.group('end'),
+                                     match.group('fieldid'),
+                                     match.group('field'),
+                                     match.group('nrows'),
+                                     match.group('spws').replace(' ', ''),
+                                     intent))
+            elif section == 'antenna':
+                match = antenna_re.match(row)
+                if match is not None:
+                    rows['antenna'].append((match.group('id'),
+                                            match.group('name'),
+                                            match.group('station'),
+                                            match.group('diam')))
+                    continue
+                # non-verbose listobs: "ID=   0-3: 'ea01'='W09', ..."
+                match = compact_antenna_re.match(row)
+                if match is not None:
+                    start = int(match.group('id'))
+                    pairs = compact_antenna_pair_re.findall(row)
+                    for ii, (name, station) in enumerate(pairs):
+                        rows['antenna'].append((start+ii, name, station,
+                                                np.nan))
+
+    record = {'msname': np.array(msname)}
+    for table, cols in columns.items():
+        for ii, (colname, dtype) in enumerate(cols):
+            values = [rr[ii] for rr in rows[table]]
+            record['{0}_{1}'.format(table, colname)] = np.array(values, dtype=dtype)
+
+    return record
+
+
+def cache_name(fn):
+    return fn+".npz"
+
+
+def load_listobs(fn, use_cache=True):
+    """
+    Return the `read_listobs` record for ``fn``, using the ``.npz`` cache next
+    to it if that was written for the current mtime and size of ``fn``.
+    """
+    stat = os.stat(fn)
+    key = np.array([cache_version, stat.st_mtime, stat.st_size])
+    cachefn = cache_name(fn)
+
+    if use_cache and os.path.exists(cachefn):
+        try:
+            with np.load(cachefn) as cache:
+                if np.all(cache['cache_key'] == key):
+                    return {kk: cache[kk] for kk in cache.files
+                            if kk != 'cache_key'}
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    record = read_listobs(fn)
+
+    if use_cache:
+        try:
+            with open(cachefn, 'wb') as fh:
+                np.savez(fh, cache_key=key, **record)
+        except (IOError, OSError) as ex:
+            print("Could not write listobs cache {0}: {1}".format(cachefn, ex))
+
+    return record
 
 
-    return msname, spws, bws, band, bbs, fields_table
+def get_spws(fn):
+    """
+    Summarize the spectral windows of a listobs file.  X- and C-band spws
+    (the pointing / reference windows) are excluded.
+
+    Returns ``msname, spws, bws, band, bbs, fields``, where ``spws``, ``bws``
+    and ``bbs`` map spw number to center frequency (MHz), total bandwidth (kHz)
+    and baseband, and ``fields`` is the array of field names.
+    """
+    record = load_listobs(fn)
 
-def parse_fields_table(fields_table):
-    title_row = fields_table[0]
+    band = str(record['spw_band'][-1]) if len(record['spw_band']) else ''
+    keep = ~np.isin(record['spw_band'], ("X", "C"))
+    spwids = record['spw_id'][keep].tolist()
 
-    name_start = title_row.find("Name")
-    name_end = title_row.find("RA")
+    spws = dict(zip(spwids, record['spw_freq'][keep].tolist()))
+    bws = dict(zip(spwids, record['spw_bw'][keep].tolist()))
+    bbs = dict(zip(spwids, record['spw_baseband'][keep].tolist()))
 
-    sources = [row[name_start:name_end].strip() for row in fields_table[1:]]
+    return str(record['msname']), spws, bws, band, bbs, record['field_name']
 
-    return sources
 
 if __name__ == "__main__":
     import glob
@@ -61,7 +217,7 @@ if __name__ == "__main__":
 
     for key in sorted(results):
         rslt = results[key]
-        print(key, parse_fields_table(rslt[4]))
+        print(key, list(rslt[4]))
 
 #    for key in sorted(results):
 #        rslt = results[key]
@@ -70,4 +226,4 @@ if __name__ == "__main__":
 #
 #            bbs = rslt[3]
 #            for bb in sorted(set(bb.values())):
-#                
+#
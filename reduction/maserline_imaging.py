@@ -1,32 +1,98 @@
 """
-Functions for imaging the masers and other lines
+Functions for imaging the masers and other lines.
+
+The lines and their imaging parameters are listed in line_catalog.py; the
+spw of each line is found in each MS from its frequency.  `image_lines`
+images many lines in parallel, e.g. every K-band line:
+
+    image_lines(lines_in_band('K'), vis=['../'+x for x in Kmses],
+                name='18A-229_combined', threshold='25mJy')
 """
 import datetime
 import os
 import glob
 import sys
+import time
+import multiprocessing
 sys.path.append('.')
 
-from utilities import id_spws, id_spw
+from utilities import match_spws, spw_metadata
+from line_catalog import line_catalog, imaging_parameters, lines_in_band
+from ms_lists import Qmses, Kamses, Kmses
 
 from tclean_cli import tclean_cli as tclean
 from impbcor_cli import impbcor_cli as impbcor
 from exportfits_cli import exportfits_cli as exportfits
+from image_export import export_products
+import clean_manifest
 
+# the MSes of each band (relative to the reduction directory)
+band_mses = {'Q': Qmses, 'KA': Kamses, 'K': Kmses}
 
-def makefits(myimagebase, cleanup=True):
-    impbcor(imagename=myimagebase+'.image', pbimage=myimagebase+'.pb', outfile=myimagebase+'.image.pbcor', overwrite=True) # perform PBcorr
-    exportfits(imagename=myimagebase+'.image.pbcor', fitsimage=myimagebase+'.image.pbcor.fits', dropdeg=True, overwrite=True) # export the corrected image
-    exportfits(imagename=myimagebase+'.image', fitsimage=myimagebase+'.image.fits', dropdeg=True, overwrite=True) # export the corrected image
-    exportfits(imagename=myimagebase+'.pb', fitsimage=myimagebase+'.pb.fits', dropdeg=True, overwrite=True) # export the PB image
-    exportfits(imagename=myimagebase+'.model', fitsimage=myimagebase+'.model.fits', dropdeg=True, overwrite=True) # export the PB image
-    exportfits(imagename=myimagebase+'.residual', fitsimage=myimagebase+'.residual.fits', dropdeg=True, overwrite=True) # export the PB image
 
+def makefits(myimagebase, cleanup=True):
+    """
+    Export the cube products, including the primary-beam corrected cube, to
+    FITS concurrently (see `image_export.export_products`), then remove the
+    CASA images
+    """
+    remove = ()
     if cleanup:
-        for suffix in ('pb', 'weight', 'sumwt', 'psf',
-                       'model', 'mask', 'image', 'residual',
-                       'alpha', 'alpha.error'):
-            os.system('rm -rf {0}.{1}'.format(myimagebase, suffix))
+        remove = ['.'+suffix for suffix in ('pb', 'weight', 'sumwt', 'psf',
+                                            'model', 'mask', 'image', 'residual',
+                                            'alpha', 'alpha.error')]
+    export_products(myimagebase, ('.image', '.pb', '.model', '.residual'),
+                    pbcor=('.image', '.pb'), dropdeg=True, remove=remove)
+
+
+def image_name(name, field, linename, robust=0.5, threshold='25mJy'):
+    return ("{name}_{field}_r{robust}_{linename}_clean1e4_{threshold}"
+            .format(name=name, field=field.replace(" ","_"),
+                    robust=robust, threshold=threshold,
+                    linename=linename,
+                   )
+           )
+
+
+def field_parameters(vis, name, linename, spws, field, imsize=2000,
+                     cell='0.04arcsec', phasecenters=None, niter=1000,
+                     threshold='25mJy', robust=0.5, savemodel='none', **kwargs):
+    """
+    The image name and the tclean parameters of one field of a `myclean` call
+    """
+    if hasattr(spws, 'items'):
+        assert not isinstance(vis, str)
+        spws = [spws[k] for k in vis]
+
+    if phasecenters is not None:
+        phasecenter = phasecenters[field]
+    else:
+        phasecenter = ''
+
+    imagename = image_name(name, field, linename, robust=robust,
+                           threshold=threshold)
+    params = dict(vis=vis,
+                  field=field,
+                  spw=spws,
+                  imsize=[imsize, imsize],
+                  cell=cell,
+                  imagename=imagename,
+                  niter=niter,
+                  threshold=threshold,
+                  robust=robust,
+                  gridder='standard',
+                  deconvolver='hogbom',
+                  specmode='cube',
+                  weighting='briggs',
+                  pblimit=0.2,
+                  interactive=False,
+                  outframe='LSRK',
+                  datacolumn='corrected',
+                  savemodel=savemodel,
+                  phasecenter=phasecenter,
+                  **kwargs
+                 )
+    return imagename, params
 
 
 def myclean(
@@ -34,228 +100,282 @@ def myclean(
     name,
     linename,
     spws,
-    imsize=2000,
-    cell='0.04arcsec',
     fields=["Sgr B2 N Q", "Sgr B2 NM Q", "Sgr B2 MS Q"],
-    phasecenters=None,
-    niter=1000,
-    threshold='25mJy',
-    robust=0.5,
-    savemodel='none',
     overwrite=False,
     **kwargs
 ):
-    if hasattr(spws, 'items'):
-        assert not isinstance(vis, str)
-        spws = [spws[k] for k in vis]
-
-
+    """
+    Clean ``linename`` in each of ``fields``; ``kwargs`` are the imaging
+    parameters of `field_parameters` and any other tclean parameters.  A
+    field is skipped if its image is up to date with its parameters and
+    inputs (see clean_manifest.py) unless ``overwrite``.
+    """
     for field in fields:
-
-        if phasecenters is not None:
-            phasecenter = phasecenters[field]
-        else:
-            phasecenter = ''
-
-        imagename = ("{name}_{field}_r{robust}_{linename}_clean1e4_{threshold}"
-                     .format(name=name, field=field.replace(" ","_"),
-                             robust=robust, threshold=threshold,
-                             linename=linename,
-                            )
-                    )
-        if os.path.exists(imagename+".image.pbcor.fits") and not overwrite:
-            print("Skipping {0} because it's done".format(imagename))
-            continue
-        tclean(vis=vis,
-               field=field,
-               spw=spws,
-               imsize=[imsize, imsize],
-               cell=cell,
-               imagename=imagename,
-               niter=niter,
-               threshold=threshold,
-               robust=robust,
-               gridder='standard',
-               deconvolver='hogbom',
-               specmode='cube',
-               weighting='briggs',
-               pblimit=0.2,
-               interactive=False,
-               outframe='LSRK',
-               datacolumn='corrected',
-               savemodel=savemodel,
-               phasecenter=phasecenter,
-               **kwargs
-              )
+        imagename, params = field_parameters(vis, name, linename, spws, field,
+                                             **kwargs)
+        marker = imagename+".image.pbcor.fits"
+        if not overwrite:
+            current, reason = clean_manifest.is_current(imagename, params, marker)
+            if current:
+                print("Skipping {0} because it's done".format(imagename))
+                continue
+            print("Imaging {0}: {1}".format(imagename, reason))
+
+        clean_manifest.start(imagename, params)
+        tclean(**params)
         makefits(imagename)
-
+        clean_manifest.finish(imagename, params, [marker])
+
+
+def line_spws(vis, linename):
+    """
+    Find the spw of ``linename`` (a `line_catalog` entry) in each MS of
+    ``vis`` (one MS or a list of them).  Returns the MSes that have the line
+    and a dict of MS -> spw; MSes without it (e.g., NH3 (6,5) is only in the
+    03_29 K-band MS) are dropped.
+    """
+    entry = line_catalog[linename]
+    vislist = [vis] if isinstance(vis, str) else list(vis)
+    spws = match_spws(vislist, [entry['spwfreq']],
+                      min_chan=entry.get('min_chan', 255))[:, 0]
+
+    missing = [vv for vv, spw in zip(vislist, spws) if spw < 0]
+    if len(missing) == len(vislist):
+        raise ValueError("No match for {0} ({1} Hz) found in {2}"
+                         .format(linename, entry['spwfreq'], vislist))
+    for vv in missing:
+        print("{0} is not in {1}; imaging without it".format(linename, vv))
+
+    found = [vv for vv, spw in zip(vislist, spws) if spw >= 0]
+    return found, {vv: str(spw) for vv, spw in zip(vislist, spws) if spw >= 0}
+
+
+def image_line(linename, vis, name, **kwargs):
+    """
+    Image ``linename`` with the parameters of its catalog entry (see
+    `line_catalog.imaging_parameters`) in every field, finding its spw in
+    each MS.  ``kwargs`` override the catalog parameters and are passed on to
+    `myclean`.
+    """
+    params = imaging_parameters(linename)
+    params.update(kwargs)
+
+    vislist, spws = line_spws(vis, linename)
+    if isinstance(vis, str):
+        return myclean(vis=vis, name=name, linename=linename, spws=spws[vis],
+                       **params)
+    return myclean(vis=vislist, name=name, linename=linename, spws=spws,
+                   **params)
+
+
+def _image_line(args):
+    linename, vis, name, kwargs = args
+    t0 = time.time()
+    try:
+        image_line(linename, vis, name, **kwargs)
+    except Exception as ex:
+        # one failed line should not stop the others
+        return linename, time.time() - t0, "{0}: {1}".format(type(ex).__name__, ex)
+    return linename, time.time() - t0, None
+
+
+def image_lines(linenames=None, name='18A-229_combined', vis=None, nprocs=None,
+                msprefix='../', **kwargs):
+    """
+    Image each of ``linenames`` (default: every line in the catalog) in
+    parallel, one line per worker process.  Each line is imaged from ``vis``
+    or, if that is ``None``, from the `ms_lists` MSes of its band (prefixed by
+    ``msprefix``).  ``nprocs`` defaults to the NPROCS environment variable or
+    the number of cores; ``kwargs`` are passed to every `image_line`.
+
+    Returns a list of (linename, wall time, error or None) in the order the
+    lines finished.
+    """
+    if linenames is None:
+        linenames = sorted(line_catalog)
+    if nprocs is None:
+        nprocs = int(os.getenv('NPROCS', multiprocessing.cpu_count()))
+
+    jobs = []
+    for linename in linenames:
+        band = line_catalog[linename]['band']
+        linevis = vis if vis is not None else [msprefix+x for x in band_mses[band]]
+        jobs.append((linename, linevis, name, kwargs))
+
+    results = []
+    t0 = time.time()
+    if nprocs > 1 and len(jobs) > 1:
+        # maxtasksperchild=1: every line gets a fresh process (and casalog)
+        pool = multiprocessing.Pool(processes=min(nprocs, len(jobs)),
+                                    maxtasksperchild=1)
+        try:
+            for result in pool.imap_unordered(_image_line, jobs):
+                results.append(result)
+                print("{0:10.1f}s {1} {2}".format(result[1], result[0],
+                                                  result[2] or 'done'))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            results.append(_image_line(job))
+            print("{0:10.1f}s {1} {2}".format(results[-1][1], results[-1][0],
+                                              results[-1][2] or 'done'))
+
+    print("Imaged {0} lines in {1:0.1f}s with {2} processes; {3} failed"
+          .format(len(jobs), time.time()-t0, nprocs,
+                  sum(error is not None for _, _, error in results)))
+    return results
+
+
+def cube_memory_gb(imsize, nchan, chanchunks=1):
+    """
+    A rough estimate of the peak memory (GB) of a cube clean: the complex
+    gridding buffer (padded by 1.2) and a few in-memory float planes for each
+    channel of one channel chunk, plus ~2 GB for casa itself
+    """
+    chunk = -(-nchan // max(chanchunks, 1))
+    return 2 + 1.44 * imsize**2 * chunk * (8 + 4*4) / 1024.**3
+
+
+def line_jobs(linenames, name='18A-229_combined', vis=None, msprefix='../',
+              **kwargs):
+    """
+    Expand ``linenames`` into independent (line, field) imaging jobs for
+    `imaging_queue`: each job images one field of one line, is done when its
+    ``.image.pbcor.fits`` exists, and carries a memory estimate from the
+    image size and the channel count of the line's spw (override it with a
+    ``memory_gb`` catalog entry or keyword).  ``vis``, ``msprefix`` and
+    ``kwargs`` are as in `image_lines`.
+    """
+    jobs = []
+    for linename in linenames:
+        entry = line_catalog[linename]
+        linevis = vis if vis is not None else [msprefix+x for x in band_mses[entry['band']]]
+        vislist, spws = line_spws(linevis, linename)
+        if isinstance(linevis, str):
+            vislist, spws = linevis, spws[linevis]
+            firstvis, firstspw = linevis, spws
+        else:
+            firstvis, firstspw = vislist[0], spws[vislist[0]]
+
+        params = imaging_parameters(linename)
+        params.update(kwargs)
+        memory = params.pop('memory_gb', entry.get('memory_gb'))
+        if memory is None:
+            nchan = spw_metadata(firstvis)[0][int(firstspw)]
+            memory = cube_memory_gb(params['imsize'], int(nchan),
+                                    params.get('chanchunks', 1))
+
+        for field in params.pop('fields'):
+            imagename = image_name(name, field, linename,
+                                   robust=params.get('robust', 0.5),
+                                   threshold=params.get('threshold', '25mJy'))
+            jobs.append({'name': imagename, 'marker': imagename+".image.pbcor.fits",
+                         'memory': float(memory), 'linename': linename,
+                         'field': field, 'vis': vislist, 'spws': spws,
+                         'imname': name, 'params': params})
+    return jobs
+
+
+def line_job_done(job):
+    """ Whether the image of a `line_jobs` job is up to date """
+    params = dict(job['params'])
+    if params.pop('overwrite', False):
+        return False
+    imagename, params = field_parameters(job['vis'], job['imname'],
+                                         job['linename'], job['spws'],
+                                         job['field'], **params)
+    return clean_manifest.is_current(imagename, params, job['marker'])[0]
+
+
+def run_line_job(job):
+    """ Image the one field of a `line_jobs` job """
+    return myclean(vis=job['vis'], name=job['imname'], linename=job['linename'],
+                   spws=job['spws'], fields=[job['field']], **job['params'])
+
+
+# The per-line functions below are kept for the scripts that call them
 
 # Q-band
 def siov1clean(vis, name, **kwargs):
-    if isinstance(vis, list):
-        spws = id_spws(vis, freq=43.12203e9)
-    else:
-        spws = "42"
-    return myclean(vis=vis, name=name, linename='SiOv=1', spws=spws, chanchunks=8, **kwargs)
+    return image_line('SiOv=1', vis, name, **kwargs)
 
 def siov2clean(vis, name, **kwargs):
-    if isinstance(vis, list):
-        spws = id_spws(vis, freq=42.82048e9)
-    else:
-        spws = "39"
-    return myclean(vis=vis, name=name, linename='SiOv=2', spws=spws, chanchunks=8, **kwargs)
+    return image_line('SiOv=2', vis, name, **kwargs)
 
 def ch3ohmaserclean(vis, name, **kwargs):
-    if isinstance(vis, list):
-        spws = id_spws(vis, freq=44.06949e9)
-    else:
-        spws = "50"
-    return myclean(vis=vis, name=name, linename='CH3OH44.1', spws=spws, chanchunks=8, **kwargs)
+    return image_line('CH3OH44.1', vis, name, **kwargs)
 
 def ch3ohthermalclean(vis, name, **kwargs):
-    if isinstance(vis, list):
-        spws = id_spws(vis, freq=48.372456e9)
-    else:
-        spws = "20"
-    return myclean(vis=vis, name=name, linename='CH3OH48.4', spws=spws, chanchunks=8, **kwargs)
+    return image_line('CH3OH48.4', vis, name, **kwargs)
 
 def csclean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='CS1-0', spws="26", chanchunks=8, **kwargs)
+    return image_line('CS1-0', vis, name, **kwargs)
 
 
 # Ka-band
 def ch3ohKamaserclean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='CH3OH36.1', spws="11",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
+    return image_line('CH3OH36.1', vis, name, **kwargs)
 
 def so10clean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='SO10_01', spws="56",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
+    return image_line('SO10_01', vis, name, **kwargs)
 
 def nh31414clean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='NH3_1414', spws="2",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
+    return image_line('NH3_1414', vis, name, **kwargs)
 
 def nh31918clean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='NH3_1918', spws="12",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
+    return image_line('NH3_1918', vis, name, **kwargs)
 
 def nh31212clean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='NH3_1212', spws="36",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
+    return image_line('NH3_1212', vis, name, **kwargs)
 
 def nh31313clean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='NH3_1313', spws="18",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
-
+    return image_line('NH3_1313', vis, name, **kwargs)
 
 def nh31615clean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='NH3_1615', spws="61",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
+    return image_line('NH3_1615', vis, name, **kwargs)
 
 def nh31716clean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='NH3_1716', spws="42",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
+    return image_line('NH3_1716', vis, name, **kwargs)
 
 def nh31817clean(vis, name, **kwargs):
-    return myclean(vis=vis, name=name, linename='NH3_1817', spws="26",
-                   fields=['Sgr B2 MN Ka', 'Sgr B2 MS Ka'], **kwargs)
-
+    return image_line('NH3_1817', vis, name, **kwargs)
 
-# the K-band images cover a much larger area, so they need to be bigger
-def myclean_kband(*args, **kwargs):
-    if 'imsize' not in kwargs:
-        kwargs['imsize'] = 3000
-    return myclean(*args, **kwargs)
 
 # K-band
 def h2oclean(vis, name, **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='H2O', spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms': '55',
-                                                             '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms': '53',
-                                                            },
-                   cell='0.1arcsec',
-                   imsize=1000,
-                   chanchunks=16,
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
-
-def nh322clean(vis, name, fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_22',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '7',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '5', },
-                   fields=fields, **kwargs)
-
-def nh321clean(vis, name, fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_21',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '4',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '3', },
-                   fields=fields, **kwargs)
+    return image_line('H2O', vis, name, **kwargs)
+
+def nh322clean(vis, name, **kwargs):
+    return image_line('NH3_22', vis, name, **kwargs)
+
+def nh321clean(vis, name, **kwargs):
+    return image_line('NH3_21', vis, name, **kwargs)
 
 def nh332clean(vis, name, **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_32',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '3',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '2', },
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
+    return image_line('NH3_32', vis, name, **kwargs)
 
 def nh311clean(vis, name, **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_11',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '6',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '4', },
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
+    return image_line('NH3_11', vis, name, **kwargs)
 
 def nh365clean(vis, name, **kwargs):
-    return myclean_kband(vis=vis[0], name=name, linename='NH3_65',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '2', },
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
+    return image_line('NH3_65', vis, name, **kwargs)
 
 def nh344clean(vis, name, **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_44',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '12',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '10', },
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
+    return image_line('NH3_44', vis, name, **kwargs)
 
 def nh355clean(vis, name, **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_55',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '16',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '14', },
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
+    return image_line('NH3_55', vis, name, **kwargs)
 
 def nh377clean(vis, name, **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_77',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '26',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '24', },
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
+    return image_line('NH3_77', vis, name, **kwargs)
 
 def nh353clean(vis, name, **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_53',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '48',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '46', },
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
+    return image_line('NH3_53', vis, name, **kwargs)
 
 def nh354clean(vis, name, **kwargs):
-    return myclean_kband(vis=vis, name=name, linename='NH3_54',
-                   spws={'../18A-229_2018_03_29_T13_19_55.276/18A-229.sb35069722.eb35251855.58206.45698415509.ms':
-                         '58',
-                         '../18A-229_2018_03_28_T17_09_22.432/18A-229.sb35069722.eb35251150.58205.383514664354.ms':
-                         '56', },
-                   fields=['Sgr B2 MN K', 'Sgr B2 SDS K'], **kwargs)
-
+    return image_line('NH3_54', vis, name, **kwargs)
 
 #  3      EVLA_Q#A1C1#3     128   TOPO   46111.536        62.500      8000.0  46115.5046       10  RR  LL NH3 18-18
 #  10     EVLA_Q#A1C1#10    128   TOPO   46982.796        62.500      8000.0  46986.7650       10  RR  LL PN 1-0
@@ -1,6 +1,7 @@
 """
 Script to create merged images of the masers and other lines
 """
+import os
 import sys
 sys.path.append('.')
 assert os.getenv('SCRIPT_DIR') is not None
@@ -14,7 +15,7 @@ from maserline_imaging import (myclean, tclean, makefits, siov1clean,
                                nh31313clean, nh31414clean, nh31817clean,
                                nh31716clean, nh31615clean, nh344clean,
                                nh355clean, nh377clean, nh353clean, nh354clean,
-                               nh365clean,
+                               nh365clean, image_lines, lines_in_band,
                               )
 from ms_lists import Qmses, Kamses, Kmses
 
@@ -59,13 +60,7 @@ from ms_lists import Qmses, Kamses, Kmses
 #          )
 
 #h2oclean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh322clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh311clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh321clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh332clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh344clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh355clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh377clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh353clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh354clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh365clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
+# every K-band line but H2O, in parallel (one line per NPROCS worker)
+image_lines([line for line in lines_in_band('K') if line != 'H2O'],
+            vis=['../'+x for x in Kmses], name='18A-229_combined',
+            threshold='25mJy')
@@ -1,16 +1,34 @@
 """
-Script to create merged images of the masers and other lines
+Script to create merged images of the masers and other lines, as
+independent (line, field) jobs: each job images one field of one line and is
+done once its .image.pbcor.fits exists and is up to date with its
+parameters and inputs (see clean_manifest.py), so rerunning skips finished
+images.
+
+By default the jobs run on a local pool (NPROCS jobs at once, within the
+NODE_MEMORY_GB budget; see imaging_queue.py).  With IMAGING_MODE=pbs the
+pending jobs are instead written to maserline_jobs.json and a PBS array
+script, maserline_jobs.pbs, whose tasks each rerun this script to image one
+of them:
+
+    IMAGING_MODE=pbs casa --nogui -c maserline_imaging_all_parallel.py
+    qsub maserline_jobs.pbs
 """
+import os
 import sys
 sys.path.append('.')
+if os.getenv('SCRIPT_DIR') is not None:
+    sys.path.append(os.getenv('SCRIPT_DIR'))
 
 from maserline_imaging import (myclean, tclean, makefits, siov1clean,
                                siov2clean, ch3ohmaserclean, ch3ohthermalclean,
                                csclean, so10clean, ch3ohKamaserclean,
                                h2oclean, nh311clean, nh322clean, nh321clean,
-                               nh332clean,
+                               nh332clean, line_jobs, run_line_job,
+                               line_job_done,
                               )
 from ms_lists import Qmses, Kamses, Kmses
+import imaging_queue
 
 
 #siov1clean(['../'+x for x in Qmses], name='18A-229_combined', threshold='25mJy', parallel=True)
@@ -35,7 +53,22 @@ from ms_lists import Qmses, Kamses, Kmses
 
 
 #h2oclean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh322clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh311clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh321clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
-nh332clean(['../'+x for x in Kmses], name='18A-229_combined', threshold='25mJy')
+
+# a PBS array task images its one job and stops
+if not imaging_queue.run_job_from_env(run_line_job, is_done=line_job_done):
+
+    jobs = line_jobs(['NH3_22', 'NH3_11', 'NH3_21', 'NH3_32'],
+                     vis=['../'+x for x in Kmses], name='18A-229_combined',
+                     threshold='25mJy')
+
+    if os.getenv('IMAGING_MODE') == 'pbs':
+        script = os.path.join(os.getenv('SCRIPT_DIR', '.'),
+                              'maserline_imaging_all_parallel.py')
+        njobs = imaging_queue.write_pbs_array(jobs, script,
+                                              jobfile='maserline_jobs.json',
+                                              pbsfile='maserline_jobs.pbs',
+                                              jobname='sb2_maserlines',
+                                              is_done=line_job_done)
+        print("Wrote {0} jobs to maserline_jobs.pbs".format(njobs))
+    else:
+        imaging_queue.run_local(run_line_job, jobs, is_done=line_job_done)
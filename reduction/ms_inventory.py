@@ -0,0 +1,192 @@
+"""
+A persistent inventory of the 18A-229 measurement sets: band, spw layout,
+fields and size of every MS, so that scripts can select MSes by band without
+opening ``msmd`` on each of them.
+
+The inventory is built from ms_lists.py and continuum_windows.py (band and
+continuum windows), the MS's listobs file (spws, fields, and the band of
+unlisted MSes; see listobs_parser.py) and, only for MSes with no listobs, the
+SPECTRAL_WINDOW table (which needs CASA).  It is kept in ms_inventory.json;
+an entry is rebuilt only when the MS's table.dat changes.
+
+    from ms_inventory import mses_by_band
+    qmses = mses_by_band('Q')
+"""
+import os
+import glob
+import json
+import numpy as np
+
+import ms_lists
+import continuum_windows
+from listobs_parser import load_listobs
+
+default_inventory = 'ms_inventory.json'
+default_pattern = "18A-229_2018_0*/18A*.ms"
+
+inventory_version = 1
+
+# VLA band edges (GHz) for classifying MSes that are in no list
+band_edges = (('K', 18, 26.5), ('KA', 26.5, 40), ('Q', 40, 50))
+
+
+def list_bands():
+    """
+    MS path -> band and MS path -> continuum windows from the hand-made lists
+    """
+    bands = {}
+    for band, lists in (('Q', (ms_lists.Qmses, continuum_windows.all_Qmses)),
+                        ('KA', (ms_lists.Kamses, continuum_windows.Kamses)),
+                        ('K', (ms_lists.Kmses, continuum_windows.Kmses))):
+        for mslist in lists:
+            for vis in mslist:
+                bands[vis] = band
+
+    windows = {}
+    for mslist in (continuum_windows.all_Qmses, continuum_windows.Kamses,
+                   continuum_windows.Kmses):
+        windows.update(mslist)
+
+    return bands, windows
+
+
+def ms_key(vis):
+    """
+    The state of an MS: the mtime and size of its table.dat, which change
+    when columns are added or the MS is re-split
+    """
+    stat = os.stat(os.path.join(vis, 'table.dat'))
+    return [inventory_version, stat.st_mtime, stat.st_size]
+
+
+def ms_size(vis):
+    """ The total size (bytes) of the files in an MS """
+    size = 0
+    for directory, dirnames, filenames in os.walk(vis):
+        for fn in filenames:
+            size += os.path.getsize(os.path.join(directory, fn))
+    return size
+
+
+def find_listobs(vis):
+    for fn in (vis.rstrip('/')+".listobs",
+               os.path.join('listobs', os.path.basename(vis.rstrip('/'))+".listobs")):
+        if os.path.exists(fn):
+            return fn
+
+
+def classify(freqs_ghz):
+    """ The band of the median science spw frequency, or '' """
+    freqs_ghz = np.asarray(freqs_ghz)
+    # X- and C-band pointing / reference windows
+    freqs_ghz = freqs_ghz[freqs_ghz > 12]
+    if freqs_ghz.size == 0:
+        return ''
+    freq = np.median(freqs_ghz)
+    for band, fmin, fmax in band_edges:
+        if fmin <= freq < fmax:
+            return band
+    return ''
+
+
+def make_entry(vis, bands, windows):
+    """
+    Gather the inventory entry of one MS
+    """
+    entry = {'key': ms_key(vis), 'size': ms_size(vis),
+             'continuum_spws': windows.get(vis, '')}
+
+    listobs_band = ''
+    listobsfn = find_listobs(vis)
+    if listobsfn is not None:
+        record = load_listobs(listobsfn)
+        entry['spw'] = record['spw_id'].tolist()
+        entry['freq'] = (record['spw_freq'] / 1e3).tolist()
+        entry['bw'] = (record['spw_bw'] / 1e6).tolist()
+        entry['nchan'] = record['spw_nchan'].tolist()
+        entry['baseband'] = record['spw_baseband'].tolist()
+        entry['fields'] = record['field_name'].tolist()
+        entry['source'] = 'listobs'
+        science = ~np.isin(record['spw_band'], ("X", "C"))
+        if np.any(science):
+            listobs_band = str(record['spw_band'][science][-1])
+    else:
+        # reading the SPECTRAL_WINDOW table needs CASA
+        from utilities import spw_metadata
+        nchan, minfreq, maxfreq, meanfreq = spw_metadata(vis)
+        entry['spw'] = list(range(len(nchan)))
+        entry['freq'] = (np.asarray(meanfreq) / 1e9).tolist()
+        entry['bw'] = ((np.asarray(maxfreq) - np.asarray(minfreq)) / 1e9).tolist()
+        entry['nchan'] = np.asarray(nchan).tolist()
+        entry['baseband'] = []
+        entry['fields'] = []
+        entry['source'] = 'spw_table'
+
+    parent = vis.replace('_continuum.ms', '.ms')
+    if vis in bands:
+        entry['band'] = bands[vis]
+    elif parent in bands:
+        entry['band'] = bands[parent]
+    elif listobs_band:
+        entry['band'] = listobs_band
+    else:
+        entry['band'] = classify(entry['freq'])
+
+    return entry
+
+
+def load_inventory(mses=None, inventoryfn=default_inventory, rebuild=False):
+    """
+    Return the inventory, a dict of MS path -> entry, for ``mses`` (default:
+    every MS matching `default_pattern` and every listed MS), adding or
+    refreshing the entries of new or changed MSes and saving it.
+
+    Each entry has the band ('Q', 'KA' or 'K'), size (bytes), continuum_spws
+    (the continuum_windows.py selection, if any), fields, and per-spw lists
+    spw, freq (GHz), bw (GHz), nchan and baseband.
+    """
+    bands, windows = list_bands()
+    if mses is None:
+        mses = sorted(set(glob.glob(default_pattern)) | set(bands))
+    mses = [vis for vis in mses if os.path.exists(os.path.join(vis, 'table.dat'))]
+
+    inventory = {}
+    if not rebuild and os.path.exists(inventoryfn):
+        try:
+            with open(inventoryfn, 'r') as fh:
+                inventory = json.load(fh)
+        except ValueError:
+            inventory = {}
+
+    changed = False
+    for vis in mses:
+        if vis in inventory and inventory[vis]['key'] == ms_key(vis):
+            continue
+        inventory[vis] = make_entry(vis, bands, windows)
+        changed = True
+
+    if changed:
+        with open(inventoryfn, 'w') as fh:
+            json.dump(inventory, fh, indent=1, sort_keys=True)
+
+    return {vis: inventory[vis] for vis in mses}
+
+
+def mses_by_band(band, pattern=None, **kwargs):
+    """
+    The sorted MSes (optionally only those matching the glob ``pattern``) in
+    ``band``
+    """
+    mses = sorted(glob.glob(pattern)) if pattern is not None else None
+    inventory = load_inventory(mses, **kwargs)
+    return sorted(vis for vis, entry in inventory.items()
+                  if entry['band'] == band.upper())
+
+
+if __name__ == "__main__":
+    inventory = load_inventory()
+    for vis in sorted(inventory):
+        entry = inventory[vis]
+        print("{0:2s} {1:7.1f} GB {2:3d} spws {3:2d} fields {4}"
+              .format(entry['band'], entry['size']/1024.**3,
+                      len(entry['spw']), len(entry['fields']), vis))
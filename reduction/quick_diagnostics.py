@@ -1,17 +1,37 @@
+"""
+Quick health checks of the 18A-229 data.
 
-for fn in glob.glob("18A-229_2018_0*/*_continuum.ms"):
-    msmd.open(fn)
-    restfreqs = msmd.restfreqs()
-    msmd.close()
-
-    if restfreqs['0']['m0']['value'] < 40e9:
-        # not Q-band
-        continue
-
-    ms.open(fn)
-    print("{fn}: min={min:0.4g} max={max:0.4g} median={median:0.4g} mean={mean:0.4g}"
-          .format(fn=fn, **ms.statistics(column='DATA', complex_value='amp', spw='0', field='Sgr B2 MS Q')['']))
-    ms.close()
+The visibility amplitude statistics of all MSes are computed in one parallel
+pass per MS (see visibility_statistics.py) and collected in
+visibility_statistics.txt; the amplitude self-cal tables are summarized in
+caltable_statistics.txt (see caltable_statistics.py).  The results of the
+individual checks that these replaced are kept below for reference.
+"""
+import glob
+from astropy.table import vstack
+from visibility_statistics import visibility_statistics
+from caltable_statistics import caltable_statistics
+from ms_inventory import mses_by_band
+
+# bands come from the MS inventory rather than opening msmd on every MS
+continuum_mses = mses_by_band('Q', pattern="18A-229_2018_0*/*_continuum.ms")
+line_pattern = "18A-229_2018_0*/18A*[0-9].ms"
+# Q- and K-band (not Ka)
+line_mses = (mses_by_band('Q', pattern=line_pattern) +
+             mses_by_band('K', pattern=line_pattern))
+
+stats = vstack([visibility_statistics(continuum_mses, columns=('DATA',),
+                                      spws=[0], fields=['Sgr B2 MS Q']),
+                visibility_statistics(line_mses,
+                                      columns=('DATA', 'CORRECTED_DATA'),
+                                      spws=[2],
+                                      fields=['Sgr B2 MS Q', 'Sgr B2 MS K'])])
+for key in ('min', 'max', 'median', 'mean'):
+    stats[key].format = '0.4g'
+stats.pprint(max_lines=-1, max_width=-1)
+stats.write('visibility_statistics.txt', format='ascii.ipac', overwrite=True)
+
+# Q-band continuum, DATA, spw 0 (previous results)
 """
 18A-229_2018_03_06_T01_29_24.948/18A-229.sb35058339.eb35201848.58183.55541637732_continuum.ms: min=0.0001102 max=5.176 median=0.1771 mean=0.2241
 18A-229_2018_03_10_T12_59_53.135/18A-229.sb35065347.eb35215346.58187.443269247684_continuum.ms: min=0.001623 max=173 median=4.263 mean=5.612
@@ -26,23 +46,7 @@ for fn in glob.glob("18A-229_2018_0*/*_continuum.ms"):
 18A-229_2018_03_06_T12_39_58.178/18A-229.sb35065347.eb35201827.58183.43683233796_continuum.ms: min=0.0002581 max=12.42 median=0.8085 mean=0.9537
 """
 
-
-for fn in glob.glob("18A-229_2018_0*/18A*[0-9].ms"):
-    msmd.open(fn)
-    restfreqs = msmd.reffreq(2)
-    msmd.close()
-
-    if restfreqs['m0']['value'] < 40e9:
-        # not Q-band
-        continue
-
-    ms.open(fn)
-    print("DATA {fn}: min={min:0.4g} max={max:0.4g} median={median:0.4g} mean={mean:0.4g}"
-          .format(fn=fn, **ms.statistics(column='DATA', complex_value='amp', spw='2', field='Sgr B2 MS Q')['']))
-    print("CORRECTED {fn}: min={min:0.4g} max={max:0.4g} median={median:0.4g} mean={mean:0.4g}"
-          .format(fn=fn, **ms.statistics(column='CORRECTED', complex_value='amp', spw='2', field='Sgr B2 MS Q')['']))
-    ms.close()
-
+# Q-band, DATA and CORRECTED, spw 2 (previous results)
 """
 DATA 18A-229_2018_03_06_T01_29_24.948/18A-229.sb35058339.eb35201848.58183.55541637732.ms: min=8.046e-07 max=0.02032 median=0.003223 mean=0.003457
 CORRECTED 18A-229_2018_03_06_T01_29_24.948/18A-229.sb35058339.eb35201848.58183.55541637732.ms: min=7.616e-05 max=13.91 median=0.4149 mean=0.5211
@@ -69,13 +73,13 @@ CORRECTED 18A-229_2018_03_06_T12_39_58.178/18A-229.sb35065347.eb35201827.58183.4
 """
 
 
-for fn in glob.glob("*amp*cal"):
-    tb.open(fn)
-    cp = tb.getcol('CPARAM').ravel().real
-    tb.close()
-    ok = cp.real != 1
-    print("{fn}: mean={mean:0.4g} median={median:0.4g}"
-          .format(fn=fn, mean=cp[ok].mean(), median=np.median(cp[ok])))
+# gain amplitudes of the solved, unflagged solutions of the amp self-cal
+# tables, per table, antenna, spw and solution time
+calstats = caltable_statistics(sorted(glob.glob("*amp*cal")))
+calstats.write('caltable_statistics.txt', format='ascii.ipac', overwrite=True)
+for row in calstats[calstats['group'] == 'all']:
+    print("{0}: mean={1:0.4g} median={2:0.4g}"
+          .format(row['caltable'], row['mean'], row['median']))
 
 """
 18A-229_2018_03_02_T23_sgrb2_selfcal_amp_INFsolint_dontuse.cal: mean=0.5354 median=0.4705
@@ -90,23 +94,3 @@ for fn in glob.glob("*amp*cal"):
 18A-229_2018_04_06_T14_sgrb2_selfcal_amp_INFsolint_dontuse.cal: mean=0.5092 median=0.4341
 18A-229_2018_04_18_T13_sgrb2_selfcal_amp_INFsolint_dontuse.cal: mean=0.5724 median=0.4894
 """
-
-
-
-
-for fn in glob.glob("18A-229_2018_0*/18A*[0-9].ms"):
-    msmd.open(fn)
-    restfreqs = msmd.reffreq(2)
-    msmd.close()
-
-    if restfreqs['m0']['value'] > 30e9:
-        # Ka or Q-band
-        continue
-
-    ms.open(fn)
-    print("DATA {fn}: min={min:0.4g} max={max:0.4g} median={median:0.4g} mean={mean:0.4g}"
-          .format(fn=fn, **ms.statistics(column='DATA', complex_value='amp', spw='2', field='Sgr B2 MS K')['']))
-    print("CORRECTED {fn}: min={min:0.4g} max={max:0.4g} median={median:0.4g} mean={mean:0.4g}"
-          .format(fn=fn, **ms.statistics(column='CORRECTED', complex_value='amp', spw='2', field='Sgr B2 MS K')['']))
-    ms.close()
-
@@ -0,0 +1,85 @@
+"""
+Render the PNG quicklooks of the FITS products written by quicklooks.py.
+
+Rendering is kept out of the cube reductions: quicklooks.py only writes FITS
+files and queues (png, [fits, ...]) render jobs, which are drawn here by a
+separate pool of worker processes.  Each worker draws everything on one
+figure that it keeps for its lifetime, rather than creating a new figure (and
+aplpy canvas) per image.
+
+Spectra (1D FITS) are drawn as step plots, overplotted if several are given;
+images are drawn with aplpy as in ``Projection.quicklook``.
+"""
+import os
+import numpy as np
+from astropy.io import fits
+from astropy import wcs
+
+import matplotlib
+matplotlib.use('agg')
+import pylab as pl
+
+# the one figure of this (worker) process
+_figure = None
+
+
+def get_figure():
+    global _figure
+    if _figure is None:
+        _figure = pl.figure()
+    _figure.clf()
+    return _figure
+
+
+def is_stale(pngfile, fitsfiles):
+    """
+    True if ``pngfile`` is missing or older than any of ``fitsfiles``
+    """
+    if not os.path.exists(pngfile):
+        return True
+    mtime = os.path.getmtime(pngfile)
+    return any(os.path.getmtime(fn) > mtime for fn in fitsfiles)
+
+
+def render_spectra(fig, fitsfiles, pngfile):
+    ax = fig.add_subplot(111)
+    for fn in fitsfiles:
+        hdu = fits.open(fn)[0]
+        ww = wcs.WCS(hdu.header)
+        xaxis = ww.wcs_pix2world(np.arange(hdu.data.size), 0)[0]
+        unit = ww.wcs.cunit[0]
+        ax.plot(xaxis, hdu.data, drawstyle='steps-mid')
+    ax.set_xlabel(unit.to_string(format='latex'))
+    ax.set_ylabel(hdu.header.get('BUNIT', ''))
+    fig.savefig(pngfile)
+
+
+def render_image(fig, fitsfile, pngfile):
+    try:
+        import aplpy
+        F = aplpy.FITSFigure(fitsfile, figure=fig)
+        F.show_grayscale()
+        F.add_colorbar()
+        F.save(pngfile)
+    except (wcs.InconsistentAxisTypesError, ImportError):
+        fig.clf()
+        ax = fig.add_subplot(111)
+        im = ax.imshow(fits.getdata(fitsfile), origin='lower', cmap='gray')
+        fig.colorbar(im)
+        fig.savefig(pngfile)
+
+
+def render(jobs):
+    """
+    Draw every (pngfile, fitsfiles) job on this process's figure.  Returns
+    the PNGs that were written.
+    """
+    done = []
+    for pngfile, fitsfiles in jobs:
+        fig = get_figure()
+        if fits.getheader(fitsfiles[0])['NAXIS'] == 1:
+            render_spectra(fig, fitsfiles, pngfile)
+        else:
+            render_image(fig, fitsfiles[0], pngfile)
+        done.append(pngfile)
+    return done
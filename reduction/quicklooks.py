@@ -1,23 +1,105 @@
+"""
+Collapse every *.image.pbcor.fits cube in the current directory into the
+quicklook products in collapse/ (noise and peak spectra, max / min / argmax /
+vmax and 25/50/75 percentile maps).
+
+Cubes are farmed out to a process pool, one fresh worker per cube (set NPROCS
+to limit the number of workers).  Each cube gets a manifest,
+collapse/manifests/<cube>.json, listing the products it wrote and the wall
+time and peak RSS it took; a cube is skipped if its manifest's products all
+exist and are newer than the cube (and its model).  ``python quicklooks.py
+force`` redoes everything.
+
+The cube workers only write FITS files.  The PNG quicklooks are queued and
+drawn by a separate pool of NRENDERPROCS (default 2) renderers while the
+cubes are being reduced (see quicklook_render.py); ``python quicklooks.py
+norender`` skips them, and the next run without it draws any that are
+missing or out of date.
+"""
 import os
+import sys
+import json
+import time
+import resource
+import multiprocessing
 import numpy as np
 from astropy.io import fits
 from astropy import units as u
 from astropy.stats import mad_std
-import aplpy
-import pylab as pl
 import radio_beam
 import glob
 from spectral_cube import SpectralCube
 from spectral_cube.lower_dimensional_structures import Projection
+from cube_collapse import (plane_statistics, collapse_maps, max_spectrum,
+                           noise_threshold, percentile_maps)
+from cube_metadata import CubeMetadata
+from quicklook_render import render, is_stale
+
+
+# bump when the set of products changes, so that existing cubes are redone
+manifest_version = 2
+
+
+def manifest_name(fn):
+    return 'collapse/manifests/{0}'.format(fn.replace(".image.pbcor.fits", ".json"))
+
+
+def load_manifest(fn):
+    """
+    The manifest of ``fn``, or an empty dict if there is none (or it is
+    unreadable)
+    """
+    try:
+        with open(manifest_name(fn), 'r') as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def is_done(fn):
+    """
+    True if every product in the manifest of ``fn`` exists and is newer than
+    ``fn`` and its model
+    """
+    manifest = load_manifest(fn)
+    if manifest.get('version') != manifest_version:
+        return False
+
+    inputs = [fn, fn.replace(".image.pbcor", ".model")]
+    newest_input = max(os.path.getmtime(ifn) for ifn in inputs if os.path.exists(ifn))
+    for product in manifest['products']:
+        if not os.path.exists(product) or os.path.getmtime(product) < newest_input:
+            return False
+    return True
+
+
+def quicklook_cube(fn):
+    """
+    Make all of the FITS quicklook products of one cube and write its
+    manifest.  Returns the file name, the list of products, the PNG render
+    jobs (see quicklook_render.py), the wall time and the peak RSS (MB) of the
+    worker.
+    """
+    t0 = time.time()
+    products = []
+    renders = []
+
+    def product(directory, suffix):
+        """ Name (and record) one output of this cube """
+        name = 'collapse/{0}/{1}'.format(directory, fn.replace(".image.pbcor.fits", suffix))
+        products.append(name)
+        return name
+
+    def queue(*fitsfiles):
+        """ Queue the PNG of one (or several overplotted) products """
+        directory, name = os.path.split(fitsfiles[-1])
+        renders.append((os.path.join(directory, 'pngs', name.replace(".fits", ".png")),
+                        list(fitsfiles)))
 
-for fn in glob.glob("*.image.pbcor.fits"):
     print(fn)
     #if fits.getheader(fn)['NAXIS'] <= 2:
     #    print("Skipped {0} because it wasn't a cube".format(fn))
     #    continue
-    #if os.path.exists('collapse/argmax/{0}'.format(fn.replace(".image.pbcor.fits","_vmax.fits"))):
-    #    print("Skipped {0} because it is done".format(fn))
-    #    continue
 
     modfile = fn.replace(".image.pbcor", ".model")
     if os.path.exists(modfile):
@@ -29,84 +111,145 @@ for fn in glob.glob("*.image.pbcor.fits"):
     #cube.allow_huge_operations = True
     mcube = cube.mask_out_bad_beams(0.1)
     mcube.beam_threshold = 1
+    # beam, mean frequency, K conversion etc., computed once for all products
+    meta = CubeMetadata(mcube)
 
-    stdspec = mcube.mad_std(axis=(1,2), how='slice')
-    stdspec.write("collapse/stdspec/{0}".format(fn.replace(".image.pbcor.fits", "_std_spec.fits")), overwrite=True)
-    stdspec.quicklook("collapse/stdspec/pngs/{0}".format(fn.replace(".image.pbcor.fits", "_std_spec.png")))
-
-    if np.nanmin(stdspec) > 0.1*cube.unit:
-        threshold = np.nanpercentile(stdspec, 90)
-    else:
-        threshold = 0.1
+    # everything below comes from two plane-by-plane reads of the cube (see
+    # cube_collapse.py) rather than one full traversal per product
+    stdspec_, maxspec_ = plane_statistics(mcube)
+    stdspec = meta.make_spectrum(stdspec_)
+    stdspecfn = product("stdspec", "_std_spec.fits")
+    stdspec.write(stdspecfn, overwrite=True)
+    queue(stdspecfn)
 
-    mcube = mcube.with_mask((stdspec < threshold*cube.unit)[:,None,None])
+    threshold = noise_threshold(stdspec_)
+    include = stdspec_ < threshold
 
-    pl.clf()
-    mxspec = mcube.max(axis=(1,2), how='slice')
-    mxspec.write("collapse/maxspec/{0}".format(fn.replace(".image.pbcor.fits", "_max_spec.fits")), overwrite=True)
-    mxspec.quicklook("collapse/maxspec/pngs/{0}".format(fn.replace(".image.pbcor.fits", "_max_spec.png")))
+    mxspec_ = np.where(include, maxspec_, np.nan)
+    mxspec = meta.make_spectrum(mxspec_)
+    mxspecfn = product("maxspec", "_max_spec.fits")
+    mxspec.write(mxspecfn, overwrite=True)
+    queue(mxspecfn)
     if os.path.exists(modfile):
-        mxmodspec = modcube.max(axis=(1,2), how='slice')
-        mxmodspec.write("collapse/maxspec/{0}".format(fn.replace(".image.pbcor.fits", "_max_model_spec.fits")), overwrite=True)
-        mxmodspec.quicklook("collapse/maxspec/pngs/{0}".format(fn.replace(".image.pbcor.fits", "_max_model_spec.png")))
-
-    mx = mcube.max(axis=0, how='slice')
-    beam = mcube.beam if hasattr(mcube, 'beam') else mcube.average_beams(1)
-    mx_K = (mx*u.beam).to(u.K, u.brightness_temperature(beam_area=beam,
-                                                        frequency=mcube.with_spectral_unit(u.GHz).spectral_axis.mean()))
-    mx_K.write('collapse/max/{0}'.format(fn.replace(".image.pbcor.fits","_max_K.fits")),
-               overwrite=True)
-    mx_K.quicklook('collapse/max/pngs/{0}'.format(fn.replace(".image.pbcor.fits","_max_K.png")))
-    mx.write('collapse/max/{0}'.format(fn.replace(".image.pbcor.fits","_max.fits")),
-             overwrite=True)
-    mx.quicklook('collapse/max/pngs/{0}'.format(fn.replace(".image.pbcor.fits","_max.png")))
-
-    sn_mask = mxspec / stdspec > 5
-    if any(sn_mask):
-        mcube_sn = mcube.with_mask(sn_mask[:,None,None])
-        mx_masked = mcube_sn.max(axis=0, how='slice')
-        mx_masked_K = (mx_masked*u.beam).to(u.K,
-                                            u.brightness_temperature(beam_area=beam,
-                                                                     frequency=mcube_sn.with_spectral_unit(u.GHz).spectral_axis.mean()))
-        mx_masked_K.write('collapse/max/{0}'.format(fn.replace(".image.pbcor.fits","_max_masked_K.fits")),
-                          overwrite=True)
-        mx_masked_K.quicklook('collapse/max/pngs/{0}'.format(fn.replace(".image.pbcor.fits","_max_masked_K.png")))
-        mx_masked.write('collapse/max/{0}'.format(fn.replace(".image.pbcor.fits","_max_masked.fits")),
-                        overwrite=True)
-        mx_masked.quicklook('collapse/max/pngs/{0}'.format(fn.replace(".image.pbcor.fits","_max_masked.png")))
-
-    argmax = mcube.argmax(axis=0, how='ray')
+        mxmodspec = CubeMetadata(modcube).make_spectrum(max_spectrum(modcube))
+        mxmodspecfn = product("maxspec", "_max_model_spec.fits")
+        mxmodspec.write(mxmodspecfn, overwrite=True)
+        # drawn over the max spectrum, as before
+        queue(mxspecfn, mxmodspecfn)
+
+    with np.errstate(invalid='ignore'):
+        sn_mask = mxspec_ / stdspec_ > 5
+    maps = collapse_maps(mcube, include, sn_mask)
+
+    mx = meta.make_projection(maps['max'])
+    mx_K = meta.to_K(mx)
+    mx_Kfn = product("max", "_max_K.fits")
+    mx_K.write(mx_Kfn, overwrite=True)
+    queue(mx_Kfn)
+    mxfn = product("max", "_max.fits")
+    mx.write(mxfn, overwrite=True)
+    queue(mxfn)
+
+    if maps['max_masked'] is not None:
+        mx_masked = meta.make_projection(maps['max_masked'])
+        mx_masked_K = meta.to_K(mx_masked)
+        mx_masked_Kfn = product("max", "_max_masked_K.fits")
+        mx_masked_K.write(mx_masked_Kfn, overwrite=True)
+        queue(mx_masked_Kfn)
+        mx_maskedfn = product("max", "_max_masked.fits")
+        mx_masked.write(mx_maskedfn, overwrite=True)
+        queue(mx_maskedfn)
+
+    argmax = maps['argmax']
     hdu = mx.hdu
     hdu.data = argmax
-    hdu.writeto('collapse/argmax/{0}'.format(fn.replace(".image.pbcor.fits","_argmax.fits")),
-                overwrite=True)
+    hdu.writeto(product("argmax", "_argmax.fits"), overwrite=True)
     bad = np.isnan(argmax)
     argmax = np.nan_to_num(argmax).astype('int')
     assert 'int' in argmax.dtype.name
-    vmax = mcube.with_spectral_unit(u.km/u.s, velocity_convention='radio').spectral_axis[argmax]
+    vmax = meta.velocity_axis(velocity_convention='radio')[argmax]
     vmax[bad] = np.nan
     hdu.data = vmax.to(u.km/u.s).value
-    hdu.writeto('collapse/argmax/{0}'.format(fn.replace(".image.pbcor.fits","_vmax.fits")),
-                overwrite=True)
-
-
-    mn = mcube.min(axis=0, how='slice')
-    beam = mcube.beam if hasattr(mcube, 'beam') else mcube.average_beams(1)
-    mn_K = (mn*u.beam).to(u.K, u.brightness_temperature(beam_area=beam,
-                                                        frequency=mcube.with_spectral_unit(u.GHz).spectral_axis.mean()))
-    mn_K.write('collapse/min/{0}'.format(fn.replace(".image.pbcor.fits","_min_K.fits")),
-               overwrite=True)
-    mn_K.quicklook('collapse/min/pngs/{0}'.format(fn.replace(".image.pbcor.fits","_min_K.png")))
-
-
-    #for pct in (25,50,75):
-    #    pctmap = mcube.percentile(pct, axis=0, iterate_rays=True)
-    #    beam = mcube.beam if hasattr(mcube, 'beam') else mcube.average_beams(1)
-    #    pctmap_K = (pctmap*u.beam).to(u.K,
-    #                                  u.brightness_temperature(beam_area=beam,
-    #                                                           frequency=mcube.with_spectral_unit(u.GHz).spectral_axis.mean()))
-    #    pctmap_K.write('collapse/percentile/{0}'.format(fn.replace(".image.pbcor.fits","_{0}pct_K.fits".format(pct))),
-    #                   overwrite=True)
-    #    pctmap_K.quicklook('collapse/percentile/pngs/{0}'.format(fn.replace(".image.pbcor.fits","_{0}pct_K.png".format(pct))))
-
-    pl.close('all')
+    hdu.writeto(product("argmax", "_vmax.fits"), overwrite=True)
+
+
+    mn = meta.make_projection(maps['min'])
+    mn_K = meta.to_K(mn)
+    mn_Kfn = product("min", "_min_K.fits")
+    mn_K.write(mn_Kfn, overwrite=True)
+    queue(mn_Kfn)
+
+
+    pcts = (25,50,75)
+    pctmaps = percentile_maps(mcube, pcts, include)
+    for pct, pctmap_ in zip(pcts, pctmaps):
+        pctmap_K = meta.to_K(meta.make_projection(pctmap_))
+        pctmap_Kfn = product("percentile", "_{0}pct_K.fits".format(pct))
+        pctmap_K.write(pctmap_Kfn, overwrite=True)
+        queue(pctmap_Kfn)
+
+    elapsed = time.time() - t0
+    # ru_maxrss is in kB on linux; each cube has a worker to itself, so this
+    # is the peak for this cube
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    with open(manifest_name(fn), 'w') as fh:
+        json.dump({'version': manifest_version, 'input': fn,
+                   'products': products, 'renders': renders,
+                   'elapsed': elapsed, 'maxrss_MB': maxrss}, fh, indent=1)
+
+    return fn, products, renders, elapsed, maxrss
+
+
+if __name__ == "__main__":
+    nprocs = int(os.getenv('NPROCS', multiprocessing.cpu_count()))
+    nrender = int(os.getenv('NRENDERPROCS', 2))
+    force = 'force' in sys.argv[1:]
+    # 'norender' only writes the FITS products; a later run draws the PNGs
+    render_pngs = 'norender' not in sys.argv[1:]
+
+    if not os.path.exists('collapse/manifests'):
+        os.makedirs('collapse/manifests')
+
+    fns = sorted(glob.glob("*.image.pbcor.fits"))
+    todo = [fn for fn in fns if force or not is_done(fn)]
+    print("{0} of {1} cubes need quicklooks".format(len(todo), len(fns)))
+
+    renderpool = multiprocessing.Pool(processes=nrender) if render_pngs else None
+    rendered = []
+
+    def submit(renders):
+        jobs = [(png, fitsfiles) for png, fitsfiles in renders
+                if force or is_stale(png, fitsfiles)]
+        if renderpool is not None and jobs:
+            rendered.append(renderpool.apply_async(render, (jobs,)))
+
+    # PNGs of finished cubes that are missing or out of date
+    for fn in fns:
+        if fn not in todo:
+            submit(load_manifest(fn).get('renders', []))
+
+    t0 = time.time()
+    try:
+        if todo:
+            # maxtasksperchild=1 gives every cube a fresh process, so its memory
+            # is returned and its peak RSS is its own
+            pool = multiprocessing.Pool(processes=max(1, min(nprocs, len(todo))),
+                                        maxtasksperchild=1)
+            try:
+                for fn, products, renders, elapsed, maxrss in pool.imap_unordered(quicklook_cube, todo):
+                    print("{0:8.1f}s {1:8.0f} MB {2:3d} products {3}"
+                          .format(elapsed, maxrss, len(products), fn))
+                    submit(renders)
+            finally:
+                pool.close()
+                pool.join()
+        print("Finished {0} cubes in {1:0.1f}s with {2} processes"
+              .format(len(todo), time.time()-t0, nprocs))
+
+        npng = sum(len(result.get()) for result in rendered)
+        print("Rendered {0} PNGs in {1:0.1f}s".format(npng, time.time()-t0))
+    finally:
+        if renderpool is not None:
+            renderpool.close()
+            renderpool.join()
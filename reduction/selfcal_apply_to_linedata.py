@@ -1,17 +1,20 @@
 import os
 import sys
 sys.path.append('.')
-from utilities import get_spw_mapping
+from utilities import get_spw_mappings
 
 from ms_lists import Qmses
 
 caltable = '../continuum/18A-229_Q_concatenated_cal_iter2_30s'
 
+# build all of the spwmaps up front, reading each table only once
+spwmaps = get_spw_mappings([("../"+ms, caltable) for ms in Qmses])
+
 
 for ms in Qmses:
     vis = "../"+ms
 
-    spwmap = get_spw_mapping(vis, caltable)
+    spwmap = spwmaps[(vis, caltable)]
 
     print(spwmap, vis, caltable)
 
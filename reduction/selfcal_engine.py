@@ -0,0 +1,370 @@
+"""
+A self-calibration loop driven by a schedule of iterations, in place of the
+image -> gaincal -> applycal sequences written out by hand in the selfcal
+scripts.
+
+A schedule is a list of iterations (see `iteration`; `from_tuples` converts
+the ``(iternum, nterms, threshold, caltype, calmode, solint, combine)``
+tuples of imaging_continuum_selfcal_incremental.py).  `run_selfcal` runs
+three steps per iteration:
+
+    apply: apply the table solved in the previous iteration (with
+           ``accumulate``, every table solved so far)
+    image: image with the iteration's threshold (by default with
+           ``myclean``, which also writes the model to the MSes)
+    solve: solve the iteration's table, its candidate tables (other solints,
+           combine='spw', ...) and the diagnostic amplitude table, all at
+           once in a pool of worker processes
+
+When a step finishes, it is appended to a JSON checkpoint file with a hash of
+its parameters.  A rerun skips the steps that the checkpoint records and
+resumes at the first step that is not recorded.  If an iteration's
+parameters change, or a recorded table is missing, that whole iteration and
+every one after it are redone, starting with its apply step so that it is
+imaged and solved on the right data, and the tables of a redone solve are
+removed first.  The MSes are taken to start out uncalibrated
+(CORRECTED_DATA = DATA, as split from the calibrated data), so redoing the
+first iteration after tables have been applied runs clearcal first.
+
+Without a checkpoint, existing tables are kept, and the apply and image steps
+of an iteration whose image already exists count as done, as in the
+hand-written scripts, so their products are picked up rather than re-imaged
+from the current state of the data.
+
+Given a list of MSes, every table is solved and applied per epoch under the
+`mygaincal` name (<month>_<day>_T<hour>_<caltable>), and the epochs run in
+parallel too.  At most ``nprocs`` (default: NPROCS or NODE_CORES, see
+imaging_queue.py) worker processes run at once.
+"""
+import os
+import json
+import shutil
+import time
+import datetime
+
+from taskinit import casalog, tbtool
+
+from gaincal_cli import gaincal_cli as gaincal
+from bandpass_cli import bandpass_cli as bandpass
+from applycal_cli import applycal_cli as applycal
+from flagdata_cli import flagdata_cli as flagdata
+from clearcal_cli import clearcal_cli as clearcal
+
+from continuum_imaging_general import (myclean, myclean_markers,
+                                       epoch_caltable, name_regex,
+                                       run_epoch_tasks)
+import clean_manifest
+
+
+def iteration(iternum, threshold, solint=None, caltype='phase', calmode='p',
+              combine='', suffix='', candidates=(), nterms=None, image=None,
+              gaincal=None, apply=None):
+    """
+    One iteration of a schedule.
+
+    ``threshold`` is the clean threshold, and ``nterms``, if given, is passed
+    to the imaging function along with ``image`` (extra imaging parameters).
+    The iteration's table (caltable template with ``suffix``) is solved with
+    ``caltype`` ('phase', 'amp' or 'ampphase' with gaincal, or 'bandpass'),
+    ``calmode``, ``solint`` and ``combine``, plus the parameters in
+    ``gaincal``; if ``solint`` is None, no table (not even the diagnostic
+    one) is solved.  Bandpass tables average 16 channels (solint
+    '<solint>,16ch') unless ``solint`` gives its own frequency interval.
+    Amplitude and bandpass tables are clipped to gains between 0.5 and 2.  ``candidates`` is
+    a list of (suffix, parameters overriding the iteration's) of further
+    tables to solve alongside it, which are not applied.  ``apply`` holds
+    extra applycal parameters for applying the previous iteration's table
+    before imaging this one.
+    """
+    return {'iternum': iternum, 'threshold': threshold, 'solint': solint,
+            'caltype': caltype, 'calmode': calmode, 'combine': combine,
+            'suffix': suffix,
+            'candidates': [list(candidate) for candidate in candidates],
+            'nterms': nterms, 'image': image or {}, 'gaincal': gaincal or {},
+            'apply': apply or {}}
+
+
+def from_tuples(tuples, thresholds, **kwargs):
+    """
+    A schedule from ``(iternum, nterms, threshold, caltype, calmode, solint,
+    combine)`` tuples, where ``threshold`` is a format string filled with
+    ``thresholds[iternum]``
+    """
+    return [iteration(iternum, threshold.format(thresholds[iternum]),
+                      solint=solint, caltype=caltype, calmode=calmode,
+                      combine=combine, nterms=nterms, **kwargs)
+            for iternum, nterms, threshold, caltype, calmode, solint, combine
+            in tuples]
+
+
+def nspw(vis):
+    tb = tbtool()
+    tb.open(vis+"/SPECTRAL_WINDOW")
+    try:
+        return tb.nrows()
+    finally:
+        tb.close()
+
+
+def _solve(args):
+    onems, caltable_, kwargs = args
+    if os.path.exists(caltable_):
+        return 'exists'
+    kwargs = dict(kwargs)
+    caltype = kwargs.pop('caltype')
+    clip = kwargs.pop('clip')
+    if caltype == 'bandpass':
+        kwargs.pop('calmode', None)
+        kwargs.pop('gaintype', None)
+        if ',' not in kwargs['solint']:
+            kwargs['solint'] = '{0},16ch'.format(kwargs['solint'])
+        bandpass(vis=onems, caltable=caltable_, **kwargs)
+    else:
+        gaincal(vis=onems, caltable=caltable_, **kwargs)
+    if not os.path.exists(caltable_):
+        raise IOError("{0} did not produce {1}".format(caltype, caltable_))
+    if clip:
+        # avoid extreme outliers: assume anything going more than 2x in
+        # either direction is wrong
+        flagdata(vis=caltable_, mode='clip', clipminmax=[0.5, 2.0],
+                 datacolumn='CPARAM')
+    return 'done'
+
+
+def _apply(args):
+    onems, gaintables, kwargs = args
+    missing = [table for table in gaintables if not os.path.exists(table)]
+    if missing:
+        raise IOError("No such table {0}".format(", ".join(missing)))
+    applycal(vis=onems, gaintable=gaintables, **kwargs)
+    return 'done'
+
+
+class SelfcalLoop(object):
+    """ The tables and tasks of one `run_selfcal` call """
+
+    def __init__(self, vis, schedule, caltable, diagnostic, accumulate,
+                 name_regex):
+        self.vislist = list(vis) if isinstance(vis, (list, tuple)) else [vis]
+        self.per_epoch = isinstance(vis, (list, tuple))
+        self.schedule = schedule
+        self.caltable = caltable
+        self.diagnostic = diagnostic
+        self.accumulate = accumulate
+        self.name_regex = name_regex
+
+    def table(self, step, suffix, template=None):
+        """ The (base) name of a table of iteration ``step`` """
+        return (template or self.caltable).format(**dict(step, suffix=suffix))
+
+    def epoch_table(self, onems, table):
+        if self.per_epoch:
+            return epoch_caltable(onems, table, self.name_regex)
+        return table
+
+    def applied_before(self, index):
+        """ The tables (with their combine) in effect when imaging iteration ``index`` """
+        solved = [(self.table(step, step['suffix']), step['combine'])
+                  for step in self.schedule[:index] if step['solint'] is not None]
+        if self.accumulate:
+            return solved
+        return solved[-1:]
+
+    def gaintable_params(self, onems, tables):
+        """ The gaintable (and spwmap) of ``tables`` for one MS """
+        params = {'gaintable': [self.epoch_table(onems, table)
+                                for table, _ in tables]}
+        if self.accumulate:
+            params['spwmap'] = [[0]*nspw(onems) if combine == 'spw' else []
+                                for _, combine in tables]
+        return params
+
+    def solve_tasks(self, index, gaincal_kwargs):
+        """ The `_solve` tasks of iteration ``index`` """
+        step = self.schedule[index]
+        tables = self.applied_before(index) if self.accumulate else []
+        solves = []
+        if step['solint'] is not None:
+            params = dict(gaincal_kwargs, caltype=step['caltype'],
+                          calmode=step['calmode'], solint=step['solint'],
+                          combine=step['combine'],
+                          clip='amp' in step['caltype'] or step['caltype'] == 'bandpass')
+            params.update(step['gaincal'])
+            solves.append((self.table(step, step['suffix']), params))
+            for suffix, overrides in step['candidates']:
+                solves.append((self.table(step, suffix), dict(params, **overrides)))
+        if self.diagnostic is not None and step['solint'] is not None:
+            params = dict(self.diagnostic)
+            template = params.pop('caltable', None)
+            suffix = params.pop('suffix', '_ampcal_diagnostic')
+            params.setdefault('caltype', 'amp')
+            params.setdefault('clip', False)
+            solves.append((self.table(step, suffix, template), params))
+
+        tasks = []
+        for table, params in solves:
+            for onems in self.vislist:
+                kwargs = dict(params)
+                if tables:
+                    kwargs.update(self.gaintable_params(onems, tables))
+                tasks.append((_solve, onems, self.epoch_table(onems, table),
+                              kwargs))
+        return tasks
+
+    def apply_tasks(self, index, apply_kwargs):
+        """ The `_apply` tasks of iteration ``index`` (none for the first) """
+        tables = self.applied_before(index)
+        if not tables:
+            return []
+        kwargs = dict(apply_kwargs)
+        kwargs.update(self.schedule[index]['apply'])
+        tasks = []
+        for onems in self.vislist:
+            params = dict(kwargs)
+            params.update(self.gaintable_params(onems, tables))
+            gaintables = params.pop('gaintable')
+            tasks.append((_apply, onems, gaintables, params))
+        return tasks
+
+
+def load_checkpoint(checkpoint):
+    try:
+        with open(checkpoint, 'r') as fh:
+            return json.load(fh)['steps']
+    except (IOError, OSError, ValueError, KeyError):
+        return []
+
+
+def write_checkpoint(checkpoint, steps):
+    with open(checkpoint+'.tmp', 'w') as fh:
+        json.dump({'steps': steps}, fh, indent=1, sort_keys=True)
+    os.rename(checkpoint+'.tmp', checkpoint)
+
+
+def run_selfcal(vis, schedule, imagename, caltable, image=myclean,
+                image_kwargs=None, image_markers=None, gaincal_kwargs=None,
+                apply_kwargs=None, diagnostic=None, accumulate=False,
+                checkpoint=None, name_regex=name_regex, nprocs=None):
+    """
+    Self-calibrate ``vis`` (an MS, or a list of epoch MSes) following
+    ``schedule``.
+
+    ``imagename`` and ``caltable`` are templates formatted with the
+    iteration's entries (``{iternum}``, ``{caltype}``, ``{solint}``, ...) and,
+    for tables, the ``{suffix}`` of the table.  Each iteration is imaged by
+    ``image(vis=vis, name=<imagename>, threshold=<threshold>,
+    **image_kwargs)``; ``image_markers(name, threshold=..., **image_kwargs)``
+    gives the files whose existence means that was done (default: the
+    `myclean` FITS images, when ``image`` is `myclean`).  ``gaincal_kwargs``
+    and ``apply_kwargs`` are the parameters shared by every solve and apply.
+    ``diagnostic`` is the gaincal parameters of a table solved every
+    iteration that solves a table, but never applied, named by its ``suffix`` (default
+    '_ampcal_diagnostic') or its own ``caltable`` template.  With
+    ``accumulate``, every table solved so far is applied, and is also
+    pre-applied when solving.
+
+    The checkpoint defaults to <imagename with iternum ''>_checkpoint.json.
+    Returns the tables applied after the last iteration.
+    """
+    image_kwargs = image_kwargs or {}
+    gaincal_kwargs = gaincal_kwargs or {}
+    apply_kwargs = apply_kwargs or {}
+    if image_markers is None and image is myclean:
+        image_markers = myclean_markers
+    if checkpoint is None:
+        checkpoint = imagename.format(**dict((key, '') for key in
+                                             schedule[0]))+'_checkpoint.json'
+
+    loop = SelfcalLoop(vis, schedule, caltable, diagnostic, accumulate,
+                       name_regex)
+    done = load_checkpoint(checkpoint)
+    nrecorded = len(done)
+
+    # (iteration index, name, parameters, run, outputs, adopt) of every step
+    steps = []
+    for index, step in enumerate(schedule):
+        prefix = 'iter{0}'.format(step['iternum'])
+        name = imagename.format(**step)
+        kwargs = dict(image_kwargs, threshold=step['threshold'])
+        if step['nterms'] is not None:
+            kwargs['nterms'] = step['nterms']
+        kwargs.update(step['image'])
+
+        def image_done(name=name, kwargs=kwargs):
+            return (image_markers is not None
+                    and all(os.path.exists(fn) for fn in image_markers(name, **kwargs)))
+        # as the scripts did: the image is only there if the table was
+        # applied, and then both are taken as done
+        adopt = image_done if nrecorded == 0 else None
+
+        tasks = loop.apply_tasks(index, apply_kwargs)
+        if tasks:
+            steps.append((index, prefix+':apply', [task[1:] for task in tasks],
+                          lambda tasks=tasks: run_epoch_tasks(tasks, nprocs=nprocs,
+                                                              origin='selfcal apply'),
+                          [], adopt))
+
+        steps.append((index, prefix+':image', [name, kwargs],
+                      lambda name=name, kwargs=kwargs: image(vis=vis, name=name, **kwargs),
+                      [], adopt))
+
+        tasks = loop.solve_tasks(index, gaincal_kwargs)
+        if tasks:
+            steps.append((index, prefix+':solve', [task[1:] for task in tasks],
+                          lambda tasks=tasks: run_epoch_tasks(tasks, nprocs=nprocs,
+                                                              origin='selfcal solve'),
+                          [task[2] for task in tasks], None))
+
+    def recorded(position):
+        index, name, params, run, outputs, adopt = steps[position]
+        return (position < len(done) and done[position]['step'] == name
+                and done[position]['hash'] == clean_manifest.params_hash(params)
+                and all(os.path.exists(fn) for fn in outputs))
+
+    first = 0
+    while first < len(steps) and recorded(first):
+        first += 1
+    if first < min(nrecorded, len(steps)):
+        # a recorded step has to be redone, but the MSes hold the data of
+        # the last step that ran: go back to the start of its iteration, so
+        # the tables it is imaged with are applied again
+        index = steps[first][0]
+        first = min(position for position, step in enumerate(steps)
+                    if step[0] == index)
+        if index == 0 and any(name.endswith(':apply') for name in
+                              [step['step'] for step in done[first:]]):
+            # the first iteration images the MSes as they were given
+            for onems in loop.vislist:
+                casalog.post("{0}: clearing the self-calibration".format(onems),
+                             origin='selfcal')
+                clearcal(vis=onems)
+
+    for position, (index, name, params, run, outputs, adopt) in enumerate(steps):
+        if position < first:
+            casalog.post("{0}: done".format(name), origin='selfcal')
+            continue
+        if position < nrecorded:
+            # the outputs of a recorded step that is redone are out of date
+            for fn in outputs:
+                if os.path.exists(fn):
+                    shutil.rmtree(fn)
+        # everything after a step that is (re)done is out of date
+        del done[position:]
+        write_checkpoint(checkpoint, done)
+        t0 = time.time()
+        if adopt is not None and adopt():
+            casalog.post("{0}: adopting the existing products".format(name),
+                         origin='selfcal')
+            adopted = True
+        else:
+            casalog.post("{0}: running".format(name), origin='selfcal')
+            run()
+            adopted = False
+        done.append({'step': name, 'hash': clean_manifest.params_hash(params),
+                     'adopted': adopted, 'elapsed': time.time() - t0,
+                     'finished': datetime.datetime.now().isoformat()})
+        write_checkpoint(checkpoint, done)
+        casalog.post("{0}: finished in {1:0.1f}s".format(name, time.time()-t0),
+                     origin='selfcal')
+
+    return [table for table, _ in loop.applied_before(len(schedule))]
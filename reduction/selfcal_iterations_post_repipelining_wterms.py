@@ -9,7 +9,8 @@ import numpy as np
 import sys
 assert os.getenv('SCRIPT_DIR') is not None
 sys.path.append(os.getenv('SCRIPT_DIR'))
-from continuum_imaging_general import myclean, makefits
+from continuum_imaging_general import myclean, makefits, continuum_fields
+from selfcal_engine import run_selfcal, iteration
 from continuum_windows import Qmses
 
 from taskinit import msmdtool, iatool, casalog, tbtool
@@ -111,380 +112,71 @@ makemask(mode='copy', inpimage=cleanbox_mask_image,
 mask = cleanbox_mask_image
 
 
+phasecenters = {"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
+                "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
+                "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
+                "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
+               }
+
+# apply calibration from the 3 self-cal'd fields to *all* fields, and image
+# all of them at the myclean default size
+all_fields = dict(image=dict(fields=continuum_fields, imsize=8000,
+                             phasecenters=None),
+                  apply=dict(field=",".join(continuum_fields),
+                             gainfield=['Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q']))
+
+schedule = [iteration(1, '3mJy', solint='60s', gaincal=dict(minsnr=5)),
+            iteration(2, '2mJy', solint='30s', suffix='_30s',
+                      candidates=[('', {}),
+                                  ('_combinespw', dict(combine='spw')),
+                                  ('_combinespw_30s', dict(combine='spw'))],
+                      apply=dict(spwmap=[])),
+            iteration(3, '1mJy', solint='20s', suffix='_20s'),
+            iteration(4, '1mJy', solint='20s', suffix='_20s'),
+            iteration(5, '1mJy', solint='20s', suffix='_20s', **all_fields),
+            iteration(6, '1mJy', **all_fields),
+           ]
 
-
-
-
-
-
-
-imagename = '18A-229_Q_singlefield_selfcal_iter1_wterms'
-myclean(vis=cont_vis,
-        fields="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q".split(","),
-        spws='',
-        imsize=1000,
-        phasecenters={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
-                      "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
-                      "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
-                      "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
-                     },
-        cell='0.01arcsec',
-        name=imagename,
-        gridder='wproject',
-        wprojplanes=64,
-        niter=10000,
-        threshold='3mJy',
-        scales=[0,3,9],
-        robust=0.5,
-        savemodel='modelcolumn',
-        mask=mask,
-       )
-
-caltable = '18A-229_Q_concatenated_cal_iter1_wterms.cal'
-if not os.path.exists(caltable):
-    gaincal(vis=cont_vis,
-            caltable=caltable,
-            field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
-            calmode='p',
-            refant='',
-            solint='60s',
-            minsnr=5,
-            #uvrange='0~2000klambda',
-            #minblperant=3,
-           )
-
-# do a purely diagnostic ampcal
-gaincal(vis=cont_vis,
-        caltable='18A-229_Q_concatenated_cal_iter1_ampcal_diagnostic_wterms.cal',
-        gaintype='G',
-        combine='spw,scan,field',
-        solint='inf',
-        calmode='a',
-        solnorm=True)
-
-
-#moved to an earlier step
-# # create a mask
-# cleanimagename = imagename+".image.tt0.pbcor"
-# exportfits(cleanimagename, cleanimagename+".fits", overwrite=True)
-# reg = pyregion.open('cleanbox_regions_SgrB2.reg')
-# imghdu = fits.open(cleanimagename+".fits")[0]
-# #mask = reg.get_mask(imghdu)[None, None, :, :]
-# mask = reg.get_mask(header=wcs.WCS(imghdu.header).celestial.to_header(), shape=imghdu.data.shape[2:])
-# imghdu.data = mask.astype('int16')
-# imghdu.header['BITPIX'] = 16
-# imghdu.writeto('cleanbox_mask_SgrB2.fits', clobber=True)
-# cleanbox_mask_image = 'cleanbox_mask_SgrB2.image'
-# importfits(fitsimage='cleanbox_mask_SgrB2.fits',
-#            imagename=cleanbox_mask_image,
-#            overwrite=True)
-# ia.open(cleanbox_mask_image)
-# ia.calcmask(mask=cleanbox_mask_image+" > 0.5",
-#             name='cleanbox_mask')
-# 
-# ia.close()
-# cleanbox_mask = 'cleanbox_mask.mask'
-# makemask(mode='copy', inpimage=cleanbox_mask_image,
-#          inpmask=cleanbox_mask_image+":cleanbox_mask",
-#          output=cleanbox_mask,
-#          overwrite=True)
-# 
-# mask = cleanbox_mask_image
-
-imagename = '18A-229_Q_singlefield_selfcal_iter2_wterms'
-if not os.path.exists(imagename+'_Sgr_B2_N_Q_r0.5_allcont_clean1e4_2mJy.image.tt0.pbcor.fits'):
-    applycal(vis=cont_vis, flagbackup=False, gainfield=[], interp=['linearperobs'],
-             gaintable=[caltable], calwt=[False], applymode='calonly',
-             antenna='*&*', spwmap=[], parang=True,)
-
-myclean(vis=cont_vis,
-        fields="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q".split(","),
-        spws='',
-        imsize=1000,
-        phasecenters={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
-                      "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
-                      "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
-                      "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
-                     },
-        cell='0.01arcsec',
-        name=imagename,
-        scales=[0,3,9],
-        niter=10000,
-        gridder='wproject',
-        wprojplanes=64,
-        threshold='2mJy',
-        robust=0.5,
-        savemodel='modelcolumn',
-        mask=mask,
-       )
-
-caltable = '18A-229_Q_concatenated_cal_iter2_wterms.cal'
-if not os.path.exists(caltable):
-    gaincal(vis=cont_vis,
-            caltable=caltable,
-            field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
-            calmode='p',
-            refant='',
-            solint='30s',
-            #uvrange='0~2000klambda',
-            #minblperant=3,
-           )
-
-caltable = '18A-229_Q_concatenated_cal_iter2_combinespw_wterms.cal'
-if not os.path.exists(caltable):
-    gaincal(vis=cont_vis,
-            caltable=caltable,
-            field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
-            calmode='p',
-            refant='',
-            solint='30s',
-            #uvrange='0~2000klambda',
-            #minblperant=3,
-            combine='spw',
-           )
-
-caltable = '18A-229_Q_concatenated_cal_iter2_combinespw_30s_wterms.cal'
-if not os.path.exists(caltable):
-    gaincal(vis=cont_vis,
-            caltable=caltable,
-            field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
-            calmode='p',
-            refant='',
-            solint='30s',
-            #uvrange='0~2000klambda',
-            #minblperant=3,
-            combine='spw',
-           )
-
-caltable = '18A-229_Q_concatenated_cal_iter2_30s_wterms.cal'
-if not os.path.exists(caltable):
-    gaincal(vis=cont_vis,
-            caltable=caltable,
-            field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
-            calmode='p',
-            refant='',
-            solint='30s',
-            #uvrange='0~2000klambda',
-            #minblperant=3,
-           )
-
-# do a purely diagnostic ampcal
-gaincal(vis=cont_vis,
-        caltable='18A-229_Q_concatenated_cal_iter2_ampcal_diagnostic_wterms.cal',
-        gaintype='G',
-        combine='spw,scan,field',
-        solint='inf',
-        calmode='a',
-        solnorm=True)
-
-
-
-tb.open(cont_vis+"/SPECTRAL_WINDOW")
-nspw = len(tb.getcol('NAME'))
-tb.close()
-
-imagename = '18A-229_Q_singlefield_selfcal_iter3_wterms'
-if not os.path.exists(imagename+'_Sgr_B2_N_Q_r0.5_allcont_clean1e4_1mJy.image.tt0.pbcor.fits'):
-    applycal(vis=cont_vis, flagbackup=False, gainfield=[], interp=['linearperobs'],
-             gaintable=[caltable], calwt=[False], applymode='calonly',
-             antenna='*&*',
-             #spwmap=[0]*nspw,
-             parang=True,)
-
-
-outlierfile = """# Outlier File
-imagename={imname}_M
-phasecenter=J2000 17h47m20.167 -28d23m04.337
-imsize=[1000,1000]
-
-
-imagename={imname}_N
-phasecenter=J2000 17h47m19.837 -28d22m18.867
-imsize=[1000,1000]
-
-imagename={imname}_Z
-phasecenter=J2000 17h47m20.040 -28d22m41.397
-imsize=[500,500]
-
-imagename={imname}_S
-phasecenter=J2000 17h47m20.455 -28d23m45.067
-imsize=[1000,1000]""".format(imname=imagename)
-with open("outlierfile.txt","w") as fh:
-    fh.write(outlierfile)
-
-myclean(vis=cont_vis,
-        fields="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q".split(","),
-        spws='',
-        imsize=1000,
-        phasecenters={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
-                      "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
-                      "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
-                      "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
-                     },
-        cell='0.01arcsec',
-        name=imagename,
-        niter=10000,
-        gridder='wproject',
-        wprojplanes=64,
-        scales=[0,3,9],
-        threshold='1mJy',
-        robust=0.5,
-        savemodel='modelcolumn',
-        mask=mask,
-       )
-
-
-caltable = '18A-229_Q_concatenated_cal_iter3_20s_wterms.cal'
-if not os.path.exists(caltable):
-    gaincal(vis=cont_vis,
-            caltable=caltable,
-            field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
-            calmode='p',
-            refant='',
-            solint='20s',
-            #uvrange='0~2000klambda',
-            #minblperant=3,
-           )
-
-# do a purely diagnostic ampcal
-gaincal(vis=cont_vis,
-        caltable='18A-229_Q_concatenated_cal_iter3_ampcal_diagnostic_wterms.cal',
-        gaintype='G',
-        combine='spw,scan,field',
-        solint='inf',
-        calmode='a',
-        solnorm=True)
-
-
-imagename = '18A-229_Q_singlefield_selfcal_iter4_wterms'
-if not os.path.exists(imagename+'_Sgr_B2_N_Q_r0.5_allcont_clean1e4_1mJy.image.tt0.pbcor.fits'):
-    applycal(vis=cont_vis, flagbackup=False, gainfield=[], interp=['linearperobs'],
-             gaintable=[caltable], calwt=[False], applymode='calonly',
-             antenna='*&*',
-             #spwmap=[0]*nspw,
-             parang=True,)
-
-#selfcal_split_vis = 'continuum_concatenated_selfcal.ms'
-#split(vis=cont_vis, outputvis=selfcal_split_vis,
-#      datacolumn='corrected',)
 selfcal_split_vis = cont_vis
 
-myclean(vis=selfcal_split_vis,
-        fields="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q".split(","),
-        spws='',
-        imsize=1000,
-        phasecenters={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
-                      "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
-                      "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
-                      "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
-                     },
-        cell='0.01arcsec',
-        name=imagename,
-        niter=10000,
-        gridder='wproject',
-        wprojplanes=64,
-        scales=[0,3,9],
-        threshold='1mJy',
-        robust=0.5,
-        savemodel='modelcolumn',
-        mask=mask,
-       )
-
-
-caltable = '18A-229_Q_concatenated_cal_iter4_20s_wterms.cal'
-if not os.path.exists(caltable):
-    gaincal(vis=selfcal_split_vis,
-            caltable=caltable,
-            field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
-            calmode='p',
-            refant='',
-            solint='20s',
-            #uvrange='0~2000klambda',
-            #minblperant=3,
-           )
-
-# do a purely diagnostic ampcal
-gaincal(vis=cont_vis,
-        caltable='18A-229_Q_concatenated_cal_iter4_ampcal_diagnostic_wterms.cal',
-        gaintype='G',
-        combine='spw,scan,field',
-        solint='inf',
-        calmode='a',
-        solnorm=True)
-
-
-imagename = '18A-229_Q_singlefield_selfcal_iter5_wterms'
-if not os.path.exists(imagename+'_Sgr_B2_N_Q_r0.5_allcont_clean1e4_1mJy.image.tt0.pbcor.fits'):
-    # apply calibration from 4 self-cal'd fields to *all* fields
-    gainfield = 'Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q'
-    for field in 'Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q,Sgr B2 S Q,Sgr B2 DS1 Q,Sgr B2 DS2 Q,Sgr B2 DS3 Q'.split(","):
-        # apply the self-calibrations to the rest of the data
-        applycal(vis=selfcal_split_vis, field=field, flagbackup=False, gainfield=[gainfield], interp=['linearperobs'],
-                 gaintable=[caltable], calwt=[False], applymode='calonly',
-                 antenna='*&*',
-                 #spwmap=[0]*nspw,
-                 parang=True,)
-
-myclean(vis=selfcal_split_vis,
-        name=imagename,
-        spws='', # even for indiv, we're dealing with cont splitted data...
-        niter=10000,
-        threshold='1mJy',
-        gridder='wproject',
-        wprojplanes=64,
-        scales=[0,3,9],
-        robust=0.5,
-        mask=mask,
-        savemodel='modelcolumn',
-       )
-
-caltable = '18A-229_Q_concatenated_cal_iter5_20s_wterms.cal'
-if not os.path.exists(caltable):
-    gaincal(vis=selfcal_split_vis,
-            caltable=caltable,
-            field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
-            calmode='p',
-            refant='',
-            solint='20s',
-            #uvrange='0~2000klambda',
-            #minblperant=3,
+# each solve runs a gaincal per table and epoch; at most this many at once
+selfcal_nprocs = int(os.getenv('NPROCS', 4))
+
+run_selfcal(vis=cont_vis,
+            schedule=schedule,
+            imagename='18A-229_Q_singlefield_selfcal_iter{iternum}_wterms',
+            caltable='18A-229_Q_concatenated_cal_iter{iternum}{suffix}_wterms.cal',
+            image_kwargs=dict(fields="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q".split(","),
+                              spws='',
+                              imsize=1000,
+                              phasecenters=phasecenters,
+                              cell='0.01arcsec',
+                              niter=10000,
+                              gridder='wproject',
+                              wprojplanes=64,
+                              scales=[0,3,9],
+                              robust=0.5,
+                              savemodel='modelcolumn',
+                              mask=mask,
+                             ),
+            gaincal_kwargs=dict(field='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q',
+                                refant='',
+                                #uvrange='0~2000klambda',
+                                #minblperant=3,
+                               ),
+            apply_kwargs=dict(flagbackup=False, gainfield=[],
+                              interp=['linearperobs'], calwt=[False],
+                              applymode='calonly', antenna='*&*',
+                              parang=True,),
+            # a purely diagnostic ampcal
+            diagnostic=dict(gaintype='G',
+                            combine='spw,scan,field',
+                            solint='inf',
+                            calmode='a',
+                            solnorm=True),
+            nprocs=selfcal_nprocs,
            )
 
-# do a purely diagnostic ampcal
-gaincal(vis=cont_vis,
-        caltable='18A-229_Q_concatenated_cal_iter5_ampcal_diagnostic_wterms.cal',
-        gaintype='G',
-        combine='spw,scan,field',
-        solint='inf',
-        calmode='a',
-        solnorm=True)
-
-
-imagename = '18A-229_Q_singlefield_selfcal_iter6_wterms'
-if not os.path.exists(imagename+'_Sgr_B2_N_Q_r0.5_allcont_clean1e4_1mJy.image.tt0.pbcor.fits'):
-    gainfield = 'Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q'
-    for field in 'Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q,Sgr B2 S Q,Sgr B2 DS1 Q,Sgr B2 DS2 Q,Sgr B2 DS3 Q'.split(","):
-        # apply the self-calibrations to the rest of the data
-        applycal(vis=selfcal_split_vis, field=field, flagbackup=False, gainfield=[gainfield], interp=['linearperobs'],
-                 gaintable=[caltable], calwt=[False], applymode='calonly',
-                 antenna='*&*',
-                 #spwmap=[0]*nspw,
-                 parang=True,)
-
-
-myclean(vis=selfcal_split_vis,
-        name=imagename,
-        spws='', # even for indiv, we're dealing with cont splitted data...
-        niter=10000,
-        threshold='1mJy',
-        robust=0.5,
-        mask=mask,
-        scales=[0,3,9],
-        gridder='wproject',
-        wprojplanes=64,
-        savemodel='modelcolumn',
-       )
-
 imagename = '18A-229_Q_mosaic_selfcal_iter6'
 tclean(
        vis=selfcal_split_vis,
@@ -541,12 +233,3 @@ for spw in np.unique(summary['spectral windows']['names']):
            mask=mask,
           )
     makefits(imagename, cleanup=False)
-
-# do a purely diagnostic ampcal
-gaincal(vis=cont_vis,
-        caltable='18A-229_Q_concatenated_cal_iter6_ampcal_diagnostic_wterms.cal',
-        gaintype='G',
-        combine='spw,scan,field',
-        solint='inf',
-        calmode='a',
-        solnorm=True)
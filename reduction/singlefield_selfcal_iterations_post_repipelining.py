@@ -9,6 +9,7 @@ import sys
 assert os.getenv('SCRIPT_DIR') is not None
 sys.path.append(os.getenv('SCRIPT_DIR'))
 from continuum_imaging_general import myclean, makefits
+from selfcal_engine import run_selfcal, iteration
 from continuum_windows import Qmses
 
 from taskinit import msmdtool, iatool, casalog, tbtool
@@ -66,6 +67,35 @@ myprint(selfcal_mses)
 # (uncomment this line to just do one field)
 #selfcal_mses = {'03_06_T12': selfcal_mses['03_06_T12']}
 
+phasecenters = {"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
+                "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
+                "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
+                "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
+               }
+gainfield = 'Sgr B2 NM Q,Sgr B2 MS Q'
+# the last two iterations are imaged at the myclean default size
+fullsize = dict(imsize=8000, phasecenters=None)
+
+schedule = [iteration(1, '3mJy', solint='60s', gaincal=dict(minsnr=5),
+                      image=dict(fields="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q".split(","))),
+            iteration(2, '2mJy', solint='60s', apply=dict(spwmap=[])),
+            iteration(3, '1mJy', solint='60s', suffix='_60s'),
+            iteration(4, '1mJy', solint='60s', suffix='_60s'),
+            # apply the self-calibrations to the self-cal'd fields
+            iteration(5, '1mJy', solint='60s', suffix='_60s', image=fullsize,
+                      apply=dict(field='Sgr B2 NM Q,Sgr B2 MS Q',
+                                 gainfield=[gainfield])),
+            # field='': apply to all fields from the gain fields
+            iteration(6, '1mJy',
+                      image=dict(fullsize,
+                                 fields="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q".split(","),
+                                 savemodel='none'),
+                      apply=dict(field='', gainfield=[gainfield])),
+           ]
+
+# each solve runs a gaincal per table and epoch; at most this many at once
+selfcal_nprocs = int(os.getenv('NPROCS', 4))
+
 for msname, cont_vis in selfcal_mses.items():
     # this is OK because there should be no corrected column
     #clearcal(vis=cont_vis, addmodel=True)
@@ -150,328 +180,39 @@ for msname, cont_vis in selfcal_mses.items():
     mask = cleanbox_mask_image
 
 
-
-
-
-
-
-
-    imagename = '18A-229_{msname}_Q_singlefield_selfcal_iter1'.format(msname=msname)
-    myclean(vis=cont_vis,
-            fields="Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q".split(","),
-            spws='',
-            imsize=1000,
-            phasecenters={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
-                          "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
-                          "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
-                          "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
-                         },
-            cell='0.01arcsec',
-            name=imagename,
-            niter=10000,
-            threshold='3mJy',
-            scales=[0,3,9],
-            robust=0.5,
-            savemodel='modelcolumn',
-            mask=mask,
-           )
-
-    caltable = '18A-229_{msname}_Q_cal_iter1.cal'.format(msname=msname)
-    if not os.path.exists(caltable):
-        gaincal(vis=cont_vis,
-                caltable=caltable,
-                field='Sgr B2 NM Q,Sgr B2 MS Q',
-                calmode='p',
-                refant='',
-                solint='60s',
-                minsnr=5,
-                #uvrange='0~2000klambda',
-                #minblperant=3,
-               )
-
-    # do a purely diagnostic ampcal
-    gaincal(vis=cont_vis,
-            caltable='18A-229_{msname}_Q_cal_iter1_ampcal_diagnostic.cal'.format(msname=msname),
-            gaintype='G',
-            combine='spw,scan,field',
-            solint='120s',
-            calmode='a',
-            solnorm=True)
-
-
-    #moved to an earlier step
-    # # create a mask
-    # cleanimagename = imagename+".image.tt0.pbcor"
-    # exportfits(cleanimagename, cleanimagename+".fits", overwrite=True)
-    # reg = pyregion.open('cleanbox_regions_SgrB2.reg')
-    # imghdu = fits.open(cleanimagename+".fits")[0]
-    # #mask = reg.get_mask(imghdu)[None, None, :, :]
-    # mask = reg.get_mask(header=wcs.WCS(imghdu.header).celestial.to_header(), shape=imghdu.data.shape[2:])
-    # imghdu.data = mask.astype('int16')
-    # imghdu.header['BITPIX'] = 16
-    # imghdu.writeto('cleanbox_mask_SgrB2.fits', clobber=True)
-    # cleanbox_mask_image = 'cleanbox_mask_SgrB2.image'
-    # importfits(fitsimage='cleanbox_mask_SgrB2.fits',
-    #            imagename=cleanbox_mask_image,
-    #            overwrite=True)
-    # ia.open(cleanbox_mask_image)
-    # ia.calcmask(mask=cleanbox_mask_image+" > 0.5",
-    #             name='cleanbox_mask')
-    # 
-    # ia.close()
-    # cleanbox_mask = 'cleanbox_mask.mask'
-    # makemask(mode='copy', inpimage=cleanbox_mask_image,
-    #          inpmask=cleanbox_mask_image+":cleanbox_mask",
-    #          output=cleanbox_mask,
-    #          overwrite=True)
-    # 
-    # mask = cleanbox_mask_image
-
-    imagename = '18A-229_{msname}_Q_singlefield_selfcal_iter2'.format(msname=msname)
-    if not os.path.exists(imagename+'_Sgr_B2_NM_Q_r0.5_allcont_clean1e4_2mJy.image.tt0.pbcor.fits'):
-        applycal(vis=cont_vis, flagbackup=False, gainfield=[], interp=['linearperobs'],
-                 gaintable=[caltable], calwt=[False], applymode='calonly',
-                 antenna='*&*', spwmap=[], parang=True,)
-
-    myclean(vis=cont_vis,
-            fields="Sgr B2 NM Q,Sgr B2 MS Q".split(","),
-            spws='',
-            imsize=1000,
-            phasecenters={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
-                          "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
-                          "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
-                          "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
-                         },
-            cell='0.01arcsec',
-            name=imagename,
-            scales=[0,3,9],
-            niter=10000,
-            threshold='2mJy',
-            robust=0.5,
-            savemodel='modelcolumn',
-            mask=mask,
-           )
-
-    caltable = '18A-229_{msname}_Q_cal_iter2.cal'.format(msname=msname)
-    if not os.path.exists(caltable):
-        gaincal(vis=cont_vis,
-                caltable=caltable,
-                field='Sgr B2 NM Q,Sgr B2 MS Q',
-                calmode='p',
-                refant='',
-                solint='60s',
-                #uvrange='0~2000klambda',
-                #minblperant=3,
-               )
-
-
-    # do a purely diagnostic ampcal
-    gaincal(vis=cont_vis,
-            caltable='18A-229_{msname}_Q_cal_iter2_ampcal_diagnostic.cal'.format(msname=msname),
-            gaintype='G',
-            combine='spw,scan,field',
-            solint='120s',
-            calmode='a',
-            solnorm=True)
-
-
-
-    tb.open(cont_vis+"/SPECTRAL_WINDOW")
-    nspw = len(tb.getcol('NAME'))
-    tb.close()
-
-    imagename = '18A-229_{msname}_Q_singlefield_selfcal_iter3'.format(msname=msname)
-    if not os.path.exists(imagename+'_Sgr_B2_NM_Q_r0.5_allcont_clean1e4_1mJy.image.tt0.pbcor.fits'):
-        applycal(vis=cont_vis, flagbackup=False, gainfield=[], interp=['linearperobs'],
-                 gaintable=[caltable], calwt=[False], applymode='calonly',
-                 antenna='*&*',
-                 #spwmap=[0]*nspw,
-                 parang=True,)
-
-
-    outlierfile = """# Outlier File
-    imagename={imname}_M
-    phasecenter=J2000 17h47m20.167 -28d23m04.337
-    imsize=[1000,1000]
-
-
-    imagename={imname}_N
-    phasecenter=J2000 17h47m19.837 -28d22m18.867
-    imsize=[1000,1000]
-
-    imagename={imname}_Z
-    phasecenter=J2000 17h47m20.040 -28d22m41.397
-    imsize=[500,500]
-
-    imagename={imname}_S
-    phasecenter=J2000 17h47m20.455 -28d23m45.067
-    imsize=[1000,1000]""".format(imname=imagename)
-    with open("outlierfile.txt","w") as fh:
-        fh.write(outlierfile)
-
-    myclean(vis=cont_vis,
-            fields="Sgr B2 NM Q,Sgr B2 MS Q".split(","),
-            spws='',
-            imsize=1000,
-            phasecenters={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
-                          "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
-                          "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
-                          "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
-                         },
-            cell='0.01arcsec',
-            name=imagename,
-            niter=10000,
-            scales=[0,3,9],
-            threshold='1mJy',
-            robust=0.5,
-            savemodel='modelcolumn',
-            mask=mask,
-           )
-
-
-    caltable = '18A-229_{msname}_Q_cal_iter3_60s.cal'.format(msname=msname)
-    if not os.path.exists(caltable):
-        gaincal(vis=cont_vis,
-                caltable=caltable,
-                field='Sgr B2 NM Q,Sgr B2 MS Q',
-                calmode='p',
-                refant='',
-                solint='60s',
-                #uvrange='0~2000klambda',
-                #minblperant=3,
-               )
-
-    # do a purely diagnostic ampcal
-    gaincal(vis=cont_vis,
-            caltable='18A-229_{msname}_Q_cal_iter3_ampcal_diagnostic.cal'.format(msname=msname),
-            gaintype='G',
-            combine='spw,scan,field',
-            solint='120s',
-            calmode='a',
-            solnorm=True)
-
-
-    imagename = '18A-229_{msname}_Q_singlefield_selfcal_iter4'.format(msname=msname)
-    if not os.path.exists(imagename+'_Sgr_B2_NM_Q_r0.5_allcont_clean1e4_1mJy.image.tt0.pbcor.fits'):
-        applycal(vis=cont_vis, flagbackup=False, gainfield=[], interp=['linearperobs'],
-                 gaintable=[caltable], calwt=[False], applymode='calonly',
-                 antenna='*&*',
-                 #spwmap=[0]*nspw,
-                 parang=True,)
-
-
-    myclean(vis=cont_vis,
-            fields="Sgr B2 NM Q,Sgr B2 MS Q".split(","),
-            spws='',
-            imsize=1000,
-            phasecenters={"Sgr B2 N Q":'J2000 17h47m19.897 -28d22m17.340',
-                          "Sgr B2 NM Q":'J2000 17h47m20.166 -28d23m04.968',
-                          "Sgr B2 MS Q":'J2000 17h47m20.166 -28d23m04.968',
-                          "Sgr B2 S Q":'J2000 17h47m20.461 -28d23m45.059',
-                         },
-            cell='0.01arcsec',
-            name=imagename,
-            niter=10000,
-            scales=[0,3,9],
-            threshold='1mJy',
-            robust=0.5,
-            savemodel='modelcolumn',
-            mask=mask,
-           )
-
-
-    caltable = '18A-229_{msname}_Q_cal_iter4_60s.cal'.format(msname=msname)
-    if not os.path.exists(caltable):
-        gaincal(vis=cont_vis,
-                caltable=caltable,
-                field='Sgr B2 NM Q,Sgr B2 MS Q',
-                calmode='p',
-                refant='',
-                solint='60s',
-                #uvrange='0~2000klambda',
-                #minblperant=3,
+    run_selfcal(vis=cont_vis,
+                schedule=schedule,
+                imagename='18A-229_{0}_Q_singlefield_selfcal_iter{{iternum}}'.format(msname),
+                caltable='18A-229_{0}_Q_cal_iter{{iternum}}{{suffix}}.cal'.format(msname),
+                image_kwargs=dict(fields="Sgr B2 NM Q,Sgr B2 MS Q".split(","),
+                                  spws='',
+                                  imsize=1000,
+                                  phasecenters=phasecenters,
+                                  cell='0.01arcsec',
+                                  niter=10000,
+                                  scales=[0,3,9],
+                                  robust=0.5,
+                                  savemodel='modelcolumn',
+                                  mask=mask,
+                                 ),
+                gaincal_kwargs=dict(field='Sgr B2 NM Q,Sgr B2 MS Q',
+                                    refant='',
+                                    #uvrange='0~2000klambda',
+                                    #minblperant=3,
+                                   ),
+                apply_kwargs=dict(flagbackup=False, gainfield=[],
+                                  interp=['linearperobs'], calwt=[False],
+                                  applymode='calonly', antenna='*&*',
+                                  parang=True,),
+                # a purely diagnostic ampcal
+                diagnostic=dict(gaintype='G',
+                                combine='spw,scan,field',
+                                solint='120s',
+                                calmode='a',
+                                solnorm=True),
+                nprocs=selfcal_nprocs,
                )
 
-    # do a purely diagnostic ampcal
-    gaincal(vis=cont_vis,
-            caltable='18A-229_{msname}_Q_cal_iter4_ampcal_diagnostic.cal'.format(msname=msname),
-            gaintype='G',
-            combine='spw,scan,field',
-            solint='120s',
-            calmode='a',
-            solnorm=True)
-
-
-    imagename = '18A-229_{msname}_Q_singlefield_selfcal_iter5'.format(msname=msname)
-    if not os.path.exists(imagename+'_Sgr_B2_NM_Q_r0.5_allcont_clean1e4_1mJy.image.tt0.pbcor.fits'):
-        # apply calibration from 4 self-cal'd fields to *all* fields
-        gainfield = 'Sgr B2 NM Q,Sgr B2 MS Q'
-        for field in 'Sgr B2 NM Q,Sgr B2 MS Q'.split(","):
-            # apply the self-calibrations to the rest of the data
-            applycal(vis=cont_vis, field=field, flagbackup=False, gainfield=[gainfield], interp=['linearperobs'],
-                     gaintable=[caltable], calwt=[False], applymode='calonly',
-                     antenna='*&*',
-                     #spwmap=[0]*nspw,
-                     parang=True,)
-
-    myclean(vis=cont_vis,
-            name=imagename,
-            fields='Sgr B2 NM Q,Sgr B2 MS Q'.split(','),
-            spws='', # even for indiv, we're dealing with cont splitted data...
-            niter=10000,
-            threshold='1mJy',
-            scales=[0,3,9],
-            robust=0.5,
-            mask=mask,
-            savemodel='modelcolumn',
-           )
-
-    caltable = '18A-229_{msname}_Q_cal_iter5_60s.cal'.format(msname=msname)
-    if not os.path.exists(caltable):
-        gaincal(vis=cont_vis,
-                caltable=caltable,
-                field='Sgr B2 NM Q,Sgr B2 MS Q',
-                calmode='p',
-                refant='',
-                solint='60s',
-                #uvrange='0~2000klambda',
-                #minblperant=3,
-               )
-
-    # do a purely diagnostic ampcal
-    gaincal(vis=cont_vis,
-            caltable='18A-229_{msname}_Q_cal_iter5_ampcal_diagnostic.cal'.format(msname=msname),
-            gaintype='G',
-            combine='spw,scan,field',
-            solint='120s',
-            calmode='a',
-            solnorm=True)
-
-
-    imagename = '18A-229_{msname}_Q_singlefield_selfcal_iter6'.format(msname=msname)
-    if not os.path.exists(imagename+'_Sgr_B2_NM_Q_r0.5_allcont_clean1e4_1mJy.image.tt0.pbcor.fits'):
-        gainfield = 'Sgr B2 NM Q,Sgr B2 MS Q'
-
-        # field='': apply to all fields from the gain fields
-        applycal(vis=cont_vis, field='', flagbackup=False,
-                 gainfield=[gainfield], interp=['linearperobs'],
-                 gaintable=[caltable], calwt=[False], applymode='calonly',
-                 antenna='*&*', parang=True,)
-
-
-    myclean(vis=cont_vis,
-            name=imagename,
-            fields='Sgr B2 N Q,Sgr B2 NM Q,Sgr B2 MS Q'.split(','),
-            spws='', # even for indiv, we're dealing with cont splitted data...
-            niter=10000,
-            threshold='1mJy',
-            robust=0.5,
-            mask=mask,
-            scales=[0,3,9],
-            #savemodel='modelcolumn',
-            savemodel='none',
-           )
-
     imagename = '18A-229_{msname}_Q_mosaic_selfcal_iter6_hogbom'.format(msname=msname)
     tclean(
            vis=cont_vis,
@@ -527,12 +268,3 @@ for msname, cont_vis in selfcal_mses.items():
     except IOError as ex:
         myprint(str(ex))
         myprint("mtmfs cleaning failed in iteration 6")
-
-    # do a purely diagnostic ampcal
-    gaincal(vis=cont_vis,
-            caltable='18A-229_{msname}_Q_cal_iter6_ampcal_diagnostic.cal'.format(msname=msname),
-            gaintype='G',
-            combine='spw,scan,field',
-            solint='120s',
-            calmode='a',
-            solnorm=True)
@@ -0,0 +1,219 @@
+"""
+Tests of the selfcal_engine bookkeeping (what is run, skipped and adopted),
+with the CASA tasks replaced by functions that only record their calls.
+
+Run with ``python -m pytest test_selfcal_engine.py``; outside of CASA, the
+CASA modules are replaced by empty stand-ins.
+"""
+import os
+import sys
+import json
+import types
+import importlib
+
+import pytest
+
+
+def _casa_standin(name):
+    module = types.ModuleType(name)
+    if name == 'taskinit':
+        module.casalog = types.SimpleNamespace(post=lambda *args, **kwargs: None)
+        module.tbtool = module.iatool = module.msmdtool = None
+    else:
+        def task(*args, **kwargs):
+            raise RuntimeError("{0} is not available outside of CASA".format(name))
+        setattr(module, name, task)
+    return module
+
+
+for _name in ('taskinit', 'gaincal_cli', 'bandpass_cli', 'applycal_cli',
+              'flagdata_cli', 'clearcal_cli', 'tclean_cli', 'immath_cli',
+              'impbcor_cli', 'exportfits_cli'):
+    try:
+        importlib.import_module(_name)
+    except ImportError:
+        sys.modules[_name] = _casa_standin(_name)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import selfcal_engine as se
+
+
+def record(kind, **kwargs):
+    # the tasks run in worker processes, so calls are recorded in a file
+    with open('calls.json', 'a') as fh:
+        fh.write(json.dumps([kind, kwargs], sort_keys=True)+"\n")
+
+
+def calls(kind=None):
+    if not os.path.exists('calls.json'):
+        return []
+    with open('calls.json') as fh:
+        entries = [json.loads(line) for line in fh]
+    return [kwargs for name, kwargs in entries if kind in (None, name)]
+
+
+def fake_gaincal(vis, caltable, **kwargs):
+    record('gaincal', vis=vis, caltable=caltable, **kwargs)
+    os.mkdir(caltable)
+
+
+def fake_bandpass(vis, caltable, **kwargs):
+    record('bandpass', vis=vis, caltable=caltable, **kwargs)
+    os.mkdir(caltable)
+
+
+def fake_applycal(vis, gaintable, **kwargs):
+    record('applycal', vis=vis, gaintable=gaintable, **kwargs)
+
+
+def fake_image(vis, name, threshold):
+    record('image', name=name, threshold=threshold)
+    open(name+'.image.fits', 'w').close()
+
+
+def image_markers(name, **kwargs):
+    return [name+'.image.fits']
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(se, 'gaincal', fake_gaincal)
+    monkeypatch.setattr(se, 'bandpass', fake_bandpass)
+    monkeypatch.setattr(se, 'applycal', fake_applycal)
+    monkeypatch.setattr(se, 'clearcal', lambda vis: record('clearcal', vis=vis))
+    monkeypatch.setattr(se, 'flagdata', lambda **kwargs: record('flagdata', **kwargs))
+    return tmp_path
+
+
+def schedule():
+    return [se.iteration(0, '3mJy', solint='60s'),
+            se.iteration(1, '2mJy', solint='30s', suffix='_30s'),
+            se.iteration(2, '1mJy', solint='30s', suffix='_30s')]
+
+
+def selfcal(schedule, **kwargs):
+    params = dict(vis='cont.ms', schedule=schedule, imagename='im{iternum}',
+                  caltable='cal{iternum}{suffix}.cal', image=fake_image,
+                  image_markers=image_markers, nprocs=1,
+                  diagnostic=dict(solint='inf', calmode='a'))
+    params.update(kwargs)
+    return se.run_selfcal(**params)
+
+
+def test_first_run_and_rerun(workdir):
+    assert selfcal(schedule()) == ['cal2_30s.cal']
+    assert [kwargs['name'] for kwargs in calls('image')] == ['im0', 'im1', 'im2']
+    assert ([kwargs['gaintable'] for kwargs in calls('applycal')]
+            == [['cal0.cal'], ['cal1_30s.cal']])
+    assert (sorted(kwargs['caltable'] for kwargs in calls('gaincal'))
+            == sorted(['cal0.cal', 'cal1_30s.cal', 'cal2_30s.cal',
+                       'cal0_ampcal_diagnostic.cal',
+                       'cal1_ampcal_diagnostic.cal',
+                       'cal2_ampcal_diagnostic.cal']))
+
+    os.remove('calls.json')
+    selfcal(schedule())
+    assert calls() == []
+
+
+def test_changed_iteration_is_redone(workdir):
+    selfcal(schedule())
+    os.remove('calls.json')
+
+    changed = schedule()
+    changed[2]['threshold'] = '0.5mJy'
+    selfcal(changed)
+    assert [kwargs['name'] for kwargs in calls('image')] == ['im2']
+    # the out-of-date tables were removed and solved again
+    assert (sorted(kwargs['caltable'] for kwargs in calls('gaincal'))
+            == ['cal2_30s.cal', 'cal2_ampcal_diagnostic.cal'])
+    # its table is applied again before it is re-imaged
+    assert [kwargs['gaintable'] for kwargs in calls('applycal')] == [['cal1_30s.cal']]
+
+
+def order(kind_field=(('image', 'name'), ('applycal', 'gaintable'),
+                      ('gaincal', 'caltable'), ('clearcal', 'vis'))):
+    """ The recorded calls as (task, name of what they made / applied) """
+    with open('calls.json') as fh:
+        entries = [json.loads(line) for line in fh]
+    fields = dict(kind_field)
+    return [(kind, kwargs[fields[kind]]) for kind, kwargs in entries
+            if kind in fields]
+
+
+def test_changed_middle_iteration_reapplies(workdir):
+    selfcal(schedule())
+    os.remove('calls.json')
+
+    changed = schedule()
+    changed[1]['threshold'] = '1.5mJy'
+    selfcal(changed)
+    # iteration 1 is imaged after applying cal0 again, not on the data the
+    # previous run left behind (with cal1_30s applied)
+    assert [call for call in order() if call[0] != 'gaincal'] == [
+        ('applycal', ['cal0.cal']), ('image', 'im1'),
+        ('applycal', ['cal1_30s.cal']), ('image', 'im2')]
+    assert (sorted(call[1] for call in order() if call[0] == 'gaincal')
+            == ['cal1_30s.cal', 'cal1_ampcal_diagnostic.cal',
+                'cal2_30s.cal', 'cal2_ampcal_diagnostic.cal'])
+
+
+def test_missing_table_redoes_its_iteration(workdir):
+    selfcal(schedule())
+    os.remove('calls.json')
+
+    os.rmdir('cal1_30s.cal')
+    selfcal(schedule())
+    assert order()[:2] == [('applycal', ['cal0.cal']), ('image', 'im1')]
+    assert ('gaincal', 'cal1_30s.cal') in order()
+
+
+def test_redone_first_iteration_clears_calibration(workdir):
+    selfcal(schedule())
+    os.remove('calls.json')
+
+    changed = schedule()
+    changed[0]['threshold'] = '4mJy'
+    selfcal(changed)
+    assert order()[:2] == [('clearcal', 'cont.ms'), ('image', 'im0')]
+
+
+def test_existing_products_are_adopted(workdir):
+    # products of iterations 0-2 made before there was a checkpoint
+    for iternum, suffix in ((0, ''), (1, '_30s'), (2, '_30s')):
+        open('im{0}.image.fits'.format(iternum), 'w').close()
+        os.mkdir('cal{0}{1}.cal'.format(iternum, suffix))
+        os.mkdir('cal{0}_ampcal_diagnostic.cal'.format(iternum))
+
+    selfcal(schedule())
+    assert calls() == []
+    with open('im_checkpoint.json') as fh:
+        steps = json.load(fh)['steps']
+    assert ([step['step'] for step in steps if step['adopted']]
+            == ['iter0:image', 'iter1:apply', 'iter1:image', 'iter2:apply',
+                'iter2:image'])
+
+    # a later iteration is run on top of the adopted ones
+    extended = schedule() + [se.iteration(3, '1mJy', solint='20s', suffix='_20s')]
+    selfcal(extended)
+    assert [kwargs['name'] for kwargs in calls('image')] == ['im3']
+    assert [kwargs['gaintable'] for kwargs in calls('applycal')] == [['cal2_30s.cal']]
+
+
+def test_no_diagnostic_without_a_solve(workdir):
+    final = schedule()[:2] + [se.iteration(2, '1mJy')]
+    assert selfcal(final) == ['cal1_30s.cal']
+    assert 'cal2_ampcal_diagnostic.cal' not in [kwargs['caltable']
+                                                for kwargs in calls('gaincal')]
+    assert not os.path.exists('cal2_ampcal_diagnostic.cal')
+
+
+def test_bandpass_averages_channels(workdir):
+    selfcal([se.iteration(0, '3mJy', solint='inf', caltype='bandpass',
+                          calmode='ap')], diagnostic=None)
+    bandpass, = calls('bandpass')
+    assert bandpass['solint'] == 'inf,16ch'
+    assert 'calmode' not in bandpass
+    # bandpass tables are clipped
+    assert calls('flagdata')[0]['vis'] == 'cal0.cal'
@@ -1,42 +1,161 @@
+import os
 from taskinit import casac, tbtool
 import numpy as np
 
 tb = tbtool()
 
-def id_spw(vis, freq, min_chan=255):
+# in-memory copy of the per-MS spw metadata, keyed by MS path
+spw_metadata_cache = {}
+
+
+def spw_metadata_key(vis):
+    """
+    Identify the state of an MS's spectral window table: if the MS is
+    re-split or re-created, the modification times and sizes change.
+    """
+    key = []
+    for fn in (os.path.join(vis, 'table.dat'),
+               os.path.join(vis, 'SPECTRAL_WINDOW', 'table.dat'),
+               os.path.join(vis, 'SPECTRAL_WINDOW', 'table.f0')):
+        if os.path.exists(fn):
+            stat = os.stat(fn)
+            key += [stat.st_mtime, stat.st_size]
+        else:
+            key += [0, 0]
+    return np.array(key)
+
+
+def spw_metadata(vis, use_cache=True):
+    """
+    Return the channel count and the minimum, maximum and mean channel
+    frequency of every spw in ``vis`` as four arrays indexed by spw number.
+
+    The table is read with a single ``getvarcol`` and the result is cached in
+    memory and in a ``.spwmeta.npz`` file next to the MS, which is ignored if
+    the MS has changed since it was written.
+    """
+    key = spw_metadata_key(vis)
+    cachefn = vis.rstrip('/') + '.spwmeta.npz'
+
+    if use_cache and vis in spw_metadata_cache:
+        cached_key, meta = spw_metadata_cache[vis]
+        if np.all(cached_key == key):
+            return meta
+
+    if use_cache and os.path.exists(cachefn):
+        try:
+            with np.load(cachefn) as cache:
+                if np.all(cache['key'] == key):
+                    meta = (cache['nchan'], cache['minfreq'],
+                            cache['maxfreq'], cache['meanfreq'])
+                    spw_metadata_cache[vis] = key, meta
+                    return meta
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
     tb.open(vis+"/SPECTRAL_WINDOW")
     nchans = tb.getcol('NUM_CHAN')
-    for spwnum, nchan in enumerate(nchans):
-        if nchan < min_chan:
-            continue
-        else:
-            frqs = tb.getcol("CHAN_FREQ", startrow=spwnum, nrow=1)
-            minfrq, maxfrq = frqs.min(), frqs.max()
-            if (minfrq < freq) and (maxfrq > freq):
-                return spwnum
+    # CHAN_FREQ is not a fixed-shape column, so fetch all rows in one go
+    # as a dict of 'r1', 'r2', ...
+    frqs = tb.getvarcol('CHAN_FREQ')
+    tb.close()
 
-    raise ValueError("No match for frequency {0} found in {1}"
-                     .format(freq, vis))
+    nspw = len(nchans)
+    minfreq = np.array([frqs['r{0}'.format(ii+1)].min() for ii in range(nspw)])
+    maxfreq = np.array([frqs['r{0}'.format(ii+1)].max() for ii in range(nspw)])
+    meanfreq = np.array([frqs['r{0}'.format(ii+1)].mean() for ii in range(nspw)])
+    meta = np.asarray(nchans), minfreq, maxfreq, meanfreq
 
-def id_spws(vislist, freq):
-    return ",".join([str(id_spw(ms, freq)) for ms in vislist])
+    if use_cache:
+        spw_metadata_cache[vis] = key, meta
+        try:
+            with open(cachefn, 'wb') as fh:
+                np.savez(fh, key=key, nchan=meta[0], minfreq=minfreq,
+                         maxfreq=maxfreq, meanfreq=meanfreq)
+        except (IOError, OSError) as ex:
+            print("Could not write spw cache {0}: {1}".format(cachefn, ex))
 
+    return meta
 
-def get_spw_mapping(vis, caltable):
+
+def match_spws(vislist, freqs, min_chan=255):
     """
-    Obtain a spwmap mapping a calibration table to a specific observation using
-    the metadata in the measurement set and the caltable.  The returned spwmap
-    should be passable to `applycal`.
+    Find the spw containing each frequency in each MS.
+
+    Returns an integer array of shape ``(len(vislist), len(freqs))`` holding
+    the first spw (in spw order) with at least ``min_chan`` channels that
+    contains the frequency, or -1 where there is none.
     """
+    freqs = np.atleast_1d(np.asarray(freqs, dtype='float'))
+    metas = [spw_metadata(vis) for vis in vislist]
+
+    # pad all of the MSes onto a common (nvis, nspw) grid; padded entries can
+    # never match
+    nspw = max([len(meta[0]) for meta in metas] + [0])
+    nchan = np.zeros([len(vislist), nspw], dtype='int')
+    minfreq = np.full([len(vislist), nspw], np.inf)
+    maxfreq = np.full([len(vislist), nspw], -np.inf)
+    for ii, (nch, mn, mx, _) in enumerate(metas):
+        nchan[ii, :len(nch)] = nch
+        minfreq[ii, :len(mn)] = mn
+        maxfreq[ii, :len(mx)] = mx
+
+    match = ((minfreq[:, None, :] < freqs[None, :, None]) &
+             (maxfreq[:, None, :] > freqs[None, :, None]) &
+             (nchan[:, None, :] >= min_chan))
+
+    spws = match.argmax(axis=2)
+    spws[~match.any(axis=2)] = -1
+
+    return spws
+
+
+def id_spw(vis, freq, min_chan=255):
+    spwnum = match_spws([vis], [freq], min_chan=min_chan)[0, 0]
+    if spwnum < 0:
+        raise ValueError("No match for frequency {0} found in {1}"
+                         .format(freq, vis))
+    return int(spwnum)
+
+def id_spws(vislist, freq, min_chan=255):
+    spws = match_spws(vislist, [freq], min_chan=min_chan)[:, 0]
+    for vis, spwnum in zip(vislist, spws):
+        if spwnum < 0:
+            raise ValueError("No match for frequency {0} found in {1}"
+                             .format(freq, vis))
+    return ",".join([str(spwnum) for spwnum in spws])
+
+
+# caltable metadata and finished spwmaps, keyed by path(s)
+caltable_metadata_cache = {}
+spw_mapping_cache = {}
+
+
+def table_key(tablename):
+    fn = os.path.join(tablename, 'table.dat')
+    if os.path.exists(fn):
+        stat = os.stat(fn)
+        return (stat.st_mtime, stat.st_size)
+    return (0, 0)
+
+
+def caltable_metadata(caltable):
+    """
+    Read the spw frequencies, observation mid-times, and per-solution
+    observation and spw ids of a caltable, opening each subtable once.
+    """
+    key = table_key(caltable)
+    if caltable in caltable_metadata_cache:
+        cached_key, meta = caltable_metadata_cache[caltable]
+        if cached_key == key:
+            return meta
 
     tb.open(caltable+"/SPECTRAL_WINDOW")
     cal_freqs = tb.getcol('CHAN_FREQ')[0,:]
     tb.close()
 
     tb.open(caltable+"/OBSERVATION")
-    caltimes = tb.getcol('TIME_RANGE')
-    calstarttimes,calendtimes = caltimes
-    calmidtimes = caltimes.mean(axis=0)
+    calmidtimes = tb.getcol('TIME_RANGE').mean(axis=0)
     tb.close()
 
     tb.open(caltable)
@@ -44,32 +163,68 @@ def get_spw_mapping(vis, caltable):
     spw_ids = tb.getcol('SPECTRAL_WINDOW_ID')
     tb.close()
 
+    meta = cal_freqs, calmidtimes, obsids, spw_ids
+    caltable_metadata_cache[caltable] = key, meta
+    return meta
 
-    tb.open(vis+"/OBSERVATION")
-    obs_time = tb.getcol('TIME_RANGE')
-    tb.close()
 
-    closest_cal = np.argmin(np.abs(obs_time.mean()-calmidtimes)) 
-    assert obs_time[0] < calmidtimes[closest_cal] < obs_time[1]
+def get_spw_mappings(pairs):
+    """
+    Obtain spwmaps for many (vis, caltable) pairs at once.
+
+    Each MS and caltable is read only once (see `spw_metadata` and
+    `caltable_metadata`), and the nearest-frequency matching for all pairs is
+    done in a single broadcast over a padded (pair, ms spw, cal spw) array.
+    Returns a dict mapping each (vis, caltable) pair to its spwmap; results are
+    cached until either table changes.
+    """
+    pairs = [tuple(pair) for pair in pairs]
+    keys = {pair: (spw_metadata_key(pair[0]).tolist(), table_key(pair[1]))
+            for pair in pairs}
+    todo = [pair for pair in pairs
+            if pair not in spw_mapping_cache or
+            spw_mapping_cache[pair][0] != keys[pair]]
+
+    ms_freqs = []
+    obs_cal_freqs = []
+    for vis, caltable in todo:
+        cal_freqs, calmidtimes, obsids, spw_ids = caltable_metadata(caltable)
+
+        tb.open(vis+"/OBSERVATION")
+        obs_time = tb.getcol('TIME_RANGE')
+        tb.close()
+
+        closest_cal = np.argmin(np.abs(obs_time.mean()-calmidtimes))
+        assert obs_time[0] < calmidtimes[closest_cal] < obs_time[1]
 
-    obs_match = obsids == closest_cal
-    spws_match = np.unique(spw_ids[obs_match])
+        spws_match = np.unique(spw_ids[obsids == closest_cal])
+        obs_cal_freqs.append(cal_freqs[spws_match])
+        ms_freqs.append(spw_metadata(vis)[3])
 
-    obs_cal_freqs = cal_freqs[spws_match]
+    if todo:
+        nms = max(len(x) for x in ms_freqs)
+        ncal = max(len(x) for x in obs_cal_freqs)
+        msgrid = np.full([len(todo), nms], np.nan)
+        calgrid = np.full([len(todo), ncal], np.inf)
+        for ii, (msf, calf) in enumerate(zip(ms_freqs, obs_cal_freqs)):
+            msgrid[ii, :len(msf)] = msf
+            calgrid[ii, :len(calf)] = calf
 
-    spwmap = []
+        # padded cal spws are at infinite distance and are never chosen
+        closest = np.argmin(np.abs(msgrid[:, :, None] - calgrid[:, None, :]),
+                            axis=2)
 
-    tb.open(vis+"/SPECTRAL_WINDOW")
-    nchans = tb.getcol('NUM_CHAN')
-    tb.close()
-    for spwnum, nchan in enumerate(nchans):
-        tb.open(vis+"/SPECTRAL_WINDOW")
-        frqs = tb.getcol("CHAN_FREQ", startrow=spwnum, nrow=1)
-        tb.close()
+        for ii, pair in enumerate(todo):
+            spwmap = closest[ii, :len(ms_freqs[ii])].tolist()
+            spw_mapping_cache[pair] = keys[pair], spwmap
+
+    return {pair: list(spw_mapping_cache[pair][1]) for pair in pairs}
 
-        meanfreq = frqs.mean()
-        closest_freq = np.argmin(np.abs(meanfreq-obs_cal_freqs))
-        
-        spwmap.append(closest_freq)
 
-    return spwmap
+def get_spw_mapping(vis, caltable):
+    """
+    Obtain a spwmap mapping a calibration table to a specific observation using
+    the metadata in the measurement set and the caltable.  The returned spwmap
+    should be passable to `applycal`.
+    """
+    return get_spw_mappings([(vis, caltable)])[(vis, caltable)]
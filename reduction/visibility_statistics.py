@@ -0,0 +1,158 @@
+"""
+Visibility amplitude statistics (min, max, mean, median) of several columns,
+spws and fields of an MS from a single chunked read of its main table, in
+place of one ``ms.statistics`` call (one full scan of the selection) per
+column / spw / field.
+
+Each MS is read by one worker process, one DATA_DESC_ID at a time (the data
+shape is fixed within one), in blocks of rows of at most ``max_bytes``.
+Unflagged amplitudes update a running count, sum, min and max and a
+log-spaced histogram per (column, spw, field); the median is read off the
+histogram, so it is accurate to ~0.5% (half a bin), while the other
+statistics are exact.  The results of all MSes are collected in one Table.
+
+Like ``ms.statistics``, flagged data are excluded.
+"""
+import os
+import multiprocessing
+import numpy as np
+from astropy.table import Table
+from taskinit import tbtool
+
+# the median histogram: 4000 bins of 0.004 dex over 1e-10 .. 1e6
+hist_lo, hist_hi, hist_nbins = -10., 6., 4000
+hist_dex = (hist_hi - hist_lo) / hist_nbins
+
+colnames = ['vis', 'column', 'spw', 'field', 'npts', 'min', 'max', 'median', 'mean']
+
+
+def new_accumulator():
+    return {'npts': 0, 'sum': 0., 'min': np.inf, 'max': -np.inf,
+            'hist': np.zeros(hist_nbins, dtype='int64')}
+
+
+def accumulate(acc, values):
+    """
+    Add the (1D, finite) amplitudes ``values`` to ``acc``
+    """
+    if values.size == 0:
+        return
+    acc['npts'] += values.size
+    acc['sum'] += values.sum(dtype='float64')
+    acc['min'] = min(acc['min'], values.min())
+    acc['max'] = max(acc['max'], values.max())
+    with np.errstate(divide='ignore'):
+        # zeros fall in the first bin
+        bins = ((np.log10(values) - hist_lo) / hist_dex).astype('int')
+    acc['hist'] += np.bincount(np.clip(bins, 0, hist_nbins-1),
+                               minlength=hist_nbins)
+
+
+def histogram_median(hist):
+    """
+    The median of the values in the log-spaced ``hist``, interpolated
+    (geometrically) within its bin
+    """
+    cumulative = np.cumsum(hist)
+    half = cumulative[-1] / 2.
+    ii = np.searchsorted(cumulative, half)
+    below = cumulative[ii-1] if ii > 0 else 0
+    frac = (half - below) / float(hist[ii])
+    return 10**(hist_lo + (ii + frac) * hist_dex)
+
+
+def ms_statistics(vis, columns=('DATA', 'CORRECTED_DATA'), spws=None,
+                  fields=None, max_bytes=512*1024**2):
+    """
+    Amplitude statistics of ``columns`` for each selected spw and field
+    (names) of ``vis`` (``None`` selects all of them).  Returns a list of rows
+    ordered as `colnames`.
+    """
+    tb = tbtool()
+
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    ddid_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+    tb.open(os.path.join(vis, 'FIELD'))
+    field_names = list(tb.getcol('NAME'))
+    tb.close()
+
+    field_ids = [ii for ii, name in enumerate(field_names)
+                 if fields is None or name in fields]
+    if not field_ids:
+        return []
+
+    accumulators = {}
+
+    tb.open(vis)
+    try:
+        columns = [col for col in columns if col in tb.colnames()]
+        for ddid, spw in enumerate(ddid_spw):
+            if spws is not None and spw not in spws:
+                continue
+            sub = tb.query('DATA_DESC_ID=={0} && FIELD_ID IN [{1}]'
+                           .format(ddid, ",".join(map(str, field_ids))))
+            try:
+                nrows = sub.nrows()
+                if nrows == 0:
+                    continue
+                # complex64 data -> float64 amplitudes, per column
+                rowbytes = np.prod(sub.getcell('FLAG', 0).shape) * 16 * len(columns)
+                chunk = int(max(1, max_bytes // rowbytes))
+
+                for start in range(0, nrows, chunk):
+                    nrow = min(chunk, nrows - start)
+                    fieldcol = sub.getcol('FIELD_ID', start, nrow)
+                    good = ~sub.getcol('FLAG', start, nrow)
+                    for col in columns:
+                        amp = np.abs(sub.getcol(col, start, nrow))
+                        for field_id in np.unique(fieldcol):
+                            key = (col, spw, field_names[field_id])
+                            if key not in accumulators:
+                                accumulators[key] = new_accumulator()
+                            sel = fieldcol == field_id
+                            accumulate(accumulators[key],
+                                       amp[..., sel][good[..., sel]])
+            finally:
+                sub.close()
+    finally:
+        tb.close()
+
+    rows = []
+    for (col, spw, field), acc in sorted(accumulators.items()):
+        if acc['npts'] == 0:
+            continue
+        rows.append([vis, col, spw, field, acc['npts'], acc['min'], acc['max'],
+                     histogram_median(acc['hist']), acc['sum'] / acc['npts']])
+    return rows
+
+
+def _ms_statistics(args):
+    vis, kwargs = args
+    return ms_statistics(vis, **kwargs)
+
+
+def visibility_statistics(vislist, nprocs=None, **kwargs):
+    """
+    Run `ms_statistics` (with ``kwargs``) on every MS in ``vislist``, in
+    parallel, and return all of the results as one Table.  ``nprocs``
+    defaults to the NPROCS environment variable or the number of cores.
+    """
+    if nprocs is None:
+        nprocs = int(os.getenv('NPROCS', multiprocessing.cpu_count()))
+
+    jobs = [(vis, kwargs) for vis in vislist]
+    if nprocs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=min(nprocs, len(jobs)))
+        try:
+            results = pool.map(_ms_statistics, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_ms_statistics(job) for job in jobs]
+
+    rows = [row for result in results for row in result]
+    if rows:
+        return Table(rows=rows, names=colnames)
+    return Table(names=colnames)